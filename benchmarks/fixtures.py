@@ -0,0 +1,35 @@
+'''
+fixtures.py -- Synthetic tables and storage for the benchmarks.
+'''
+import random
+from src.gdp_storage import InMemoryStorageManager, SimulatedLatencyStorageManager
+
+SCHEMA = [
+  {"name": "id", "type": "number"},
+  {"name": "name", "type": "string"},
+  {"name": "category", "type": "string"},
+  {"name": "score", "type": "number"},
+  {"name": "passed", "type": "boolean"}
+]
+
+CATEGORIES = [f'cat_{i}' for i in range(20)]
+
+
+def make_rows(num_rows, seed=17):
+  rng = random.Random(seed)
+  return [
+    [i, f'name_{i}', CATEGORIES[i % len(CATEGORIES)], rng.random() * 100, i % 2 == 0]
+    for i in range(num_rows)
+  ]
+
+def make_table(num_rows, seed=17):
+  return {"type": "RowTable", "schema": SCHEMA, "rows": make_rows(num_rows, seed)}
+
+
+
+def make_storage(latency_s=0.0, jitter=0.0, bandwidth=None):
+  '''
+  An in-memory store which behaves like a remote blob store with latency_s per operation
+  '''
+  latency = {operation: latency_s for operation in SimulatedLatencyStorageManager.OPERATIONS}
+  return SimulatedLatencyStorageManager(InMemoryStorageManager(), latency=latency, jitter=jitter, bandwidth=bandwidth, seed=17)
@@ -0,0 +1,264 @@
+'''
+run.py -- Benchmarks for GDPTableManager and the SDTP/repo endpoints.
+
+Usage:
+  python -m benchmarks.run [--full] [--rows 1000 100000] [--tables 10 1000]
+                           [--latency-ms 0] [--repeat 5] [--output bench_results.json]
+                           [--compare previous.json]
+
+The startup cases time importing src.app and create_app in fresh interpreters.  The
+other cases run against InMemoryStorageManager wrapped in a
+SimulatedLatencyStorageManager with a fixed per-operation latency (--latency-ms, default 0).
+Storage calls per operation are recorded with each result.  Results are written as
+JSON: a "meta" block describing the run and a "results" list with one record per case
+and size.
+With --compare, cases whose median got more than --threshold (default 20%) slower
+than in the previous results file are reported, and the exit status is 1.
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+os.environ.setdefault('DEBUG_GDP', 'true')
+# DEBUG_GDP would also turn on DEBUG logging, burying the results in app log lines
+os.environ.setdefault('GDP_LOG_LEVEL', 'WARNING')
+os.environ.setdefault('STORAGE_ENVIRONMENT', 'MEMORY')
+os.environ.setdefault('GDP_METRICS', 'false')
+
+from json import dumps
+from sdtp import json_serialize
+from src.gdp_table_manager import GDPTableManager
+from benchmarks.fixtures import make_storage, make_table
+
+QUICK_ROWS = [1000, 100000]
+FULL_ROWS = [1000, 100000, 1000000, 10000000]
+QUICK_TABLES = [10, 1000]
+FULL_TABLES = [10, 1000, 10000]
+
+FILTER_SHAPES = {
+  'all_rows': None,
+  'in_list_id': {"operator": "IN_LIST", "column": "id", "values": list(range(0, 1000, 100))},
+  'in_range_score': {"operator": "IN_RANGE", "column": "score", "min_val": 10, "max_val": 20},
+  'compound': {"operator": "ALL", "arguments": [
+    {"operator": "IN_RANGE", "column": "score", "min_val": 0, "max_val": 50},
+    {"operator": "IN_LIST", "column": "category", "values": ["cat_1", "cat_2"]}
+  ]},
+  'regex_name': {"operator": "REGEX_MATCH", "column": "name", "expression": "name_1.*"}
+}
+
+BENCH_USER = 'bench@gdp'
+
+
+def _stats(samples):
+  samples = sorted(samples)
+  return {
+    'repeat': len(samples),
+    'min_s': samples[0],
+    'median_s': statistics.median(samples),
+    'p95_s': samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+    'mean_s': statistics.fmean(samples)
+  }
+
+def _time(fn, repeat, setup=None, storage=None):
+  samples = []
+  calls = {}
+  for i in range(repeat):
+    if setup is not None:
+      setup()
+    if storage is not None:
+      storage.reset_counts()
+    start = time.perf_counter()
+    fn()
+    samples.append(time.perf_counter() - start)
+    if storage is not None:
+      for (operation, count) in storage.call_counts.items():
+        calls[operation] = calls.get(operation, 0) + count
+  result = _stats(samples)
+  if storage is not None:
+    result['storage_calls_per_op'] = {operation: count / repeat for (operation, count) in calls.items() if count > 0}
+  return result
+
+def _record(results, name, params, timing):
+  record = {'name': name, 'params': params, **timing}
+  results.append(record)
+  print(f'{name:32s} {json.dumps(params):40s} median {timing["median_s"] * 1000:10.3f} ms', file=sys.stderr)
+
+def _manager(latency_s):
+  # No journal poller: it would never stop, and its list calls would count against the benchmarks
+  return GDPTableManager(make_storage(latency_s), journal_poll_interval=0)
+
+
+def bench_get_table(results, args, num_rows):
+  manager = _manager(args.latency)
+  key = f'{BENCH_USER}/get_table_{num_rows}.sdml'
+  manager.publish_table(key, make_table(num_rows))
+  params = {'rows': num_rows}
+  _record(results, 'get_table_hit', params, _time(lambda: manager.get_table(key), args.repeat, storage=manager.storage_manager))
+  _record(results, 'get_table_miss', params, _time(lambda: manager.get_table(key), args.repeat, setup=lambda: manager._evict(key), storage=manager.storage_manager))
+
+def bench_all_user_tables(results, args, num_tables):
+  manager = _manager(args.latency)
+  table = make_table(2)
+  for i in range(num_tables):
+    owner = BENCH_USER if i % 2 == 0 else f'other_{i % 7}@gdp'
+    manager.publish_table(f'{owner}/table_{i}.sdml', table)
+  _record(results, 'all_user_tables', {'tables': num_tables}, _time(lambda: manager.all_user_tables(BENCH_USER, True), args.repeat, storage=manager.storage_manager))
+
+def bench_filtered_rows(results, args, num_rows):
+  manager = _manager(args.latency)
+  key = f'{BENCH_USER}/filter_{num_rows}.sdml'
+  manager.publish_table(key, make_table(num_rows))
+  table = manager.get_table(key)
+  for (shape, filter_spec) in FILTER_SHAPES.items():
+    def run():
+      rows = table.get_filtered_rows(filter_spec=filter_spec, columns=['id', 'score'])
+      dumps(rows, default=json_serialize)
+    _record(results, f'get_filtered_rows.{shape}', {'rows': num_rows}, _time(run, args.repeat))
+  indexed_key = f'{BENCH_USER}/filter_indexed_{num_rows}.sdml'
+  manager.publish_table(indexed_key, {**make_table(num_rows), 'indexes': {'id': 'hash', 'category': 'hash', 'score': 'sorted'}})
+  indexed_table = manager.get_table(indexed_key)
+  for (shape, filter_spec) in FILTER_SHAPES.items():
+    def run_indexed():
+      rows = manager.filter_rows(indexed_key, indexed_table, filter_spec=filter_spec, columns=['id', 'score'])
+      dumps(rows, default=json_serialize)
+    _record(results, f'filter_rows_indexed.{shape}', {'rows': num_rows}, _time(run_indexed, args.repeat))
+
+def bench_publish(results, args, num_rows):
+  manager = _manager(args.latency)
+  table = make_table(num_rows)
+  key = f'{BENCH_USER}/publish_{num_rows}.sdml'
+  _record(results, 'publish_table', {'rows': num_rows}, _time(lambda: manager.publish_table(key, table), args.repeat, storage=manager.storage_manager))
+
+def bench_endpoints(results, args, num_rows):
+  '''
+  Time the SDTP and repo routes end to end through the Flask test client
+  '''
+  from src.app import create_app
+  app = create_app()
+  app.table_manager = _manager(args.latency)  # type: ignore[attr-defined]
+  key = f'{BENCH_USER}/endpoint_{num_rows}.sdml'
+  app.table_manager.publish_table(key, make_table(num_rows))  # type: ignore[attr-defined]
+  headers = {'Debug-User': BENCH_USER}
+  client = app.test_client()
+  params = {'rows': num_rows}
+  cases = {
+    'GET /get_table_schema': lambda: client.get(f'/services/gdp/get_table_schema?table={key}', headers=headers),
+    'GET /get_range_spec': lambda: client.get(f'/services/gdp/get_range_spec?table={key}&column=score', headers=headers),
+    'POST /get_filtered_rows': lambda: client.post('/services/gdp/get_filtered_rows', headers=headers, json={'table': key, 'filter_spec': FILTER_SHAPES['in_range_score']}),
+    'GET /table (download)': lambda: client.get(f'/services/gdp/table?table={key}', headers=headers),
+  }
+  for (name, request) in cases.items():
+    response = request()
+    if response.status_code != 200:
+      raise RuntimeError(f'{name} returned {response.status_code}')
+    _record(results, name, params, _time(request, args.repeat, storage=app.table_manager.storage_manager))  # type: ignore[attr-defined]
+
+
+# Modules which only some deployments need, and which startup should not import
+OPTIONAL_MODULES = ('google.cloud.storage', 'azure.storage.blob', 'jupyterhub.services.auth', 'user_agents')
+
+STARTUP_SCRIPT = f'''
+import json, sys, time
+start = time.perf_counter()
+import src.app
+imported = time.perf_counter()
+src.app.create_app()
+created = time.perf_counter()
+print(json.dumps({{"import_s": imported - start, "create_app_s": created - imported,
+                  "optional_modules": [m for m in {OPTIONAL_MODULES!r} if m in sys.modules]}}))
+'''
+
+def bench_startup(results, args):
+  '''
+  Time a cold worker start: importing src.app and calling create_app, each in a fresh
+  interpreter.  Records which optional modules startup imported.
+  '''
+  env = {**os.environ, 'STORAGE_ENVIRONMENT': 'MEMORY', 'GDP_LOG_LEVEL': 'WARNING'}
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  runs = []
+  for i in range(args.repeat):
+    output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, text=True, check=True, cwd=root, env=env).stdout
+    runs.append(json.loads(output.strip().splitlines()[-1]))
+  params = {'storage': 'MEMORY'}
+  for stage in ('import_s', 'create_app_s'):
+    timing = _stats([run[stage] for run in runs])
+    timing['optional_modules'] = runs[-1]['optional_modules']
+    _record(results, f'startup_{stage[:-2]}', params, timing)
+
+
+def _git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except Exception:
+    return None
+
+def compare(results, previous_path, threshold):
+  '''
+  Return the cases whose median is more than threshold (a fraction) slower than in previous_path
+  '''
+  with open(previous_path) as f:
+    previous = json.load(f)
+  baseline = {(r['name'], json.dumps(r['params'], sort_keys=True)): r['median_s'] for r in previous['results']}
+  regressions = []
+  for record in results:
+    old = baseline.get((record['name'], json.dumps(record['params'], sort_keys=True)))
+    if old and record['median_s'] > old * (1 + threshold):
+      regressions.append({'name': record['name'], 'params': record['params'], 'previous_s': old, 'current_s': record['median_s']})
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='GDP table repo benchmarks')
+  parser.add_argument('--full', action='store_true', help='run the large sizes (up to 10M rows, 10k tables)')
+  parser.add_argument('--rows', type=int, nargs='*', help='row counts for the table benchmarks')
+  parser.add_argument('--tables', type=int, nargs='*', help='table counts for all_user_tables')
+  parser.add_argument('--latency-ms', type=float, default=0.0, help='storage latency injected per operation')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--output', default='bench_results.json')
+  parser.add_argument('--compare', help='previous results file to check for regressions')
+  parser.add_argument('--threshold', type=float, default=0.2)
+  args = parser.parse_args(argv)
+  args.latency = args.latency_ms / 1000.0
+  row_counts = args.rows or (FULL_ROWS if args.full else QUICK_ROWS)
+  table_counts = args.tables or (FULL_TABLES if args.full else QUICK_TABLES)
+
+  results = []
+  bench_startup(results, args)
+  for num_rows in row_counts:
+    bench_get_table(results, args, num_rows)
+    bench_filtered_rows(results, args, num_rows)
+    bench_publish(results, args, num_rows)
+    bench_endpoints(results, args, num_rows)
+  for num_tables in table_counts:
+    bench_all_user_tables(results, args, num_tables)
+
+  report = {
+    'meta': {
+      'timestamp': datetime.now(timezone.utc).isoformat(),
+      'git_commit': _git_commit(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'latency_ms': args.latency_ms,
+      'repeat': args.repeat
+    },
+    'results': results
+  }
+  with open(args.output, 'w') as f:
+    json.dump(report, f, indent=2)
+  print(f'wrote {len(results)} results to {args.output}', file=sys.stderr)
+  if args.compare:
+    regressions = compare(results, args.compare, args.threshold)
+    for regression in regressions:
+      print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,155 @@
+'''
+aggregate.py -- Server-side group-by aggregation over the rows of a table.
+
+An aggregation is described by a list of group-by columns and a list of aggregates:
+  {"function": "count"}                                   rows in the group
+  {"function": "count", "column": "c"}                    non-null values of c
+  {"function": "sum" | "mean", "column": "c"}             c must be a number column
+  {"function": "min" | "max", "column": "c"}              any column
+Each aggregate may carry a "name" for its result column; the default is
+"<function>_<column>" (or "count").  Null values are ignored, and the mean, min and max
+of a group with no values are null.
+
+aggregate_rows makes one pass over the rows and returns one row per group, in the order
+the groups are first seen, so only the (small) result ever leaves the server.
+'''
+from typing import List, Optional, Tuple
+from sdtp import InvalidDataException
+
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'mean', 'min', 'max')
+
+
+def _check_spec(schema: list, group_by: Optional[list], aggregates: list) -> Tuple[List[int], List[tuple], list]:
+  # Validate the request, and return the group-by indices, the aggregate plans
+  # (function, column index or None) and the schema of the result
+  column_names = [entry['name'] for entry in schema]
+  group_by = group_by or []
+  if not isinstance(group_by, list) or any(column not in column_names for column in group_by):
+    raise InvalidDataException(f'group_by must be a list of columns of the table, {column_names}')
+  if not isinstance(aggregates, list) or len(aggregates) == 0:
+    raise InvalidDataException('aggregates must be a non-empty list')
+  group_indices = [column_names.index(column) for column in group_by]
+  result_schema = [schema[i] for i in group_indices]
+  plans = []
+  for aggregate in aggregates:
+    if not isinstance(aggregate, dict) or aggregate.get('function') not in AGGREGATE_FUNCTIONS:
+      raise InvalidDataException(f'Each aggregate must be a dictionary whose function is one of {AGGREGATE_FUNCTIONS}')
+    function = aggregate['function']
+    column = aggregate.get('column')
+    if column is None and function != 'count':
+      raise InvalidDataException(f'{function} requires a column')
+    if column is not None and column not in column_names:
+      raise InvalidDataException(f'{column} is not a column of the table')
+    if column is None:
+      column_index = None
+      result_type = 'number'
+    else:
+      column_index = column_names.index(column)
+      column_type = schema[column_index]['type']
+      if function in ('sum', 'mean') and column_type != 'number':
+        raise InvalidDataException(f'{function} requires a number column, but {column} is a {column_type}')
+      result_type = column_type if function in ('min', 'max') else 'number'
+    name = aggregate.get('name') or (function if column is None else f'{function}_{column}')
+    result_schema.append({'name': name, 'type': result_type})
+    plans.append((function, column_index))
+  names = [entry['name'] for entry in result_schema]
+  if len(set(names)) != len(names):
+    raise InvalidDataException(f'The result columns {names} are not unique; name the aggregates')
+  return (group_indices, plans, result_schema)
+
+
+class _Count:
+  def __init__(self):
+    self.count = 0
+
+  def add(self, value) -> None:
+    self.count += 1
+
+  def result(self):
+    return self.count
+
+
+class _Sum:
+  def __init__(self):
+    self.total = 0
+
+  def add(self, value) -> None:
+    self.total += value
+
+  def result(self):
+    return self.total
+
+
+class _Mean:
+  def __init__(self):
+    self.total = 0
+    self.count = 0
+
+  def add(self, value) -> None:
+    self.total += value
+    self.count += 1
+
+  def result(self):
+    return self.total / self.count if self.count else None
+
+
+class _Min:
+  def __init__(self):
+    self.value = None
+
+  def add(self, value) -> None:
+    if self.value is None or value < self.value:
+      self.value = value
+
+  def result(self):
+    return self.value
+
+
+class _Max:
+  def __init__(self):
+    self.value = None
+
+  def add(self, value) -> None:
+    if self.value is None or value > self.value:
+      self.value = value
+
+  def result(self):
+    return self.value
+
+
+# The running state of each aggregate function over one group
+_STATES = {'count': _Count, 'sum': _Sum, 'mean': _Mean, 'min': _Min, 'max': _Max}
+
+
+def aggregate_rows(rows: list, schema: list, group_by: Optional[list], aggregates: list) -> Tuple[list, list]:
+  '''
+  Group rows by the group_by columns and compute aggregates over each group.
+  Arguments:
+    rows: the rows of the table (already filtered)
+    schema: the schema of the table
+    group_by: list of column names to group by; an empty list or None gives one group
+    aggregates: list of aggregate specifications (see the module docstring)
+  Returns:
+    (result_schema, result_rows): result rows hold the group-by values followed by the
+    aggregates, in that order
+  Raises:
+    InvalidDataException if group_by or aggregates is invalid
+  '''
+  (group_indices, plans, result_schema) = _check_spec(schema, group_by, aggregates)
+  groups = {}
+  for row in rows:
+    group = tuple(row[i] for i in group_indices)
+    states = groups.get(group)
+    if states is None:
+      states = groups[group] = [_STATES[function]() for (function, column_index) in plans]
+    for (state, (function, column_index)) in zip(states, plans):
+      if column_index is None:
+        state.add(None)
+        continue
+      value = row[column_index]
+      if value is not None:
+        state.add(value)
+  if not groups and not group_indices:
+    # An aggregate over no rows is still one row (count 0), as in SQL
+    groups[()] = [_STATES[function]() for (function, column_index) in plans]
+  return (result_schema, [list(group) + [state.result() for state in states] for (group, states) in groups.items()])
@@ -1,23 +1,38 @@
 from flask import Flask
 import logging
 import os
-import sys
 import src.gdp_storage
-from src.config import  BUCKET_NAME, STORAGE_ENVIRONMENT, FLASK_SECRET_KEY, FLASK_JINJA_TEMPLATE_DIR, FLASK_STATIC_ASSET_DIR, FLASK_STATIC_URL, CONTAINER_NAME, AZURE_STORAGE_CONNECTION_STRING
+from src.config import STORAGE_ENVIRONMENT, FLASK_SECRET_KEY, FLASK_JINJA_TEMPLATE_DIR, FLASK_STATIC_ASSET_DIR, FLASK_STATIC_URL
+from src.config import LOCAL_CACHE_DIR, LOCAL_CACHE_MAX_BYTES
+from src.config import SIMULATED_STORAGE_LATENCY, SIMULATED_STORAGE_JITTER, SIMULATED_STORAGE_THROTTLE_RATE, SIMULATED_STORAGE_BANDWIDTH
 from src.gdp_table_manager import GDPTableManager
 from src.routes.sdtp_routes import sdtp_bp
 from src.routes.repo import repo_bp
 from src.routes.ui import ui_bp
 from src.routes.debug import debug_bp
+from src.routes.metrics import metrics_bp
+from src.routes.profiles import profiles_bp
+from src.metrics import init_request_metrics
+from src.profiling import init_request_profiling
 from src.auth_helpers import auth_bp
+from src.log_config import configure_logging
+
+logger = logging.getLogger(__name__)
 
 def _create_storage_manager():
-  if STORAGE_ENVIRONMENT == 'Google':
-    return src.gdp_storage.GDPGoogleStorageManager(BUCKET_NAME)
-  elif STORAGE_ENVIRONMENT == 'Azure':
-    return src.gdp_storage.GDPAzureStorageManager(CONTAINER_NAME, AZURE_STORAGE_CONNECTION_STRING)
-  else:
-    return  src.gdp_storage.InMemoryStorageManager()
+  # The backend (and its cloud SDK) is chosen and imported here; see STORAGE_BACKENDS
+  storage_manager = src.gdp_storage.create_backend_storage_manager(STORAGE_ENVIRONMENT)
+  if SIMULATED_STORAGE_LATENCY or SIMULATED_STORAGE_THROTTLE_RATE > 0 or SIMULATED_STORAGE_BANDWIDTH > 0:
+    storage_manager = src.gdp_storage.SimulatedLatencyStorageManager(
+      storage_manager,
+      latency=src.gdp_storage.parse_latency_spec(SIMULATED_STORAGE_LATENCY),
+      jitter=SIMULATED_STORAGE_JITTER,
+      throttle_rate=SIMULATED_STORAGE_THROTTLE_RATE,
+      bandwidth=SIMULATED_STORAGE_BANDWIDTH or None
+    )
+  if LOCAL_CACHE_DIR:
+    storage_manager = src.gdp_storage.LocalCacheStorageManager(storage_manager, LOCAL_CACHE_DIR, LOCAL_CACHE_MAX_BYTES)
+  return storage_manager
 
     
 def create_app():
@@ -29,29 +44,24 @@ def create_app():
   )
 
 
-  if app.logger.hasHandlers():
-    app.logger.handlers.clear()
-
-  handler = logging.StreamHandler(sys.stdout)
-  handler.setLevel(logging.DEBUG)
-  formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-  )
-  handler.setFormatter(formatter)
-  app.logger.addHandler(handler)
-  app.logger.setLevel(logging.DEBUG)
+  # app.logger (like every other logger) writes through the queue handler on the root
+  # logger; see log_config.py
+  configure_logging()
+  app.logger.handlers.clear()
+  app.logger.setLevel(logging.NOTSET)
   app.table_manager = GDPTableManager(_create_storage_manager())  # type: ignore[attr-defined]
   app.register_blueprint(sdtp_bp)
   app.register_blueprint(repo_bp)
   app.register_blueprint(ui_bp)
   app.register_blueprint(auth_bp)
+  app.register_blueprint(metrics_bp)
+  app.register_blueprint(profiles_bp)
+  init_request_metrics(app)
+  init_request_profiling(app)
   app.config['GDP_BASE_URL'] = os.environ.get('GDP_BASE_URL', 'http://localhost:5000/services/gdp')
   app.config['GDP_AUTH_TOKEN_VAR'] = os.environ.get('GDP_AUTH_TOKEN_VAR', 'JUPYTER_HUB_TOKEN')
 
-  print("STATIC:", FLASK_STATIC_ASSET_DIR)
-  print("TEMPLATE:", FLASK_JINJA_TEMPLATE_DIR)
-  print("App static_folder:", app.static_folder)
-  print("App template_folder:", app.template_folder)
+  logger.debug('static folder %s, template folder %s', app.static_folder, app.template_folder)
 
 
   app.secret_key = FLASK_SECRET_KEY
@@ -60,5 +70,6 @@ def create_app():
   return app
 
 if __name__ == '__main__':
+  # Development server only; production runs under gunicorn (see src/gunicorn_conf.py)
   app = create_app()
-  app.run('0.0.0.0', port=5000, debug = True)
\ No newline at end of file
+  app.run('0.0.0.0', port=5000, debug = True)
@@ -3,19 +3,26 @@ auth_helpers.py -- All authentication logic, decorators, and helper functions fo
 No routes are declared here! Import authenticated and helpers into blueprints as needed.
 """
 
+import logging
 import os
 import re
+import hashlib
 import requests
-import user_agents
 from urllib.parse import urlparse
-from functools import wraps
-from flask import request, make_response, session, redirect, Blueprint
+from functools import wraps, lru_cache
+from flask import request, make_response, session, redirect, Blueprint, g
 from src.config import HUB_API_URL, HUB_URL, OAUTH_CALLBACK_URL, SERVICE_API_TOKEN, GDP_CLIENT_ID
-from jupyterhub.services.auth import HubOAuth, HubAuth
+from src.config import TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL, TOKEN_CACHE_NEGATIVE_TTL
+from src.config import HUB_POOL_SIZE, HUB_CONNECT_TIMEOUT, HUB_READ_TIMEOUT, HUB_RETRIES, HUB_RETRY_BACKOFF
+from src.hub_client import HubClient
+from src.metrics import METRICS
+from src.profiling import start_request_profile
+from src.ttl_cache import TTLCache
+from src.single_flight import SingleFlight
 auth_bp = Blueprint('auth', __name__)
 
-print(f"[DEBUG] HUB_URL: {HUB_URL}")
-print(f"[DEBUG] OAUTH_CALLBACK_URL: {OAUTH_CALLBACK_URL}")
+logger = logging.getLogger(__name__)
+logger.debug('HUB_URL: %s, OAUTH_CALLBACK_URL: %s', HUB_URL, OAUTH_CALLBACK_URL)
 
 # def _sanitize_callback():
 #   if HUB_URL.endswith('/') and OAUTH_CALLBACK_URL.startswith('/'):
@@ -43,24 +50,43 @@ if OAUTH_CALLBACK_URL.startswith('http://') or OAUTH_CALLBACK_URL.startswith('ht
 else:
   CALLBACK_URI = f"{HUB_URL.rstrip('/')}/{OAUTH_CALLBACK_URL.lstrip('/')}"
 
-print(f"[DEBUG] CALLBACK_URI: {CALLBACK_URI}")
-
-
-auth = HubOAuth(
-  api_url=HUB_API_URL,
-  api_token=SERVICE_API_TOKEN,
-  oauth_client_id=GDP_CLIENT_ID,
-  oauth_redirect_uri=CALLBACK_URI,
-  cache_max_age=60
-)
-print(f"[DEBUG] auth.oauth_redirect_uri: {auth.oauth_redirect_uri}")
-
-token_auth = HubAuth(
-  api_url=HUB_API_URL,
-  api_token=SERVICE_API_TOKEN
-)
+logger.debug('CALLBACK_URI: %s', CALLBACK_URI)
+
+
+# jupyterhub is slow to import, and only needed once a request needs the hub, so the
+# hub auth clients are built on first use.  `auth` and `token_auth` are still importable
+# from this module (see __getattr__).
+@lru_cache(maxsize=None)
+def _hub_oauth():
+  from jupyterhub.services.auth import HubOAuth
+  auth = HubOAuth(
+    api_url=HUB_API_URL,
+    api_token=SERVICE_API_TOKEN,
+    oauth_client_id=GDP_CLIENT_ID,
+    oauth_redirect_uri=CALLBACK_URI,
+    cache_max_age=60
+  )
+  logger.debug('auth.oauth_redirect_uri: %s', auth.oauth_redirect_uri)
+  return auth
+
+@lru_cache(maxsize=None)
+def _hub_auth():
+  from jupyterhub.services.auth import HubAuth
+  return HubAuth(
+    api_url=HUB_API_URL,
+    api_token=SERVICE_API_TOKEN
+  )
+
+def __getattr__(name):
+  if name == 'auth':
+    return _hub_oauth()
+  if name == 'token_auth':
+    return _hub_auth()
+  raise AttributeError(f'module {__name__} has no attribute {name}')
 
 def is_browser(user_agent):
+  # user_agents loads a large table of regexes on import, so it is imported on first use
+  import user_agents
   ua = user_agents.parse(user_agent)
   return ua.is_pc or ua.is_mobile or ua.is_tablet
 
@@ -91,33 +117,84 @@ def oauth_callback():
     return "Forbidden", 403
 
   arg_state = request.args.get('state', None)
-  cookie_state = request.cookies.get(auth.state_cookie_name)
+  cookie_state = request.cookies.get(_hub_oauth().state_cookie_name)
   if arg_state is None or arg_state != cookie_state:
     return "Forbidden", 403
 
   try:
-    token = auth.token_for_code(code)
+    token = _hub_oauth().token_for_code(code)
   except Exception as e:
     return f"Token exchange failed: {e}", 400
 
   session["token"] = token
-  next_url = auth.get_next_url(cookie_state) or "/services/gdp/"
+  next_url = _hub_oauth().get_next_url(cookie_state) or "/services/gdp/"
   response = make_response(redirect(next_url))
   return response
 
 
+# All hub API calls share this connection pool
+hub_client = HubClient(
+  HUB_API_URL,
+  pool_size=HUB_POOL_SIZE,
+  connect_timeout=HUB_CONNECT_TIMEOUT,
+  read_timeout=HUB_READ_TIMEOUT,
+  retries=HUB_RETRIES,
+  backoff=HUB_RETRY_BACKOFF
+)
+
+# token hash -> user structure, or None for a token the hub rejected.  Only a hash
+# of the token is kept in memory
+_token_cache = TTLCache(max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+_token_lookups = SingleFlight()
+
+# Hub responses which say the token itself is bad, and so can be cached
+_REJECTED_TOKEN_STATUSES = {401, 403, 404}
+
 def _list_users():
-  headers = {'Authorization': f'token {SERVICE_API_TOKEN}'}
-  result = requests.get(f'{HUB_API_URL}/users', headers=headers)
+  result = hub_client.get('users', SERVICE_API_TOKEN)
   return result.json()
 
-def get_user_from_token(user_token):
-  headers = {"Authorization": f"token {user_token}"}
-  response = requests.get(f"{HUB_API_URL}/user", headers=headers)
+_hub_requests = METRICS.add_counter('gdp_hub_requests_total', 'Requests made to the hub API')
+_hub_errors = METRICS.add_counter('gdp_hub_errors_total', 'Hub API requests that failed or returned 5xx')
+_hub_seconds = METRICS.add_counter('gdp_hub_request_seconds_total', 'Time spent in hub API requests')
+
+def _hub_client_metrics():
+  stats = hub_client.stats()
+  _hub_requests.set((), stats['requests'])
+  _hub_errors.set((), stats['errors'])
+  _hub_seconds.set((), stats['seconds'])
+
+METRICS.register_collector(_hub_client_metrics)
+
+def _token_hash(user_token):
+  return hashlib.sha256(user_token.encode('utf-8')).hexdigest()
+
+def _fetch_user_from_token(user_token, token_hash):
+  try:
+    response = hub_client.get('user', user_token)
+  except requests.RequestException:
+    return None
   if response.status_code == 200:
-    return response.json()
+    user = response.json()
+    _token_cache.put(token_hash, user)
+    return user
+  if response.status_code in _REJECTED_TOKEN_STATUSES:
+    _token_cache.put(token_hash, None, ttl=TOKEN_CACHE_NEGATIVE_TTL)
   return None
 
+def get_user_from_token(user_token):
+  '''
+  Return the hub user structure for user_token, or None if the hub rejects it.
+  Results (including rejections) are cached by token hash, and concurrent
+  lookups of the same token share one hub request.
+  '''
+  token_hash = _token_hash(user_token)
+  (hit, user) = _token_cache.lookup(token_hash)
+  METRICS.count_cache('token', hit)
+  if hit:
+    return user
+  return _token_lookups.do(token_hash, lambda: _fetch_user_from_token(user_token, token_hash))
+
 class DebugUser:
   def __init__(self):
     self.debug_user_name = os.getenv("DEBUG_GDP_USER", "debug_user")
@@ -150,41 +227,54 @@ def _is_request_from_hub_proxy():
   hub_host = urlparse(HUB_URL).netloc
   return forwarded_host == hub_host
 
+def _recording_user(f):
+  # Record the authenticated user in g for the request hooks, and start profiling the
+  # request if it asks and the user may (see profiling.py)
+  @wraps(f)
+  def with_user(user, *args, **kwargs):
+    g.current_user = user
+    start_request_profile(user)
+    return f(user, *args, **kwargs)
+  return with_user
+
 def authenticated(f):
+  view = _recording_user(f)
   @wraps(f)
   def decorated(*args, **kwargs):
     if "JupyterHub-User" in request.headers:
       username = request.headers.get("JupyterHub-User")
-      return f({"name": username}, *args, **kwargs)
+      return view({"name": username}, *args, **kwargs)
     if _is_request_from_hub_proxy():
       user_from_path = _get_user_from_forwarded_path()
       if user_from_path:
-        return f({"name": user_from_path}, *args, **kwargs)
+        return view({"name": user_from_path}, *args, **kwargs)
     if DEBUG:
       if "Debug-User" in request.headers:
         DEBUG_USER.set_user(request.headers.get("Debug-User"))
-      return f(DEBUG_USER.get_user_structure(), *args, **kwargs)
+      return view(DEBUG_USER.get_user_structure(), *args, **kwargs)
     if "Authorization" in request.headers:
       auth_header = request.headers.get("Authorization")
       auth_header = auth_header.strip() if auth_header is not None else ''
       if auth_header.startswith("token "):
         user_token = _get_bearer_token(auth_header)
-        user = get_user_from_token(user_token)
+        with METRICS.stage('auth'):
+          user = get_user_from_token(user_token)
         if user:
-          return f(user, *args, **kwargs)
+          return view(user, *args, **kwargs)
     token = session.get("token")
-    user = auth.user_for_token(token) if token else None
+    with METRICS.stage('auth'):
+      user = _hub_oauth().user_for_token(token) if token else None
     if user:
-      return f(user, *args, **kwargs)
+      return view(user, *args, **kwargs)
     elif oauth_ok():
+      auth = _hub_oauth()
       state = auth.generate_state(next_url=request.path)
-      print(f"[DEBUG] auth.login_url: {auth.login_url}")
-      print(f"[DEBUG] state: {state}")
+      logger.debug('Redirecting to %s, state %s', auth.login_url, state)
       response = make_response(redirect(auth.login_url + f'&state={state}'))
       response.set_cookie(auth.state_cookie_name, state)
       return response
     else:
-      return f({}, *args, **kwargs)
+      return view({}, *args, **kwargs)
   return decorated
 
 def _get_email(user):
@@ -0,0 +1,147 @@
+'''
+change_journal.py -- A journal of table changes, shared by the replicas of the GDP
+through the storage backend itself.
+
+Each change to a table (publish, update, delete, access change) is recorded as a small
+object under JOURNAL_PREFIX, named <time_ns>-<random>.json and holding {"key", "op"}.
+Each process polls the journal from a background thread every poll_interval seconds
+and calls on_change(key, op) for each entry it hasn't seen, so it can evict exactly
+the cached state of the tables that changed.  A poll costs one listing of the journal
+plus one read per new entry.  Entries older than retention seconds are deleted.
+
+Entries are tracked by name rather than by a time watermark, so clock skew between
+replicas can't make one of them miss an entry.  A process skips the entries it wrote.
+
+While polls keep succeeding, trusted() is true, and a process may serve its caches
+without revalidating them against storage.  If polling stops (storage errors, a stalled
+thread) trusted() turns false and callers go back to revalidating.  The first poll in a
+process, and a poll after a gap longer than the retention (entries may have been
+deleted unseen), call on_reset() instead, so that everything cached before it is
+revalidated once.
+'''
+import os
+import threading
+import time
+import uuid
+from json import dumps, loads
+from typing import Callable, Optional
+
+JOURNAL_PREFIX = '.gdp/journal/'
+
+
+def _entry_time(name: str) -> int:
+  # The time_ns a journal entry was written, from its name
+  try:
+    return int(name[len(JOURNAL_PREFIX):].split('-', 1)[0])
+  except ValueError:
+    return 0
+
+
+class ChangeJournal:
+  '''
+  Records table changes to storage, and polls for the changes made by other processes.
+  Arguments:
+    storage_manager: the GDPStorageManager shared by the replicas
+    on_change: function(key, op) called for each change made elsewhere
+    on_reset: function() called when changes may have been missed
+    poll_interval: seconds between polls; 0 turns the journal off
+    retention: seconds an entry is kept
+  '''
+  def __init__(self, storage_manager, on_change: Callable[[str, str], None], on_reset: Callable[[], None],
+               poll_interval: float, retention: float):
+    self.storage_manager = storage_manager
+    self.poll_interval = poll_interval
+    self.retention = retention
+    self._on_change = on_change
+    self._on_reset = on_reset
+    self._lock = threading.Lock()
+    self._poll_lock = threading.Lock()
+    self._seen = set()
+    self._last_poll: Optional[float] = None
+    self._pid: Optional[int] = None
+    self._stopped = threading.Event()
+
+  @property
+  def enabled(self) -> bool:
+    return self.poll_interval > 0
+
+  def record(self, key: str, op: str) -> None:
+    '''
+    Record a change to the table at key.  op is one of publish, update, compact, delete, access.
+    '''
+    if not self.enabled:
+      return
+    name = f'{JOURNAL_PREFIX}{time.time_ns():020d}-{uuid.uuid4().hex}.json'
+    with self._lock:
+      self._seen.add(name)
+    self.storage_manager.put_object(name, dumps({'key': key, 'op': op}))
+
+  def start(self) -> None:
+    '''
+    Start polling in this process if it hasn't started yet.  Cheap enough to call on
+    every request; a forked worker starts its own poller.
+    '''
+    pid = os.getpid()
+    if not self.enabled or self._pid == pid:
+      return
+    with self._lock:
+      if self._pid == pid:
+        return
+      self._pid = pid
+      self._last_poll = None
+    threading.Thread(target=self._run, args=(pid,), daemon=True).start()
+
+  def stop(self) -> None:
+    self._stopped.set()
+
+  def _run(self, pid: int) -> None:
+    while self._pid == pid:
+      try:
+        self.poll()
+      except Exception:
+        # trusted() lapses if polls keep failing
+        pass
+      if self._stopped.wait(self.poll_interval):
+        return
+
+  def trusted(self) -> bool:
+    '''
+    True iff this process has polled the journal recently, so its caches are current to
+    within about poll_interval
+    '''
+    with self._lock:
+      last_poll = self._last_poll if self._pid == os.getpid() else None
+    return last_poll is not None and time.monotonic() - last_poll <= 3 * self.poll_interval
+
+  def poll(self) -> int:
+    '''
+    Apply the entries not seen yet, and delete the expired ones.
+    Returns:
+      The number of changes passed to on_change
+    '''
+    with self._poll_lock:
+      now = time.monotonic()
+      names = sorted(self.storage_manager.all_keys_matching(prefix=JOURNAL_PREFIX))
+      with self._lock:
+        new = [name for name in names if name not in self._seen]
+        reset = self._last_poll is None or now - self._last_poll > self.retention
+      applied = 0
+      if reset:
+        self._on_reset()
+      for name in new:
+        if not reset:
+          entry = self.storage_manager.get_object(name)
+          if entry is not None:
+            entry = loads(entry) if isinstance(entry, str) else entry
+            self._on_change(entry['key'], entry['op'])
+            applied += 1
+        with self._lock:
+          self._seen.add(name)
+      cutoff = time.time_ns() - int(self.retention * 1e9)
+      for name in names:
+        if _entry_time(name) < cutoff:
+          self.storage_manager.delete_object(name)
+      with self._lock:
+        self._seen = {name for name in self._seen if _entry_time(name) >= cutoff}
+        self._last_poll = now
+      return applied
@@ -0,0 +1,90 @@
+'''
+columnar_table.py -- A table whose columns are loaded from storage one at a time, on
+first use.
+
+Wide tables are stored twice: as the usual SDML object, and as one object per column
+(see GDPTableManager).  A ColumnarTable is built from the schema and row count alone;
+each SDTP query then loads only the columns it touches (the requested columns plus the
+columns named in the filter), and keeps them for later queries.
+'''
+from typing import Any, Callable, List
+from sdtp import SDMLFixedTable, InvalidDataException
+from sdtp.sdtp_filter import make_filter, ColumnFilter, CompoundFilter
+from sdtp.sdtp_table import _convert_filter_result_to_format, ALLOWED_FILTERED_ROW_RESULT_FORMATS, DEFAULT_FILTERED_ROW_RESULT_FORMAT
+from src.single_flight import SingleFlight
+
+
+def filter_columns(filter) -> set:
+  '''
+  The names of the columns a filter reads
+  '''
+  if isinstance(filter, ColumnFilter):
+    return {filter.column}
+  if isinstance(filter, CompoundFilter):
+    return set().union(*[filter_columns(argument) for argument in filter.arguments])
+  return set()
+
+
+class ColumnarTable(SDMLFixedTable):
+  '''
+  An SDMLFixedTable which loads its columns lazily.
+  Arguments:
+    schema: the schema of the table
+    row_count: the number of rows
+    load_column: function(index) returning the values of column index, converted to the column's type
+  '''
+  def __init__(self, schema: list, row_count: int, load_column: Callable[[int], List]):
+    super(ColumnarTable, self).__init__(schema, self._get_rows)
+    self.row_count = row_count
+    self._load_column = load_column
+    self._columns = {}
+    self._loads = SingleFlight()
+
+  def column(self, column_name: str) -> list:
+    '''
+    The values of column_name, loading them if this is the first use.  The list is
+    shared; callers must not modify it.
+    '''
+    try:
+      index = self.column_names().index(column_name)
+    except ValueError as original_error:
+      raise InvalidDataException(f'{column_name} is not a column of this table') from original_error
+    values = self._columns.get(index)
+    if values is None:
+      values = self._loads.do(index, lambda: self._columns.setdefault(index, self._load_column(index)))
+    return values
+
+  def loaded_columns(self) -> List[str]:
+    names = self.column_names()
+    return [names[index] for index in sorted(self._columns.keys())]
+
+  def _get_column_values_and_type(self, column_name: str):
+    values = self.column(column_name)
+    return (list(values), self.get_column_type(column_name))
+
+  def _rows_of(self, column_names: List[str]) -> list:
+    columns = [self.column(name) for name in column_names]
+    return [list(row) for row in zip(*columns)]
+
+  def _get_rows(self):
+    return self._rows_of(self.column_names())
+
+  # The base is unannotated, and abstract in SDMLTable (so its return type is inferred as
+  # NoReturn); like it, this returns rows in any of the result formats
+  def get_filtered_rows(self, filter_spec=None, columns=None, format = DEFAULT_FILTERED_ROW_RESULT_FORMAT) -> Any:
+    '''
+    As SDMLTable.get_filtered_rows, but reads only the requested columns and the columns
+    the filter tests.
+    '''
+    if format is None: format = DEFAULT_FILTERED_ROW_RESULT_FORMAT
+    if format not in ALLOWED_FILTERED_ROW_RESULT_FORMATS:
+      raise InvalidDataException(f'format for get_filtered rows must be one of {ALLOWED_FILTERED_ROW_RESULT_FORMATS}, not {format}')
+    requested_columns = columns if columns else self.column_names()
+    filter = make_filter(filter_spec) if filter_spec is not None else None
+    needed = set(requested_columns) | (filter_columns(filter) if filter is not None else set())
+    names = [name for name in self.column_names() if name in needed]
+    rows = self._rows_of(names)
+    if filter is not None:
+      rows = [row for row in rows if filter.matches(row, names)]
+    projected_schema = [entry for entry in self.schema if entry['name'] in needed]
+    return _convert_filter_result_to_format(rows, requested_columns, projected_schema, format)
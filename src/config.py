@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 HUB_API_URL = os.environ.get('JUPYTERHUB_API_URL',' ')
 SERVICE_API_TOKEN = os.environ.get('GDP_SERVICE_API_TOKEN','foo')
@@ -23,3 +24,129 @@ FLASK_SECRET_KEY = os.environ.get('FLASK_SECRET_KEY', 'super-secret-key')
 FLASK_STATIC_ASSET_DIR = os.environ.get("FLASK_STATIC_ASSET_DIR", "../static")
 FLASK_JINJA_TEMPLATE_DIR = os.environ.get("FLASK_JINJA_TEMPLATE_DIR", "../templates")
 FLASK_STATIC_URL = os.environ.get("FLASK_STATIC_URL", "/static")
+
+#--- Production server (gunicorn) settings ----
+GDP_BIND = os.environ.get('GDP_BIND', '0.0.0.0:5000')
+GDP_WORKERS = int(os.environ.get('GDP_WORKERS', '2'))
+GDP_THREADS = int(os.environ.get('GDP_THREADS', '8'))
+GDP_WORKER_TIMEOUT = int(os.environ.get('GDP_WORKER_TIMEOUT', '120'))
+GDP_GRACEFUL_TIMEOUT = int(os.environ.get('GDP_GRACEFUL_TIMEOUT', '60'))
+GDP_KEEPALIVE = int(os.environ.get('GDP_KEEPALIVE', '5'))
+GDP_MAX_REQUESTS = int(os.environ.get('GDP_MAX_REQUESTS', '5000'))
+GDP_MAX_REQUESTS_JITTER = int(os.environ.get('GDP_MAX_REQUESTS_JITTER', '500'))
+GDP_PRELOAD_APP = os.environ.get('GDP_PRELOAD_APP', 'true') == 'true'
+
+#--- Hub token cache ----
+TOKEN_CACHE_SIZE = int(os.environ.get('GDP_TOKEN_CACHE_SIZE', '4096'))
+TOKEN_CACHE_TTL = float(os.environ.get('GDP_TOKEN_CACHE_TTL', '60'))
+TOKEN_CACHE_NEGATIVE_TTL = float(os.environ.get('GDP_TOKEN_CACHE_NEGATIVE_TTL', '10'))
+
+#--- Hub API connection pool ----
+HUB_POOL_SIZE = int(os.environ.get('GDP_HUB_POOL_SIZE', '20'))
+HUB_CONNECT_TIMEOUT = float(os.environ.get('GDP_HUB_CONNECT_TIMEOUT', '3.05'))
+HUB_READ_TIMEOUT = float(os.environ.get('GDP_HUB_READ_TIMEOUT', '10'))
+HUB_RETRIES = int(os.environ.get('GDP_HUB_RETRIES', '2'))
+HUB_RETRY_BACKOFF = float(os.environ.get('GDP_HUB_RETRY_BACKOFF', '0.1'))
+
+#--- Instrumentation ----
+METRICS_ENABLED = os.environ.get('GDP_METRICS', 'true') == 'true'
+# Directory through which the gunicorn workers share their metrics, so /metrics reports
+# the whole server.  gunicorn_conf.py makes a temporary one if this isn't set.
+METRICS_DIR = os.environ.get('GDP_METRICS_DIR', '')
+# Seconds between the snapshots each worker writes there
+METRICS_SHARE_INTERVAL = float(os.environ.get('GDP_METRICS_SHARE_INTERVAL', '1'))
+
+#--- Simulated storage latency, for local load testing ----
+# e.g. "get_object=40,get_meta=8,key_exists=8,list=60" (milliseconds), or a single number for every operation
+SIMULATED_STORAGE_LATENCY = os.environ.get('GDP_SIMULATED_STORAGE_LATENCY', '')
+SIMULATED_STORAGE_JITTER = float(os.environ.get('GDP_SIMULATED_STORAGE_JITTER', '0'))
+SIMULATED_STORAGE_THROTTLE_RATE = float(os.environ.get('GDP_SIMULATED_STORAGE_THROTTLE_RATE', '0'))
+SIMULATED_STORAGE_BANDWIDTH = float(os.environ.get('GDP_SIMULATED_STORAGE_BANDWIDTH', '0'))
+
+#--- Local filesystem storage (STORAGE_ENVIRONMENT=Local) ----
+LOCAL_STORAGE_DIR = os.environ.get('GDP_LOCAL_STORAGE_DIR', './gdp-data')
+LOCAL_STORAGE_DURABLE = os.environ.get('GDP_LOCAL_STORAGE_DURABLE', 'true') == 'true'
+
+#--- Local disk read-through cache in front of the storage backend ----
+LOCAL_CACHE_DIR = os.environ.get('GDP_LOCAL_CACHE_DIR', '')
+LOCAL_CACHE_MAX_BYTES = int(os.environ.get('GDP_LOCAL_CACHE_MAX_BYTES', str(1 << 30)))
+
+#--- Incremental table updates ----
+# A table is compacted (rewritten with all its rows) once it has this many appended segments
+COMPACT_SEGMENTS = int(os.environ.get('GDP_COMPACT_SEGMENTS', '32'))
+# Updates to a table (from any worker or replica) take a lease on it in storage.  A
+# lease not released after GDP_TABLE_LEASE_TTL seconds (its holder died) can be taken
+# over; a writer waits up to GDP_TABLE_LEASE_WAIT seconds for it before giving up.
+TABLE_LEASE_TTL = float(os.environ.get('GDP_TABLE_LEASE_TTL', '30'))
+TABLE_LEASE_WAIT = float(os.environ.get('GDP_TABLE_LEASE_WAIT', '10'))
+
+#--- Secondary indexes ----
+# A column is indexed automatically once this many filters on it have scanned a table
+# of at least GDP_INDEX_MIN_ROWS rows.  0 turns automatic indexing off.
+INDEX_HOT_QUERIES = int(os.environ.get('GDP_INDEX_HOT_QUERIES', '3'))
+INDEX_MIN_ROWS = int(os.environ.get('GDP_INDEX_MIN_ROWS', '10000'))
+
+#--- SDTP batch requests ----
+BATCH_MAX_QUERIES = int(os.environ.get('GDP_BATCH_MAX_QUERIES', '100'))
+
+#--- Column storage ----
+# RowTables with at least this many columns are also stored one object per column,
+# and loaded a column at a time.  The column objects of a replaced version are kept for
+# GDP_JOURNAL_RETENTION seconds, so replicas still serving it can finish reading it.
+COLUMNAR_MIN_COLUMNS = int(os.environ.get('GDP_COLUMNAR_MIN_COLUMNS', '32'))
+
+#--- Table previews ----
+# Rows kept at each end of a table in its preview (the table detail page shows head and tail)
+PREVIEW_ROWS = int(os.environ.get('GDP_PREVIEW_ROWS', '5'))
+
+#--- Downloads ----
+# Bytes read from storage per chunk of a streamed download
+DOWNLOAD_CHUNK_BYTES = int(os.environ.get('GDP_DOWNLOAD_CHUNK_BYTES', str(1 << 20)))
+
+#--- Cross-replica change journal ----
+# Seconds between polls of the change journal.  While polling keeps succeeding, cached
+# tables are served without checking storage on each request.  0 turns the journal off
+# (every request then revalidates its table's etag).
+JOURNAL_POLL_INTERVAL = float(os.environ.get('GDP_JOURNAL_POLL_INTERVAL', '2'))
+# Seconds a journal entry is kept before it is deleted
+JOURNAL_RETENTION = float(os.environ.get('GDP_JOURNAL_RETENTION', '600'))
+
+#--- Table cache freshness ----
+# Seconds a cached table is served without checking its etag when the change journal
+# isn't being polled.  0 checks on every request.
+TABLE_CACHE_TTL = float(os.environ.get('GDP_TABLE_CACHE_TTL', '0'))
+# Stale-while-revalidate: for up to this many seconds after a table is found to have
+# changed, requests are served the cached version while it is reloaded in the
+# background.  0 turns this off (the request which notices the change reloads it).
+TABLE_CACHE_STALE = float(os.environ.get('GDP_TABLE_CACHE_STALE', '0'))
+# Refresh-ahead: a table served at least this many times since it was last checked is
+# rechecked in the background once GDP_TABLE_CACHE_REFRESH_AHEAD of its TTL has passed,
+# and (with stale-while-revalidate on) reloaded as soon as the journal reports a change
+REFRESH_AHEAD_HITS = int(os.environ.get('GDP_REFRESH_AHEAD_HITS', '10'))
+REFRESH_AHEAD = float(os.environ.get('GDP_TABLE_CACHE_REFRESH_AHEAD', '0.8'))
+
+#--- Negative caching ----
+# Seconds a table or permission record found missing is remembered as missing.  Local
+# writes (and, through the change journal, writes on other replicas) forget it at once.
+NEGATIVE_CACHE_TTL = float(os.environ.get('GDP_NEGATIVE_CACHE_TTL', '5'))
+NEGATIVE_CACHE_SIZE = int(os.environ.get('GDP_NEGATIVE_CACHE_SIZE', '16384'))
+
+#--- SDTP request coalescing ----
+# Identical SDTP queries in flight at the same time share one computation and response body
+COALESCE_QUERIES = os.environ.get('GDP_COALESCE_QUERIES', 'true') == 'true'
+
+#--- On-demand request profiling ----
+# Requests with "X-GDP-Profile: sample|cprofile" (or ?gdp_profile=...) are profiled for
+# admins (hub admins and the users listed here), or for anyone when DEBUG_GDP is set
+DEBUG_GDP = os.environ.get('DEBUG_GDP', 'false') == 'true'
+PROFILING_ENABLED = os.environ.get('GDP_PROFILING', 'true') == 'true'
+PROFILE_ADMINS = [name.strip() for name in os.environ.get('GDP_PROFILE_ADMINS', '').split(',') if name.strip()]
+PROFILE_DIR = os.environ.get('GDP_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'gdp-profiles'))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('GDP_PROFILE_SAMPLE_INTERVAL', '0.005'))
+
+#--- Logging ----
+# Level of the root logger, and per-logger levels, e.g. "src.routes.repo=DEBUG,werkzeug=WARNING"
+LOG_LEVEL = os.environ.get('GDP_LOG_LEVEL', 'DEBUG' if DEBUG_GDP else 'INFO')
+LOG_LEVELS = os.environ.get('GDP_LOG_LEVELS', '')
+# "text", or "json" for one JSON object per line
+LOG_FORMAT = os.environ.get('GDP_LOG_FORMAT', 'text')
@@ -0,0 +1,118 @@
+'''
+downloads.py -- Streamed table downloads.
+
+A table whose stored object is exactly what the client should receive is streamed
+straight from storage in chunks, with HTTP Range support (a single byte range,
+"bytes=a-b", "bytes=a-" or "bytes=-n", and If-Range) so interrupted downloads can
+resume.  A table which has to be serialized (for example one with appended rows not
+yet compacted into its stored object) is streamed through stream_table_json, a few
+rows at a time, rather than built as one string.
+'''
+import json
+from typing import Iterator, Optional, Tuple
+from flask import Response, request
+from sdtp import json_serialize, jsonifiable_rows, RowTable
+from src.config import DOWNLOAD_CHUNK_BYTES
+
+ROWS_PER_CHUNK = 1000
+
+
+class RangeNotSatisfiable(Exception):
+  '''
+  Raised when a Range header asks for bytes outside the object
+  '''
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+  '''
+  Parse an HTTP Range header against an object of size bytes.
+  Returns:
+    (start, end) with end exclusive, or None if the whole object should be sent (no
+    header, a header this server doesn't handle, or several ranges)
+  Raises:
+    RangeNotSatisfiable if the range lies outside the object
+  '''
+  if not header or not header.startswith('bytes=') or ',' in header:
+    return None
+  (first, dash, last) = header[len('bytes='):].strip().partition('-')
+  if not dash:
+    return None
+  try:
+    if first == '':
+      suffix = int(last)
+      if suffix <= 0:
+        raise RangeNotSatisfiable(header)
+      return (max(0, size - suffix), size)
+    start = int(first)
+    end = size if last == '' else min(size, int(last) + 1)
+  except ValueError:
+    return None
+  if start >= size or end <= start:
+    raise RangeNotSatisfiable(header)
+  return (start, end)
+
+
+def _headers(filename: Optional[str], etag: Optional[str]) -> dict:
+  headers = {}
+  if filename is not None:
+    headers['Content-Disposition'] = f'attachment; filename={filename}'
+  if etag:
+    headers['ETag'] = f'"{etag}"'
+  return headers
+
+
+def stored_object_response(storage_manager, key: str, meta, filename: Optional[str] = None) -> Response:
+  '''
+  Stream the object stored at key, honouring Range and If-Range.
+  Arguments:
+    storage_manager: the GDPStorageManager holding the object
+    key: the key of the object
+    meta: its ObjectMeta (for the size and etag, and the version sent)
+    filename: if given, the response is an attachment with this name
+  '''
+  headers = _headers(filename, meta.etag)
+  headers['Accept-Ranges'] = 'bytes'
+  size = meta.size
+  if_range = request.headers.get('If-Range')
+  try:
+    byte_range = parse_range(request.headers.get('Range'), size)
+  except RangeNotSatisfiable:
+    headers['Content-Range'] = f'bytes */{size}'
+    return Response(status=416, headers=headers)
+  if byte_range is not None and if_range is not None and if_range.strip('"') != meta.etag:
+    # The object has changed since the client's partial download: send all of it
+    byte_range = None
+  (start, end) = byte_range if byte_range is not None else (0, size)
+  headers['Content-Length'] = str(end - start)
+  status = 200
+  if byte_range is not None:
+    status = 206
+    headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+  # Pinned to meta's version: if the table is republished mid-download, the body stops
+  # short of Content-Length rather than mixing in the new version's bytes
+  chunks = storage_manager.iter_range(key, start, end, DOWNLOAD_CHUNK_BYTES, expected=meta)
+  return Response(chunks, status=status, headers=headers, mimetype='application/json', direct_passthrough=True)
+
+
+def stream_table_json(table, rows_per_chunk: int = ROWS_PER_CHUNK) -> Iterator[str]:
+  '''
+  Yield the JSON form of table.to_dictionary() in pieces, a few rows at a time
+  '''
+  if not isinstance(table, RowTable):
+    yield json.dumps(table.to_dictionary(), default=json_serialize)
+    return
+  types = table.column_types()
+  yield '{"type": "RowTable", "schema": ' + json.dumps(table.schema) + ', "rows": ['
+  rows = table.rows
+  for start in range(0, len(rows), rows_per_chunk):
+    chunk = jsonifiable_rows(rows[start:start + rows_per_chunk], types)
+    body = ', '.join(json.dumps(row, default=json_serialize) for row in chunk)
+    yield body if start == 0 else ', ' + body
+  yield ']}'
+
+
+def table_stream_response(table, filename: Optional[str] = None) -> Response:
+  '''
+  Stream the serialized form of an in-memory table.  Ranges aren't supported.
+  '''
+  return Response(stream_table_json(table), headers=_headers(filename, None), mimetype='application/json')
@@ -1,13 +1,24 @@
-from typing import Any, Optional, List, Dict
-import sys
+from typing import Any, Callable, Optional, List, Dict, Iterator
+import os
+import hashlib
+import mmap
+import tempfile
+import random
+import threading
+import time
+import importlib
 from uuid import uuid4
-from google.cloud import storage
 import json
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from src.metrics import METRICS
 
-from typing import Optional
 from datetime import datetime
 
+# Makes GDPStorageManager.put_object_if_match atomic within a process
+_conditional_write_lock = threading.Lock()
+
 class ObjectMeta:
     def __init__(
         self,
@@ -63,9 +74,9 @@ class GDPStorageManager(ABC):
     raise NotImplementedError()
   
   @abstractmethod
-  def put_object(self, key: str, object_data: Dict) -> None:
+  def put_object(self, key: str, object_data: Any) -> None:
     '''
-    Stores the given object_data  as JSON under key.
+    Stores the given object_data (a dict, stored as JSON, or a string) under key.
     '''
     raise NotImplementedError()
   
@@ -75,6 +86,35 @@ class GDPStorageManager(ABC):
     Deletes  the object stored under  key.
     '''
     raise NotImplementedError()
+
+  def put_object_if_match(self, key: str, object_data: Any, expected: Optional[ObjectMeta]) -> Optional[ObjectMeta]:
+    '''
+    Stores object_data under key only if the object there is still the one expected
+    describes (or, if expected is None, only if there is no object at key).
+    Returns the ObjectMeta of the stored object, or None if the precondition failed.
+    This default is only atomic within one process: every backend which may be shared
+    by several processes must override it with a write the store itself makes
+    conditional.
+    '''
+    with _conditional_write_lock:
+      current = self.get_meta(key)
+      if (current.etag if current is not None else None) != (expected.etag if expected is not None else None):
+        return None
+      self.put_object(key, object_data)
+      return self.get_meta(key)
+
+  def delete_object_if_match(self, key: str, expected: ObjectMeta) -> bool:
+    '''
+    Deletes the object at key only if it is still the one expected describes.
+    Returns True iff it was deleted.  As with put_object_if_match, this default is only
+    atomic within one process, and shared backends must override it.
+    '''
+    with _conditional_write_lock:
+      current = self.get_meta(key)
+      if current is None or current.etag != expected.etag:
+        return False
+      self.delete_object(key)
+      return True
   
   @abstractmethod
   def _all_keys(self):
@@ -103,6 +143,36 @@ class GDPStorageManager(ABC):
     for key in self.all_keys_matching():
       self.delete_object(key)
 
+  def get_range(self, key: str, start: int = 0, end: Optional[int] = None, expected: Optional[ObjectMeta] = None) -> Optional[bytes]:
+    '''
+    Reads bytes start up to (not including) end of the object at key, exactly as stored;
+    end = None reads to the end of the object.  Returns None if not found, or if expected
+    is given and the object is no longer the version it describes.
+    Backends which can read part of an object override this; the default reads it all.
+    '''
+    data = _stored_bytes(self.get_object(key))
+    if expected is not None:
+      # Etags are unique, so if the object is still expected's version, so was data
+      current = self.get_meta(key)
+      if current is None or current.etag != expected.etag:
+        return None
+    return None if data is None else data[start:end]
+
+  def iter_range(self, key: str, start: int, end: int, chunk_size: int = 1 << 20, expected: Optional[ObjectMeta] = None) -> Iterator[bytes]:
+    '''
+    Yields bytes start up to (not including) end of the object at key in chunks of at
+    most chunk_size bytes, reading one chunk at a time.  If expected is
+    given, every chunk comes from the version it describes: the chunks stop early if the
+    object is replaced.
+    '''
+    position = start
+    while position < end:
+      chunk = self.get_range(key, position, min(end, position + chunk_size), expected)
+      if not chunk:
+        return
+      yield chunk
+      position += len(chunk)
+
 class GDPGoogleStorageManager(GDPStorageManager):
   '''
   Storage manager for SDML tables in GCS buckets.
@@ -110,6 +180,8 @@ class GDPGoogleStorageManager(GDPStorageManager):
   Handles JSON-serializable objects as blobs. All keys are GCS paths (e.g., 'project/table.sdml').
   '''
   def __init__(self, bucket_name: str):
+    # The cloud SDKs are slow to import, so each is only imported by its own backend
+    from google.cloud import storage
     self.bucket_name = bucket_name
     self.client = storage.Client()
     self.bucket = self.client.bucket(bucket_name)
@@ -123,12 +195,13 @@ class GDPGoogleStorageManager(GDPStorageManager):
     Get the metadata associated with a key.  Reads the blob and then returns the 
     metadata object assocated with it
     '''
-    blob = self.bucket.blob(key)
-    if not blob.exists():
-      return None
-    # `blob` is a google.cloud.storage.Blob object (after get_blob or list_blobs)
+    # get_blob fetches the blob's properties (a bare bucket.blob(key) has no etag)
+    blob = self.bucket.get_blob(key)
     if blob is  None:
       return None
+    return self._blob_meta(blob)
+
+  def _blob_meta(self, blob) -> ObjectMeta:
     return ObjectMeta(
         etag=blob.etag if blob.etag else '',
         last_modified=blob.updated if blob.updated else datetime.now(),
@@ -162,11 +235,50 @@ class GDPGoogleStorageManager(GDPStorageManager):
     else:
       blob.upload_from_string(json.dumps(object_data))
 
+  def put_object_if_match(self, key: str, object_data: Any, expected: Optional[ObjectMeta]) -> Optional[ObjectMeta]:
+    '''
+    A write with a generation precondition (generation 0 means the object must not exist)
+    '''
+    from google.api_core.exceptions import PreconditionFailed
+    blob = self.bucket.blob(key)
+    data = object_data if isinstance(object_data, str) else json.dumps(object_data)
+    try:
+      blob.upload_from_string(data, if_generation_match=int(expected.version_id) if expected is not None and expected.version_id else 0)
+    except PreconditionFailed:
+      return None
+    # The upload leaves the new object's properties on blob
+    return self._blob_meta(blob)
+
+  def get_range(self, key: str, start: int = 0, end: Optional[int] = None, expected: Optional[ObjectMeta] = None) -> Optional[bytes]:
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+    if end is not None and end <= start:
+      return b''
+    blob = self.bucket.blob(key)
+    generation = int(expected.version_id) if expected is not None and expected.version_id else None
+    try:
+      # GCS ranges are inclusive of end
+      return blob.download_as_bytes(start=start, end=None if end is None else end - 1, if_generation_match=generation)
+    except (NotFound, PreconditionFailed):
+      return None
+
   def delete_object(self, key: str) -> None:
     '''
     Deletes the object at key (path) in the bucket.
     '''
     self.bucket.delete_blob(key)
+
+  def delete_object_if_match(self, key: str, expected: ObjectMeta) -> bool:
+    '''
+    A delete with a generation precondition
+    '''
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+    if not expected.version_id:
+      return False
+    try:
+      self.bucket.delete_blob(key, if_generation_match=int(expected.version_id))
+    except (NotFound, PreconditionFailed):
+      return False
+    return True
       
 
   def _all_keys(self,) -> List[str]:
@@ -175,6 +287,14 @@ class GDPGoogleStorageManager(GDPStorageManager):
     '''
     blobs = self.client.list_blobs(self.bucket_name)
     return  [blob.name for blob in blobs]
+
+  def all_keys_matching(self, prefix: Optional[str] = None, suffix: Optional[str] = None) -> List[str]:
+    '''
+    As GDPStorageManager.all_keys_matching, but only the keys under prefix are listed
+    by the bucket
+    '''
+    keys = [blob.name for blob in self.client.list_blobs(self.bucket_name, prefix=prefix)]
+    return keys if suffix is None else [key for key in keys if key.endswith(suffix)]
     
   
 class InMemoryStorageManager(GDPStorageManager):
@@ -205,26 +325,31 @@ class InMemoryStorageManager(GDPStorageManager):
     '''
     Stores the given object_data (dict or string) under key.
     '''
-    self.objects[key] = object_data
-    object_size = sys.getsizeof(object_data)
+    object_size = len(_stored_bytes(object_data) or b'')
     version = str(uuid4())
-    if key in self.meta.keys():
-      meta = self.meta[key]
-      meta.etag = version
-      meta.version_id = version
-      meta.last_modified = datetime.now()
-      meta.content_type = 'application/dict'
-      meta.size = object_size
-    else:
-      self.meta[key] = ObjectMeta(
-        etag=version,
-        last_modified=datetime.now(),
-        size=object_size,
-        content_type='application/dict',
-        version_id=version
-      )
+    # A new ObjectMeta for each version, so metas handed out earlier keep their etag.
+    # The meta is replaced first, so data read before a meta check is that meta's version
+    self.meta[key] = ObjectMeta(
+      etag=version,
+      last_modified=datetime.now(),
+      size=object_size,
+      content_type='application/dict',
+      version_id=version
+    )
+    self.objects[key] = object_data
 
 
+  def iter_range(self, key: str, start: int, end: int, chunk_size: int = 1 << 20, expected: Optional[ObjectMeta] = None) -> Iterator[bytes]:
+    data = _stored_bytes(self.objects.get(key))
+    if data is None:
+      return
+    if expected is not None:
+      current = self.get_meta(key)
+      if current is None or current.etag != expected.etag:
+        return
+    for position in range(start, min(end, len(data)), chunk_size):
+      yield data[position:min(end, position + chunk_size)]
+
   def delete_object(self, key: str) -> None:
     '''
     Deletes the object at key (path).
@@ -242,7 +367,534 @@ class InMemoryStorageManager(GDPStorageManager):
     return  list(self.objects.keys())
     
 
-from azure.storage.blob import BlobServiceClient
+class GDPFileSystemStorageManager(GDPStorageManager):
+  '''
+  Storage manager for SDML tables in a local (or NFS-mounted) directory, for on-prem and
+  single-node deployments.  The key 'owner/table.sdml' is stored at root_dir/owner/table.sdml.
+  Writes go to a temporary file in the target directory which is then renamed over the
+  target, so readers never see a partial object.  The etag is derived from the file's
+  inode, mtime and size, which change on every write.  Reads are memory-mapped, so an
+  object is decoded (or a range copied) straight from the page cache.
+  Arguments:
+    root_dir: the directory holding the objects; created if it doesn't exist
+    durable: if True, fsync each object before it is renamed into place
+  '''
+  TEMP_PREFIX = '.gdp-tmp-'
+
+  def __init__(self, root_dir: str, durable: bool = True):
+    self.root_dir = os.path.abspath(root_dir)
+    self.durable = durable
+    os.makedirs(self.root_dir, exist_ok=True)
+
+  def _path(self, key: str) -> str:
+    parts = key.split('/')
+    if key.startswith('/') or any(part in ('', '.', '..') for part in parts):
+      raise ValueError(f'Invalid storage key {key}')
+    return os.path.join(self.root_dir, *parts)
+
+  def key_exists(self, key: str) -> bool:
+    return os.path.isfile(self._path(key))
+
+  def get_meta(self, key: str) -> Optional[ObjectMeta]:
+    try:
+      stat = os.stat(self._path(key))
+    except FileNotFoundError:
+      return None
+    return ObjectMeta(
+      etag=self._etag(stat),
+      last_modified=datetime.fromtimestamp(stat.st_mtime),
+      size=stat.st_size,
+      content_type='application/json',
+      version_id=str(stat.st_mtime_ns)
+    )
+
+  def _etag(self, stat) -> str:
+    return f'{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+  @contextmanager
+  def _mapped(self, key: str):
+    # The file at key, memory-mapped (an empty file can't be mapped, so b'' stands in),
+    # along with its stat.  Raises FileNotFoundError if there is none
+    with open(self._path(key), 'rb') as f:
+      stat = os.fstat(f.fileno())
+      if stat.st_size == 0:
+        yield (b'', stat)
+        return
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        yield (mapped, stat)
+
+  def get_range(self, key: str, start: int = 0, end: Optional[int] = None, expected: Optional[ObjectMeta] = None) -> Optional[bytes]:
+    try:
+      with self._mapped(key) as (mapped, stat):
+        # Writes replace the file, so the open file is one version throughout
+        if expected is not None and self._etag(stat) != expected.etag:
+          return None
+        # Only the range is copied out of the map
+        return bytes(mapped[start:end])
+    except FileNotFoundError:
+      return None
+
+  def get_object(self, key: str) -> Optional[Any]:
+    '''
+    Reads the object at key.  Returns the parsed JSON object, the raw string if it
+    isn't JSON, or None if not found.
+    '''
+    try:
+      with self._mapped(key) as (mapped, stat):
+        # Decoded straight from the map, without first copying the file into bytes
+        text = str(mapped, 'utf-8')
+    except FileNotFoundError:
+      return None
+    try:
+      return json.loads(text)
+    except Exception:
+      return text
+
+  def put_object(self, key: str, object_data: Any) -> None:
+    '''
+    Atomically stores object_data (dict or string) as JSON under key.
+    '''
+    path = self._path(key)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    data = object_data if isinstance(object_data, str) else json.dumps(object_data)
+    (fd, temp_path) = tempfile.mkstemp(dir=directory, prefix=self.TEMP_PREFIX)
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data.encode('utf-8'))
+        if self.durable:
+          f.flush()
+          os.fsync(f.fileno())
+      os.replace(temp_path, path)
+    except BaseException:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      raise
+
+  def put_object_if_match(self, key: str, object_data: Any, expected: Optional[ObjectMeta]) -> Optional[ObjectMeta]:
+    '''
+    The check and the write are made under an exclusive lock on a lock file in the
+    object's directory, so they are atomic across the processes sharing root_dir
+    (provided the filesystem supports flock).
+    '''
+    with self._directory_lock(key):
+      current = self.get_meta(key)
+      if (current.etag if current is not None else None) != (expected.etag if expected is not None else None):
+        return None
+      self.put_object(key, object_data)
+      return self.get_meta(key)
+
+  def delete_object_if_match(self, key: str, expected: ObjectMeta) -> bool:
+    '''
+    As put_object_if_match, the check and the delete are made under the lock file
+    '''
+    with self._directory_lock(key):
+      current = self.get_meta(key)
+      if current is None or current.etag != expected.etag:
+        return False
+      self.delete_object(key)
+      return True
+
+  @contextmanager
+  def _directory_lock(self, key: str):
+    # An exclusive lock on the lock file in the directory of the object at key
+    import fcntl
+    directory = os.path.dirname(self._path(key))
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f'{self.TEMP_PREFIX}lock'), 'a') as lock_file:
+      fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+  def delete_object(self, key: str) -> None:
+    try:
+      os.remove(self._path(key))
+    except FileNotFoundError:
+      pass
+
+  def _walk(self, directory: str, relative: str, keys: List[str]) -> None:
+    try:
+      entries = list(os.scandir(directory))
+    except FileNotFoundError:
+      return
+    for entry in entries:
+      if entry.name.startswith(self.TEMP_PREFIX):
+        continue
+      key = f'{relative}{entry.name}'
+      if entry.is_dir(follow_symlinks=False):
+        self._walk(entry.path, f'{key}/', keys)
+      elif entry.is_file(follow_symlinks=False):
+        keys.append(key)
+
+  def _all_keys(self) -> List[str]:
+    keys: List[str] = []
+    self._walk(self.root_dir, '', keys)
+    return keys
+
+  def all_keys_matching(self, prefix: Optional[str] = None, suffix: Optional[str] = None) -> List[str]:
+    '''
+    As GDPStorageManager.all_keys_matching, but only walks the directory the prefix
+    points into rather than the whole tree
+    '''
+    keys: List[str] = []
+    if prefix and '/' in prefix:
+      relative = prefix[:prefix.rindex('/') + 1]
+      try:
+        directory = self._path(relative.rstrip('/'))
+      except ValueError:
+        return []
+      self._walk(directory, relative, keys)
+    else:
+      self._walk(self.root_dir, '', keys)
+    if prefix is not None:
+      keys = [key for key in keys if key.startswith(prefix)]
+    if suffix is not None:
+      keys = [key for key in keys if key.endswith(suffix)]
+    return keys
+
+
+class LocalCacheStorageManager(GDPStorageManager):
+  '''
+  A read-through cache on local disk in front of any other GDPStorageManager (usually
+  GCS or Azure).  get_object checks the backend's etag for the key (a metadata request)
+  and serves the local copy if it matches; otherwise it downloads that version of the
+  object (a read pinned to the etag) and keeps a copy.  A get_object straight after a
+  get_meta of the same key by the same thread (as a table load does) uses that meta
+  rather than asking again.  Writes and deletes go straight through to the backend;
+  a conditional write keeps a copy under the etag the write returned, and any other
+  write drops the copy, since only the write itself knows which version it made.  The cache is bounded
+  to max_bytes and evicts least-recently-used entries.  The cached files (and their
+  etags) survive restarts, so a restarted pod or a new worker doesn't re-download
+  tables the node already has.
+  Workers sharing a cache_dir each keep their own index, so the directory can grow to
+  max_bytes per worker; a file evicted by another worker just counts as a miss.
+  Arguments:
+    backend: the storage manager being cached
+    cache_dir: directory for the cached objects; created if it doesn't exist
+    max_bytes: upper bound on the bytes of cached object data
+  '''
+  # Seconds for which a thread's get_meta is used by its next get_object of the key
+  META_REUSE_SECONDS = 1.0
+
+  def __init__(self, backend: GDPStorageManager, cache_dir: str, max_bytes: int = 1 << 30):
+    self.backend = backend
+    self._recent = threading.local()
+    self.cache_dir = os.path.abspath(cache_dir)
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    # key -> (etag, size), least recently used first
+    self._index: OrderedDict = OrderedDict()
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(self.cache_dir, exist_ok=True)
+    self._load_index()
+
+  def _paths(self, key: str):
+    name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return (os.path.join(self.cache_dir, f'{name}.data'), os.path.join(self.cache_dir, f'{name}.meta'))
+
+  def _load_index(self) -> None:
+    entries = []
+    for entry in os.scandir(self.cache_dir):
+      if not entry.name.endswith('.meta'):
+        continue
+      try:
+        with open(entry.path) as f:
+          record = json.load(f)
+        data_path = entry.path[:-len('.meta')] + '.data'
+        entries.append((os.stat(data_path).st_atime, record['key'], record['etag'], record['size']))
+      except (OSError, ValueError, KeyError):
+        continue
+    for (atime, key, etag, size) in sorted(entries):
+      self._index[key] = (etag, size)
+      self._bytes += size
+    self._evict_to(self.max_bytes)
+
+  def _write_file(self, path: str, data: bytes) -> None:
+    (fd, temp_path) = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    os.replace(temp_path, path)
+
+  def _drop(self, key: str) -> None:
+    # caller holds self._lock
+    entry = self._index.pop(key, None)
+    if entry is not None:
+      self._bytes -= entry[1]
+    for path in self._paths(key):
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+
+  def _evict_to(self, limit: int) -> None:
+    # caller holds self._lock (or is the constructor)
+    while self._bytes > limit and self._index:
+      oldest = next(iter(self._index))
+      self._drop(oldest)
+
+  def _store(self, key: str, etag: str, text: str) -> None:
+    data = text.encode('utf-8')
+    if len(data) > self.max_bytes:
+      return
+    (data_path, meta_path) = self._paths(key)
+    with self._lock:
+      self._drop(key)
+      self._evict_to(self.max_bytes - len(data))
+      try:
+        self._write_file(data_path, data)
+        self._write_file(meta_path, json.dumps({'key': key, 'etag': etag, 'size': len(data)}).encode('utf-8'))
+      except OSError:
+        return
+      self._index[key] = (etag, len(data))
+      self._bytes += len(data)
+
+  def _cached_text(self, key: str, etag: str) -> Optional[str]:
+    with self._lock:
+      entry = self._index.get(key)
+      if entry is None or entry[0] != etag:
+        return None
+      self._index.move_to_end(key)
+    try:
+      with open(self._paths(key)[0], 'rb') as f:
+        return f.read().decode('utf-8')
+    except OSError:
+      with self._lock:
+        self._drop(key)
+      return None
+
+  def key_exists(self, key: str) -> bool:
+    return self.backend.key_exists(key)
+
+  def get_meta(self, key: str) -> Optional[ObjectMeta]:
+    meta = self.backend.get_meta(key)
+    self._recent.meta = (key, meta, time.monotonic())
+    return meta
+
+  def _current_meta(self, key: str) -> Optional[ObjectMeta]:
+    # The meta this thread has just read for key, or a fresh one
+    recent = getattr(self._recent, 'meta', None)
+    self._recent.meta = None
+    if recent is not None and recent[0] == key and time.monotonic() - recent[2] < self.META_REUSE_SECONDS:
+      return recent[1]
+    return self.backend.get_meta(key)
+
+  def get_object(self, key: str) -> Optional[Any]:
+    meta = self._current_meta(key)
+    if meta is None:
+      with self._lock:
+        self._drop(key)
+      return None
+    text = self._cached_text(key, meta.etag)
+    METRICS.count_cache('disk', text is not None)
+    if text is not None:
+      self.hits += 1
+      try:
+        return json.loads(text)
+      except Exception:
+        return text
+    self.misses += 1
+    data = self.backend.get_range(key, 0, None, expected=meta)
+    if data is None:
+      # Replaced since meta was read: send the new version, without knowing its etag
+      return self.backend.get_object(key)
+    text = data.decode('utf-8')
+    self._store(key, meta.etag, text)
+    # Parse strings, so a miss returns the same thing as a hit
+    try:
+      return json.loads(text)
+    except Exception:
+      return text
+
+  def put_object(self, key: str, object_data: Any) -> None:
+    self.backend.put_object(key, object_data)
+    with self._lock:
+      self._drop(key)
+
+  def put_object_if_match(self, key: str, object_data: Any, expected: Optional[ObjectMeta]) -> Optional[ObjectMeta]:
+    meta = self.backend.put_object_if_match(key, object_data, expected)
+    if meta is not None:
+      self._store(key, meta.etag, object_data if isinstance(object_data, str) else json.dumps(object_data))
+    return meta
+
+  def delete_object(self, key: str) -> None:
+    self.backend.delete_object(key)
+    with self._lock:
+      self._drop(key)
+
+  def delete_object_if_match(self, key: str, expected: ObjectMeta) -> bool:
+    deleted = self.backend.delete_object_if_match(key, expected)
+    if deleted:
+      with self._lock:
+        self._drop(key)
+    return deleted
+
+  def get_range(self, key: str, start: int = 0, end: Optional[int] = None, expected: Optional[ObjectMeta] = None) -> Optional[bytes]:
+    # Byte ranges are for streamed downloads, which go straight to the backend
+    return self.backend.get_range(key, start, end, expected)
+
+  def _all_keys(self) -> List[str]:
+    return self.backend._all_keys()
+
+  def all_keys_matching(self, prefix: Optional[str] = None, suffix: Optional[str] = None) -> List[str]:
+    return self.backend.all_keys_matching(prefix=prefix, suffix=suffix)
+
+
+class GDPStorageThrottledException(Exception):
+  '''
+  Raised when a storage backend refuses a request because of rate limiting
+  (HTTP 429/503 from a cloud blob store, or injected by SimulatedLatencyStorageManager).
+  '''
+  def __init__(self, operation, key):
+    self.message = f'Storage operation {operation} on {key} was throttled'
+    self.operation = operation
+    self.key = key
+    super().__init__(self.message)
+
+
+class SimulatedLatencyStorageManager(GDPStorageManager):
+  '''
+  Wraps another GDPStorageManager and makes it behave like a remote blob store, for
+  local load testing and benchmarks: every operation is delayed, may be throttled,
+  and object transfers are limited in bandwidth.  Calls are counted per operation.
+  Operations are key_exists, get_meta, get_object, get_range, put_object, delete_object and list.
+  Arguments:
+    backend: the storage manager that actually holds the objects
+    latency: dict operation -> seconds of fixed latency (missing operations get 0)
+    jitter: up to this fraction of the latency is randomly added to or taken off each call
+    throttle_rate: probability that a call raises GDPStorageThrottledException
+    bandwidth: bytes per second for get_object/get_range/put_object payloads; None for unlimited
+    seed: seed for the jitter/throttling random number generator
+  '''
+  OPERATIONS = ('key_exists', 'get_meta', 'get_object', 'get_range', 'put_object', 'delete_object', 'list')
+
+  def __init__(
+      self,
+      backend: GDPStorageManager,
+      latency: Optional[Dict[str, float]] = None,
+      jitter: float = 0.0,
+      throttle_rate: float = 0.0,
+      bandwidth: Optional[float] = None,
+      seed: Optional[int] = None
+  ):
+    self.backend = backend
+    self.latency = latency or {}
+    self.jitter = jitter
+    self.throttle_rate = throttle_rate
+    self.bandwidth = bandwidth
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self.call_counts: Dict[str, int] = {operation: 0 for operation in self.OPERATIONS}
+    self.throttled_counts: Dict[str, int] = {operation: 0 for operation in self.OPERATIONS}
+
+  def _simulate(self, operation: str, key: str, payload: Any = None) -> None:
+    with self._lock:
+      self.call_counts[operation] += 1
+      throttled = self.throttle_rate > 0 and self._random.random() < self.throttle_rate
+      if throttled:
+        self.throttled_counts[operation] += 1
+      jitter = self._random.uniform(-self.jitter, self.jitter) if self.jitter > 0 else 0.0
+    delay = self.latency.get(operation, 0.0) * (1 + jitter)
+    if self.bandwidth and payload is not None:
+      delay += _payload_size(payload) / self.bandwidth
+    if delay > 0:
+      time.sleep(delay)
+    if throttled:
+      raise GDPStorageThrottledException(operation, key)
+
+  def reset_counts(self) -> None:
+    with self._lock:
+      for operation in self.OPERATIONS:
+        self.call_counts[operation] = 0
+        self.throttled_counts[operation] = 0
+
+  def key_exists(self, key: str) -> bool:
+    self._simulate('key_exists', key)
+    return self.backend.key_exists(key)
+
+  def get_meta(self, key: str) -> Optional[ObjectMeta]:
+    self._simulate('get_meta', key)
+    return self.backend.get_meta(key)
+
+  def get_object(self, key: str) -> Optional[Any]:
+    result = self.backend.get_object(key)
+    self._simulate('get_object', key, result)
+    return result
+
+  def get_range(self, key: str, start: int = 0, end: Optional[int] = None, expected: Optional[ObjectMeta] = None) -> Optional[bytes]:
+    result = self.backend.get_range(key, start, end, expected)
+    self._simulate('get_range', key, result)
+    return result
+
+  def put_object(self, key: str, object_data: Any) -> None:
+    self._simulate('put_object', key, object_data)
+    self.backend.put_object(key, object_data)
+
+  def put_object_if_match(self, key: str, object_data: Any, expected: Optional[ObjectMeta]) -> Optional[ObjectMeta]:
+    self._simulate('put_object', key, object_data)
+    return self.backend.put_object_if_match(key, object_data, expected)
+
+  def delete_object(self, key: str) -> None:
+    self._simulate('delete_object', key)
+    self.backend.delete_object(key)
+
+  def delete_object_if_match(self, key: str, expected: ObjectMeta) -> bool:
+    self._simulate('delete_object', key)
+    return self.backend.delete_object_if_match(key, expected)
+
+  def _all_keys(self) -> List[str]:
+    self._simulate('list', '')
+    return self.backend._all_keys()
+
+  def all_keys_matching(self, prefix: Optional[str] = None, suffix: Optional[str] = None) -> List[str]:
+    # One list call, made the backend's way (which may list only the keys under prefix)
+    self._simulate('list', prefix or '')
+    return self.backend.all_keys_matching(prefix=prefix, suffix=suffix)
+
+
+def _stored_bytes(stored: Any) -> Optional[bytes]:
+  # The bytes of an object as returned by get_object
+  if stored is None:
+    return None
+  if isinstance(stored, (bytes, bytearray)):
+    return bytes(stored)
+  if isinstance(stored, str):
+    return stored.encode('utf-8')
+  return json.dumps(stored).encode('utf-8')
+
+# Azure sends and expects etags in quotes (as in HTTP); ObjectMeta etags are kept bare
+def _quoted_etag(etag: str) -> str:
+  return etag if etag.startswith('"') else f'"{etag}"'
+
+def _unquoted_etag(etag: str) -> str:
+  return etag.strip('"')
+
+def _payload_size(payload: Any) -> int:
+  if isinstance(payload, (bytes, bytearray)):
+    return len(payload)
+  if isinstance(payload, str):
+    return len(payload.encode('utf-8'))
+  return len(json.dumps(payload))
+
+
+def parse_latency_spec(spec: str) -> Dict[str, float]:
+  '''
+  Parse a latency specification of the form "get_object=20,get_meta=5" (milliseconds)
+  into a dict operation -> seconds.  A bare number applies to every operation.
+  '''
+  result: Dict[str, float] = {}
+  for part in [part.strip() for part in spec.split(',') if part.strip()]:
+    if '=' in part:
+      (operation, millis) = part.split('=', 1)
+      result[operation.strip()] = float(millis) / 1000.0
+    else:
+      for operation in SimulatedLatencyStorageManager.OPERATIONS:
+        result[operation] = float(part) / 1000.0
+  return result
+
 
 class GDPAzureStorageManager(GDPStorageManager):
   '''
@@ -251,6 +903,7 @@ class GDPAzureStorageManager(GDPStorageManager):
   '''
 
   def __init__(self, container_name: str, connection_string: str):
+    from azure.storage.blob import BlobServiceClient
     self.container_name = container_name
     self.client = BlobServiceClient.from_connection_string(connection_string)
     self.container = self.client.get_container_client(container_name)
@@ -275,7 +928,7 @@ class GDPAzureStorageManager(GDPStorageManager):
       return None
     props = blob.get_blob_properties()
     return ObjectMeta(
-      etag=props['etag'],
+      etag=_unquoted_etag(props['etag']),
       last_modified=props['last_modified'],
       size=props['size'],
       content_type=props.get('content_settings', {}).get('content_type', None), # type: ignore
@@ -297,6 +950,18 @@ class GDPAzureStorageManager(GDPStorageManager):
     except Exception:
       return data
 
+  def get_range(self, key: str, start: int = 0, end: Optional[int] = None, expected: Optional[ObjectMeta] = None) -> Optional[bytes]:
+    from azure.core import MatchConditions
+    from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+    if end is not None and end <= start:
+      return b''
+    blob = self.container.get_blob_client(key)
+    conditions = {} if expected is None else {'etag': _quoted_etag(expected.etag), 'match_condition': MatchConditions.IfNotModified}
+    try:
+      return blob.download_blob(offset=start, length=None if end is None else end - start, **conditions).readall()
+    except (ResourceModifiedError, ResourceNotFoundError):
+      return None
+
   def put_object(self, key: str, object_data: Dict) -> None:
     '''
     Stores the given object_data  as JSON under key.
@@ -306,6 +971,23 @@ class GDPAzureStorageManager(GDPStorageManager):
       blob.upload_blob(object_data, overwrite=True)
     else:
       blob.upload_blob(json.dumps(object_data), overwrite=True)
+
+  def put_object_if_match(self, key: str, object_data: Any, expected: Optional[ObjectMeta]) -> Optional[ObjectMeta]:
+    '''
+    A write with an If-Match precondition, or If-None-Match: * when expected is None
+    '''
+    from azure.core import MatchConditions
+    from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+    blob = self.container.get_blob_client(key)
+    data = (object_data if isinstance(object_data, str) else json.dumps(object_data)).encode('utf-8')
+    try:
+      if expected is None:
+        result = blob.upload_blob(data, overwrite=False)
+      else:
+        result = blob.upload_blob(data, overwrite=True, etag=_quoted_etag(expected.etag), match_condition=MatchConditions.IfNotModified)
+    except (ResourceExistsError, ResourceModifiedError):
+      return None
+    return ObjectMeta(etag=_unquoted_etag(result['etag']), last_modified=result['last_modified'], size=len(data), version_id=result.get('version_id'))
  
   def delete_object(self, key: str) -> None:
     '''
@@ -314,10 +996,73 @@ class GDPAzureStorageManager(GDPStorageManager):
     blob = self.container.get_blob_client(key)
     blob.delete_blob()
 
+  def delete_object_if_match(self, key: str, expected: ObjectMeta) -> bool:
+    '''
+    A delete with an If-Match precondition
+    '''
+    from azure.core import MatchConditions
+    from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+    blob = self.container.get_blob_client(key)
+    try:
+      blob.delete_blob(etag=_quoted_etag(expected.etag), match_condition=MatchConditions.IfNotModified)
+    except (ResourceModifiedError, ResourceNotFoundError):
+      return False
+    return True
+
   def _all_keys(self):
     '''
     Return all the keys of stored objects
     '''
     return [b.name for b in self.container.list_blobs()]
+
+  def all_keys_matching(self, prefix: Optional[str] = None, suffix: Optional[str] = None) -> List[str]:
+    '''
+    As GDPStorageManager.all_keys_matching, but only the keys under prefix are listed
+    by the container
+    '''
+    keys = [b.name for b in self.container.list_blobs(name_starts_with=prefix)]
+    return keys if suffix is None else [key for key in keys if key.endswith(suffix)]
  
   
+
+
+# --- Storage backend registry --- #
+
+def _google_backend() -> GDPStorageManager:
+  from src.config import BUCKET_NAME
+  return GDPGoogleStorageManager(BUCKET_NAME)
+
+def _azure_backend() -> GDPStorageManager:
+  from src.config import CONTAINER_NAME, AZURE_STORAGE_CONNECTION_STRING
+  return GDPAzureStorageManager(CONTAINER_NAME, AZURE_STORAGE_CONNECTION_STRING)
+
+def _local_backend() -> GDPStorageManager:
+  from src.config import LOCAL_STORAGE_DIR, LOCAL_STORAGE_DURABLE
+  return GDPFileSystemStorageManager(LOCAL_STORAGE_DIR, durable=LOCAL_STORAGE_DURABLE)
+
+# STORAGE_ENVIRONMENT -> zero-argument factory for the backend storage manager.  A
+# backend's SDK is imported only when its factory runs.
+STORAGE_BACKENDS: Dict[str, Callable[[], GDPStorageManager]] = {
+  'Google': _google_backend,
+  'Azure': _azure_backend,
+  'Local': _local_backend,
+  'MEMORY': InMemoryStorageManager
+}
+
+def register_storage_backend(environment: str, factory: Callable[[], GDPStorageManager]) -> None:
+  '''
+  Make factory the backend for STORAGE_ENVIRONMENT=environment
+  '''
+  STORAGE_BACKENDS[environment] = factory
+
+def create_backend_storage_manager(environment: str) -> GDPStorageManager:
+  '''
+  Build the storage manager registered for environment.  An environment of the form
+  "package.module:factory" names a plugin factory, imported on demand.  Any other
+  unregistered environment gets an InMemoryStorageManager.
+  '''
+  factory = STORAGE_BACKENDS.get(environment)
+  if factory is None and ':' in environment:
+    (module_name, factory_name) = environment.split(':', 1)
+    factory = getattr(importlib.import_module(module_name), factory_name)
+  return (factory or InMemoryStorageManager)()
@@ -1,7 +1,26 @@
-from sdtp import TableServer, InvalidDataException
+from sdtp import TableServer, TableBuilder, InvalidDataException, RowTable, json_serialize, convert_rows_to_type_list
 from json import loads, dumps
+import threading
+import time
 from typing import Dict, Optional, List
 from src.gdp_storage import ObjectMeta
+from src.single_flight import SingleFlight
+from src.ttl_cache import TTLCache
+from src.metrics import METRICS
+from src.aggregate import aggregate_rows
+from src.columnar_table import ColumnarTable
+from src.table_index import TableIndexes, indexable_columns, INDEX_KINDS
+from src.change_journal import ChangeJournal
+from src.table_lease import TableLease, GDPTableBusyException, UPDATE_ATTEMPTS
+from src.table_segments import table_stem, segments_key, segment_key, pending_segments, read_manifest, delete_segments, merge_segment
+from src.table_columns import head_and_tail, read_sidecar, load_column, write_columns, delete_columns
+from src.table_catalogue import TableCatalogue, catalogue_entry
+from src.table_freshness import TableFreshness
+from src.config import COMPACT_SEGMENTS, INDEX_HOT_QUERIES, INDEX_MIN_ROWS, PREVIEW_ROWS, JOURNAL_POLL_INTERVAL, JOURNAL_RETENTION
+from src.config import TABLE_CACHE_TTL, TABLE_CACHE_STALE, REFRESH_AHEAD
+from src.config import NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_SIZE
+from sdtp.sdtp_filter import make_filter
+from sdtp.sdtp_table import _convert_filter_result_to_format, ALLOWED_FILTERED_ROW_RESULT_FORMATS, DEFAULT_FILTERED_ROW_RESULT_FORMAT
 from pydantic import BaseModel, ValidationError
 
 class PermissionRecord(BaseModel):
@@ -24,9 +43,15 @@ def perm_key(table_key: str) -> str:
     return table_key[:-5] + '.perm'
   raise ValueError("Table key does not end with '.sdml'")
 
+def lease_key(table_key: str) -> str:
+  return table_stem(table_key) + '.lease'
+
 def owner(key):
   return key.split('/')[0]
 
+def _parse(obj):
+  return loads(obj) if isinstance(obj, str) else obj
+
 class GDPNotFoundException(Exception):
   '''
   Raised when a GDP Object (table) has not been found.
@@ -60,42 +85,830 @@ class GDPTableManager:
   Manages storage, retrieval, and permissions for GDP/SDML tables only.
   This is a thin overlay on the storage, permissions, and table server managers.
   Ensures the different layers remain consistent, especially for permissioning.
+  The caches are shared by all the threads of a worker, and are guarded by self._lock.
+  See table_segments.py, table_columns.py, table_catalogue.py and table_freshness.py.
   '''
-  def __init__(self, storage_manager):
+  def __init__(self, storage_manager, journal_poll_interval: float = JOURNAL_POLL_INTERVAL):
     '''
     Initialize storage, permissions, and table server.
     Loads all tables at startup so they're available in memory.
+    Arguments:
+      storage_manager: the GDPStorageManager holding the tables
+      journal_poll_interval: seconds between polls of the change journal; 0 turns it off
     '''
     self.storage_manager = storage_manager
     self.table_server = TableServer()
     self._cache_meta = {}
+    self._cache_segments = {}
+    self._key_positions = {}
+    self._lock = threading.RLock()
+    self._loads = SingleFlight()
+    self._write_locks = {}
+    self._compacting = set()
+    self._declared_indexes = {}
+    self._indexes = {}
+    self._scan_counts = {}
+    self._freshness = TableFreshness()
+    self._missing = TTLCache(max_size=NEGATIVE_CACHE_SIZE, ttl=NEGATIVE_CACHE_TTL)
+    self.catalogue = TableCatalogue(storage_manager, self._describe_tables)
+    self.journal = ChangeJournal(storage_manager, self._journal_change, self._journal_reset, journal_poll_interval, JOURNAL_RETENTION)
+
+  def _cache_table(self, key, table, meta, segments_etag=None, seq=None):
+    with self._lock:
+      self.table_server.add_sdtp_table(key, table)
+      self._cache_meta[key] = meta
+      self._cache_segments[key] = segments_etag
+      self._freshness.cached(key, seq)
+      indexes = self._indexes.get(key)
+      if indexes is not None and indexes.table is not table:
+        del self._indexes[key]
+
+  def _evict(self, key):
+    with self._lock:
+      self.table_server.servers.pop(key, None)
+      self._cache_meta.pop(key, None)
+      self._cache_segments.pop(key, None)
+      self._freshness.forget(key)
+      self._key_positions.pop(key, None)
+      self._indexes.pop(key, None)
+      self._scan_counts.pop(key, None)
+      self._declared_indexes.pop(key, None)
+
+  def _write_lock(self, key):
+    with self._lock:
+      return self._write_locks.setdefault(key, threading.Lock())
 
+  def _lease(self, key):
+    return TableLease(self.storage_manager, key, lease_key(key))
 
-  def get_table(self, key):
-    if not self.storage_manager.key_exists(key):
+  # --- Change journal --- #
+
+  def _journal_change(self, key, op):
+    # Another replica changed the table at key
+    self._missing.invalidate(key)
+    self._missing.invalidate(perm_key(key))
+    if op == 'access':
+      # Permission records aren't cached, only their absence
+      return
+    hot = False
+    with self._lock:
+      self._freshness.changed(key)
+      keep = op != 'delete' and TABLE_CACHE_STALE > 0 and key in self.table_server.servers
+      if keep:
+        self._freshness.mark_stale(key, time.monotonic())
+        hot = self._freshness.hot(key)
+    if not keep:
+      self._evict(key)
+    elif hot:
+      self._refresh_in_background(key)
+
+  def _journal_reset(self):
+    # Changes may have been missed: revalidate every cached table once
+    self._missing.clear()
+    with self._lock:
+      self._freshness.reset()
+
+  def _table_meta(self, key) -> ObjectMeta:
+    '''
+    The meta of the table object at key.  A missing key is remembered in self._missing.
+    Raises:
+      GDPNotFoundException if there is no table at key
+    '''
+    (missing, _) = self._missing.lookup(key)
+    METRICS.count_cache('missing_table', missing)
+    if missing:
+      raise GDPNotFoundException(key)
+    with METRICS.stage('storage_meta'):
+      blob_meta = self.storage_manager.get_meta(key)
+    if blob_meta is None:
+      self._missing.put(key, True)
       raise GDPNotFoundException(key)
+    return blob_meta
+
+  # --- Freshness --- #
+
+  def _refresh_in_background(self, key):
+    '''
+    Revalidate the table at key in a background thread, reloading it if it has changed.
+    At most one refresh of a table runs at a time.
+    '''
+    with self._lock:
+      if not self._freshness.start_refresh(key):
+        return
+    threading.Thread(target=self._refresh, args=(key,), daemon=True).start()
+
+  def _refresh(self, key):
+    try:
+      self.get_table(key, revalidate=True)
+    except GDPNotFoundException:
+      self._evict(key)
+    except Exception:
+      # The next request will revalidate (and report the error)
+      pass
+    finally:
+      with self._lock:
+        self._freshness.end_refresh(key)
+
+  def get_table(self, key, revalidate=False):
+    '''
+    Return the table at key, from the cache if it's current.  While the change journal is
+    being polled, a current cached table is returned without a storage check, unless
+    revalidate is True.
+    Raises:
+      GDPNotFoundException if there is no table at key
+    '''
+    self.journal.start()
+    now = time.monotonic()
+    with self._lock:
+      seq = self._freshness.seq
+      table = self.table_server.servers.get(key)
+      current = self._freshness.is_current(key)
+      if table is not None and not revalidate:
+        self._freshness.hit(key)
+      age = self._freshness.age(key, now)
+      hot = self._freshness.hot(key)
+      stale_since = self._freshness.stale_since(key)
+    if table is not None and current and not revalidate:
+      if self.journal.trusted():
+        METRICS.count_cache('table', True)
+        return table
+      if age < TABLE_CACHE_TTL:
+        if hot and age >= REFRESH_AHEAD * TABLE_CACHE_TTL:
+          self._refresh_in_background(key)
+        METRICS.count_cache('table', True)
+        return table
+
+    # 1. Does it exist?
+    blob_meta = self._table_meta(key)
+    with METRICS.stage('storage_meta'):
+      segments_meta = self._segments_meta(key)
 
     # 2. Is it cached and up to date?
-    cache_meta = self._cache_meta.get(key)
-    blob_meta = self.storage_manager.get_meta(key)
+    with self._lock:
+      cache_meta = self._cache_meta.get(key)
+      table = self.table_server.servers.get(key)
+      cache_segments = self._cache_segments.get(key)
     if (
       cache_meta
+      and table is not None
       and cache_meta.etag == blob_meta.etag
-      and key in self.table_server.servers
+      and cache_segments == (segments_meta.etag if segments_meta else None)
     ):
-      return self.table_server.servers[key]
+      with self._lock:
+        if self.table_server.servers.get(key) is table:
+          self._freshness.revalidated(key, seq)
+      METRICS.count_cache('table', True)
+      return table
+
+    # 3. Changed: serve the cached version if it hasn't been stale for too long, and
+    # reload it in the background
+    if table is not None and not revalidate and TABLE_CACHE_STALE > 0:
+      with self._lock:
+        stale_since = self._freshness.mark_stale(key, stale_since or now)
+      if now - stale_since <= TABLE_CACHE_STALE:
+        self._refresh_in_background(key)
+        METRICS.count_cache('table_stale', True)
+        return table
+    METRICS.count_cache('table', False)
 
-    # 3. Otherwise, load from storage and update cache
-    obj = self.storage_manager.get_object(key)
-    self.table_server.add_sdtp_table_from_dictionary(key, obj)
-    self._cache_meta[key] = blob_meta
-    return self.table_server.servers[key]
+    # 4. Otherwise, load from storage and update cache.  The load is done outside
+    # the lock so a slow download doesn't block requests for other tables, and
+    # only one thread loads a given table; the others wait for its result
+    return self._loads.do(key, lambda: self._load_table(key, metas=(blob_meta, segments_meta)))
+
+  def table_version(self, key, table) -> tuple:
+    '''
+    A value which changes whenever the contents of table, the cached table at key, may
+    have: results computed from equal versions can be shared
+    '''
+    with self._lock:
+      meta = self._cache_meta.get(key)
+      return (id(table), meta.etag if meta else None, self._cache_segments.get(key))
+
+  def _load_table(self, key, by_column=True, metas=None):
+    '''
+    Download and parse the table at key, and cache it.  The meta is read before
+    the object, so if the table changes mid-load the cached etag is the older one
+    and the next get_table reloads.  If by_column is True and the table is stored by
+    column, only its schema is read, and its columns are loaded as they are used.
+    metas, if given, is (table meta, manifest meta or None), just read by the caller.
+    '''
+    with self._lock:
+      seq = self._freshness.seq
+    if metas is None:
+      with METRICS.stage('storage_meta'):
+        blob_meta = self.storage_manager.get_meta(key)
+      if blob_meta is None:
+        raise GDPNotFoundException(key)
+      (segments_meta, manifest) = read_manifest(self.storage_manager, key)
+    else:
+      (blob_meta, segments_meta) = metas
+      (segments_meta, manifest) = read_manifest(self.storage_manager, key, segments_meta) if segments_meta else (None, None)
+    segments_etag = segments_meta.etag if segments_meta else None
+    has_segments = pending_segments(manifest, blob_meta)
+    if by_column and not has_segments and self._stored_by_column(key, blob_meta):
+      sidecar = read_sidecar(self.storage_manager, key, blob_meta)
+      if sidecar is not None and sidecar.get('columns'):
+        table = ColumnarTable(sidecar['schema'], sidecar['row_count'], lambda index: self._load_column(key, sidecar, index))
+        with self._lock:
+          self._declared_indexes[key] = sidecar.get('indexes') or {}
+        self._cache_table(key, table, blob_meta, segments_etag, seq)
+        return table
+    with METRICS.stage('storage_fetch'):
+      obj = self.storage_manager.get_object(key)
+    if obj is None:
+      raise GDPNotFoundException(key)
+    with METRICS.stage('parse'):
+      table_data = _parse(obj)
+      table = TableBuilder.build_table(table_data)
+    if has_segments and manifest is not None:
+      for seg_key in manifest['segments']:
+        with METRICS.stage('storage_fetch'):
+          segment = self.storage_manager.get_object(seg_key)
+        if segment is not None:
+          self._apply_segment(key, table, _parse(segment))
+      if len(manifest['segments']) >= COMPACT_SEGMENTS:
+        self._start_compaction(key)
+    declared = table_data.get('indexes') or {}
+    with self._lock:
+      self._declared_indexes[key] = declared
+    if declared and isinstance(table, RowTable):
+      with METRICS.stage('index'):
+        indexes = self._build_indexes(table, declared)
+      with self._lock:
+        self._indexes[key] = indexes
+    self._cache_table(key, table, blob_meta, segments_etag, seq)
+    return table
+
+  # --- By-column storage (see table_columns.py) --- #
+
+  def _stored_by_column(self, key, blob_meta) -> bool:
+    '''
+    False if the catalogue says the version of the table at key whose meta is blob_meta
+    isn't stored by column, so loading it needn't read its column sidecar.  The catalogue
+    is read on the first load, and the cached copy used after that; a table it doesn't
+    describe, or describes at another version, may be stored by column.
+    '''
+    tables = self.catalogue.cached()
+    if tables is None:
+      tables = self.catalogue.read()
+    entry = tables.get(key)
+    return entry is None or entry.get('etag') != blob_meta.etag or entry.get('columnar', True)
+
+  def _load_column(self, key, sidecar, index) -> list:
+    values = load_column(self.storage_manager, sidecar, index)
+    if values is None:
+      # The table was replaced under us; the next get_table will reload it
+      self._evict(key)
+      raise GDPNotFoundException(key)
+    return values
+
+  def _write_columns(self, key, table_data: dict, declared_indexes: dict, serialized: bool) -> Optional[ObjectMeta]:
+    # Write the column sidecar (and columns) of the base just stored, and catalogue it.
+    # Returns the base's meta
+    (sidecar, base_meta) = write_columns(self.storage_manager, key, table_data, declared_indexes, serialized)
+    self.catalogue.update({key: catalogue_entry(sidecar, base_meta)})
+    return base_meta
+
+  def _get_row_table(self, key):
+    '''
+    get_table, but always a current table with all its rows in memory (needed to update it)
+    '''
+    table = self.get_table(key, revalidate=True)
+    if isinstance(table, ColumnarTable):
+      self._evict(key)
+      table = self._loads.do(key, lambda: self._load_table(key, by_column=False))
+    return table
+
+  # --- Catalogue (see table_catalogue.py) --- #
+
+  def read_catalogue(self) -> Dict[str, dict]:
+    '''
+    Return the catalogue: a dictionary table key -> {schema, row_count, size, etag,
+    columnar}.  Costs one get_meta if the cached copy is current.
+    '''
+    return self.catalogue.read()
+
+  def rebuild_catalogue(self) -> Dict[str, dict]:
+    '''
+    Rewrite the catalogue from the tables in storage, and return it
+    '''
+    return self.catalogue.rebuild()
+
+  def _describe_table(self, key: str) -> dict:
+    # A catalogue entry for a table which is missing from the catalogue
+    blob_meta = self.storage_manager.get_meta(key)
+    if blob_meta is None:
+      raise GDPNotFoundException(key)
+    sidecar = read_sidecar(self.storage_manager, key, blob_meta)
+    if sidecar is None:
+      table = self.get_table(key)
+      row_count = len(table.rows) if isinstance(table, RowTable) else None
+      sidecar = {'schema': table.schema, 'row_count': row_count}
+    return catalogue_entry(sidecar, blob_meta)
+
+  def _describe_tables(self) -> Dict[str, dict]:
+    tables = {}
+    for key in self.list_tables():
+      try:
+        tables[key] = self._describe_table(key)
+      except GDPNotFoundException:
+        pass
+    return tables
+
+  def preview(self, key: str, head: int = PREVIEW_ROWS, tail: int = PREVIEW_ROWS) -> dict:
+    '''
+    Return the first head and last tail rows of the table at key, without copying the
+    table.  Served from the column sidecar when the table isn't in memory.
+    Arguments:
+      key: the table key
+      head: the number of rows from the start of the table
+      tail: the number of rows from the end of the table
+    Returns:
+      {"schema": schema, "row_count": number of rows, "head": rows, "tail": rows}.  If
+      the table has no more than head + tail rows, they are all in head and tail is empty.
+    Raises:
+      GDPNotFoundException if there is no table at key
+    '''
+    with self._lock:
+      cached = self.table_server.servers.get(key)
+    if not isinstance(cached, RowTable) and head <= PREVIEW_ROWS and tail <= PREVIEW_ROWS:
+      blob_meta = self._table_meta(key)
+      with METRICS.stage('storage_meta'):
+        segments_meta = self._segments_meta(key)
+      pending = segments_meta is not None and pending_segments(read_manifest(self.storage_manager, key)[1], blob_meta)
+      sidecar = None if pending else read_sidecar(self.storage_manager, key, blob_meta)
+      if sidecar is not None and 'head' in sidecar:
+        if len(sidecar['tail']) == 0:
+          # the sidecar holds the whole table
+          (head_rows, tail_rows) = head_and_tail(sidecar['head'], head, tail)
+        else:
+          (head_rows, tail_rows) = (sidecar['head'][:head], sidecar['tail'][len(sidecar['tail']) - tail:] if tail > 0 else [])
+        return {'schema': sidecar['schema'], 'row_count': sidecar['row_count'], 'head': head_rows, 'tail': tail_rows}
+    table = self.get_table(key)
+    rows = table.rows if isinstance(table, RowTable) else table.get_filtered_rows()
+    (head_rows, tail_rows) = head_and_tail(rows, head, tail)
+    return {'schema': table.schema, 'row_count': len(rows), 'head': head_rows, 'tail': tail_rows}
+
+  def preview_if_permitted(self, key, user, user_is_hub_user, head: int = PREVIEW_ROWS, tail: int = PREVIEW_ROWS) -> dict:
+    '''
+    As preview, after checking that user may access the table.
+    Raises GDPNotFoundException or GDPNotPermittedException as appropriate.
+    '''
+    result = self.preview(key, head, tail)
+    if not self.table_access_permitted(key, user, user_is_hub_user):
+      raise GDPNotPermittedException(key, user)
+    return result
+
+  TABLE_SORT_FIELDS = ('key', 'name', 'owner', 'row_count', 'size')
+
+  def list_tables_page(self, user, user_is_hub_user, prefix: Optional[str] = None, search: Optional[str] = None,
+                       sort: str = 'key', descending: bool = False, start: int = 0, limit: int = 50) -> dict:
+    '''
+    One page of the tables user can access.  The tables are the keys in storage; their
+    row counts and sizes come from the catalogue.  Tables the catalogue is missing are
+    described from storage and added to it, and entries for tables which no longer exist
+    are dropped from it.
+    Arguments:
+      user: the user listing tables
+      user_is_hub_user: True iff the user is an accredited hub user
+      prefix: if given, only keys starting with prefix
+      search: if given, only keys containing search (case-insensitive)
+      sort: one of TABLE_SORT_FIELDS; tables without the field sort last
+      descending: reverse the sort
+      start: position in the sorted, searched list of tables to start from (the "next"
+        of the previous page)
+      limit: the maximum number of tables on the page
+    Returns:
+      {"tables": [{"key", "owner", "name", "row_count", "size"}], "next": the start of the
+      next page, or None if this is the last page}.  Only as many permission records
+      as it takes to fill the page are read.
+    Raises:
+      InvalidDataException if sort, start or limit is invalid
+    '''
+    if sort not in self.TABLE_SORT_FIELDS:
+      raise InvalidDataException(f'sort must be one of {self.TABLE_SORT_FIELDS}, not {sort}')
+    if start < 0 or limit <= 0:
+      raise InvalidDataException('start must be non-negative and limit positive')
+    needle = search.lower() if search else None
+    keys = [key for key in self.list_tables(prefix) if not needle or needle in key.lower()]
+    (meta, catalogue) = self.catalogue.read_with_meta()
+    if meta is None:
+      catalogue = self.rebuild_catalogue()
+    listed = set(keys)
+    missing: Dict[str, Optional[dict]] = {key: None for key in catalogue if key not in listed and key.startswith(prefix or '') and (not needle or needle in key.lower())}
+    entries = []
+    for key in keys:
+      entry = catalogue.get(key)
+      if entry is None:
+        try:
+          entry = missing[key] = self._describe_table(key)
+        except GDPNotFoundException:
+          continue
+      (table_owner, _, name) = key.partition('/')
+      entries.append({'key': key, 'owner': table_owner, 'name': name, 'row_count': entry.get('row_count'), 'size': entry.get('size')})
+    present = [entry for entry in entries if entry[sort] is not None]
+    present.sort(key=lambda entry: (entry[sort], entry['key']), reverse=descending)
+    entries = present + sorted([entry for entry in entries if entry[sort] is None], key=lambda entry: entry['key'])
+    if missing:
+      self.catalogue.update(missing)
+    page = []
+    position = start
+    while position < len(entries) and len(page) < limit:
+      if self.table_access_permitted(entries[position]['key'], user, user_is_hub_user):
+        page.append(entries[position])
+      position += 1
+    return {'tables': page, 'next': position if position < len(entries) else None}
+
+  def download_source(self, key: str, user, user_is_hub_user):
+    '''
+    Decide how to send the table at key to user, without loading it if possible.
+    Returns:
+      (meta, None) if the stored object is exactly the table's serialized form and can
+      be streamed as it is (meta is its ObjectMeta), or (None, table) if the table must
+      be serialized: it has appended rows not yet compacted into the stored object, or
+      the stored object holds declared indexes or the uploader's formatting
+    Raises:
+      GDPNotFoundException or GDPNotPermittedException as appropriate
+    '''
+    blob_meta = self._table_meta(key)
+    if not self.table_access_permitted(key, user, user_is_hub_user):
+      raise GDPNotPermittedException(key, user)
+    (segments_meta, manifest) = read_manifest(self.storage_manager, key)
+    if pending_segments(manifest, blob_meta):
+      return (None, self.get_table(key))
+    sidecar = read_sidecar(self.storage_manager, key, blob_meta)
+    if sidecar is None or not sidecar.get('serialized'):
+      return (None, self.get_table(key))
+    return (blob_meta, None)
+
+  def get_table_schema(self, key: str) -> list:
+    '''
+    Return the schema of the table at key without loading its rows, if possible.
+    Raises:
+      GDPNotFoundException if there is no table at key
+    '''
+    with self._lock:
+      cached = key in self.table_server.servers
+    if not cached:
+      blob_meta = self._table_meta(key)
+      try:
+        sidecar = read_sidecar(self.storage_manager, key, blob_meta)
+      except ValueError:
+        sidecar = None
+      if sidecar is not None:
+        return sidecar['schema']
+    return self.get_table(key).schema
+
+  def get_table_schema_if_permitted(self, key, user, user_is_hub_user) -> list:
+    '''
+    As get_table_if_permitted, but returns only the schema (see get_table_schema).
+    Raises GDPNotFoundException or GDPNotPermittedException as appropriate.
+    '''
+    schema = self.get_table_schema(key)
+    if not self.table_access_permitted(key, user, user_is_hub_user):
+      raise GDPNotPermittedException(key, user)
+    return schema
+
+  def _segments_meta(self, key):
+    try:
+      return self.storage_manager.get_meta(segments_key(key))
+    except ValueError:
+      return None
+
+  # --- Incremental updates --- #
+
+  def _typed_rows(self, table, rows):
+    if not isinstance(table, RowTable):
+      raise InvalidDataException(f'Rows can only be added to a RowTable, not a {type(table).__name__}')
+    if not isinstance(rows, list) or any(not isinstance(row, list) or len(row) != len(table.schema) for row in rows):
+      raise InvalidDataException(f'rows must be a list of lists of length {len(table.schema)}')
+    return convert_rows_to_type_list(table.column_types(), rows)
+
+  def _positions_for(self, key, table, key_column):
+    '''
+    The map value -> row index of key_column in table, built on first use and then
+    kept up to date by _apply_segment
+    '''
+    cached = self._key_positions.get(key)
+    if cached is not None and cached[0] is table and cached[1] == key_column:
+      return cached[2]
+    column_index = table.column_names().index(key_column)
+    positions = {row[column_index]: i for (i, row) in enumerate(table.rows)}
+    self._key_positions[key] = (table, key_column, positions)
+    return positions
+
+  def _apply_segment(self, key, table, segment):
+    '''
+    Merge a segment into the in-memory table.  Costs O(rows in the segment), apart from
+    building the key-column map on the first patch of a table.
+    '''
+    rows = self._typed_rows(table, segment['rows'])
+    with self._lock:
+      indexes = self._indexes.get(key)
+      if indexes is not None and indexes.table is not table:
+        indexes = None
+      if segment.get('op') == 'patch':
+        positions = self._positions_for(key, table, segment['key_column'])
+        position_column = table.column_names().index(segment['key_column'])
+      else:
+        cached = self._key_positions.get(key)
+        if cached is not None and cached[0] is table:
+          (positions, position_column) = (cached[2], table.column_names().index(cached[1]))
+        else:
+          (positions, position_column) = (None, None)
+      merge_segment(table, rows, segment, positions, position_column, indexes)
+
+  def _add_segment(self, key, user, segment):
+    '''
+    Store segment as the next update of the table at key and merge it into the cached
+    table.  Only the owner may update a table.  Returns the new number of rows.
+    The segment is stored under a key of its own, and then added to the manifest with a
+    conditional write; if another writer replaced the manifest first, the manifest is
+    read again and the write retried.
+    Raises:
+      GDPTableBusyException if the table is kept busy by other writers
+    '''
+    perm_record = self.get_permissions_record(key)
+    if perm_record.owner != user:
+      raise GDPNotOwnerException(key, perm_record.owner, user)
+    with self._write_lock(key), self._lease(key):
+      table = self._get_row_table(key)
+      self._typed_rows(table, segment['rows'])
+      if segment.get('op') == 'patch' and segment.get('key_column') not in table.column_names():
+        raise InvalidDataException(f'{segment.get("key_column")} is not a column of {key}')
+      with self._lock:
+        base_meta = self._cache_meta.get(key)
+        loaded_segments = self._cache_segments.get(key)
+      seg_key = segment_key(key)
+      self.storage_manager.put_object(seg_key, dumps(segment, default=json_serialize))
+      for attempt in range(UPDATE_ATTEMPTS):
+        if attempt > 0 or base_meta is None:
+          # The base may have been rewritten too (or evicted from the cache)
+          base_meta = self._table_meta(key)
+        (segments_meta, manifest) = read_manifest(self.storage_manager, key)
+        if manifest is None or manifest.get('base_etag') != base_meta.etag:
+          manifest = {'base_etag': base_meta.etag, 'segments': []}
+        manifest = {'base_etag': base_meta.etag, 'segments': manifest['segments'] + [seg_key]}
+        new_segments_meta = self.storage_manager.put_object_if_match(segments_key(key), dumps(manifest), segments_meta)
+        if new_segments_meta is not None:
+          break
+      else:
+        self.storage_manager.delete_object(seg_key)
+        raise GDPTableBusyException(key)
+      with self._lock:
+        current = self._cache_meta.get(key) is base_meta and self._cache_segments.get(key) == loaded_segments
+      if current and loaded_segments == (segments_meta.etag if segments_meta else None):
+        # The cached table is the one the manifest described: just add the segment
+        self._apply_segment(key, table, segment)
+        self._cache_table(key, table, base_meta, new_segments_meta.etag)
+      else:
+        # Other writers got in first; reload their updates along with this one
+        self._evict(key)
+        table = self._get_row_table(key)
+      if len(manifest['segments']) >= COMPACT_SEGMENTS:
+        self._start_compaction(key)
+      self.journal.record(key, 'update')
+      return len(table.rows)
+
+  def append_rows(self, key: str, user: str, rows: list) -> int:
+    '''
+    Append rows to the table at key without rewriting it.
+    Arguments:
+      key: the table key
+      user: the user making the change; must be the owner
+      rows: list of rows, each a list of values in schema order
+    Returns:
+      The number of rows in the table after the append
+    Raises:
+      GDPNotFoundException, GDPNotOwnerException, InvalidDataException, GDPTableBusyException
+    '''
+    return self._add_segment(key, user, {'op': 'append', 'rows': rows})
+
+  def patch_rows(self, key: str, user: str, rows: list, key_column: str) -> int:
+    '''
+    Upsert rows into the table at key: each row replaces the existing row with the same
+    value in key_column, or is appended if there is none.
+    Arguments:
+      key: the table key
+      user: the user making the change; must be the owner
+      rows: list of rows, each a list of values in schema order
+      key_column: the column identifying rows
+    Returns:
+      The number of rows in the table after the patch
+    Raises:
+      GDPNotFoundException, GDPNotOwnerException, InvalidDataException, GDPTableBusyException
+    '''
+    return self._add_segment(key, user, {'op': 'patch', 'key_column': key_column, 'rows': rows})
+
+  def _start_compaction(self, key):
+    with self._lock:
+      if key in self._compacting:
+        return
+      self._compacting.add(key)
+    threading.Thread(target=self._compact_in_background, args=(key,), daemon=True).start()
+
+  def _compact_in_background(self, key):
+    try:
+      self.compact_table(key)
+    except Exception:
+      pass
+    finally:
+      with self._lock:
+        self._compacting.discard(key)
+
+  def compact_table(self, key: str) -> None:
+    '''
+    Rewrite the base object of the table at key with all its rows, and drop its segments.
+    The base is replaced with a conditional write, so a table republished meanwhile
+    isn't overwritten.  Segments which reached the manifest after it was read (only
+    possible if a writer overran its lease) are carried over to the new base.
+    Raises:
+      GDPTableBusyException if the table is kept busy by other writers
+    '''
+    with self._write_lock(key), self._lease(key):
+      table = self._get_row_table(key)
+      with self._lock:
+        base_meta = self._cache_meta.get(key)
+        loaded_segments = self._cache_segments.get(key)
+      (segments_meta, manifest) = read_manifest(self.storage_manager, key)
+      if base_meta is None or segments_meta is None or not pending_segments(manifest, base_meta) or segments_meta.etag != loaded_segments:
+        return
+      table_data = table.to_dictionary()
+      with self._lock:
+        declared = self._declared_indexes.get(key)
+      if declared:
+        table_data['indexes'] = declared
+      # Readers ignore the manifest as soon as the base changes, since it names the old base
+      new_base_meta = self.storage_manager.put_object_if_match(key, dumps(table_data, default=json_serialize), base_meta)
+      if new_base_meta is None:
+        return
+      compacted = manifest['segments']
+      carried_over = []
+      for attempt in range(UPDATE_ATTEMPTS):
+        if manifest is None or manifest.get('base_etag') != base_meta.etag or manifest['segments'][:len(compacted)] != compacted:
+          break
+        carried_over = manifest['segments'][len(compacted):]
+        remaining = {'base_etag': new_base_meta.etag, 'segments': carried_over}
+        if self.storage_manager.put_object_if_match(segments_key(key), dumps(remaining), segments_meta) is not None:
+          break
+        (segments_meta, manifest) = read_manifest(self.storage_manager, key)
+      if not carried_over:
+        self.storage_manager.delete_object(segments_key(key))
+      for seg_key in compacted:
+        self.storage_manager.delete_object(seg_key)
+      self._write_columns(key, table_data, declared or {}, not declared)
+      if carried_over:
+        self._evict(key)
+      else:
+        self._cache_table(key, table, new_base_meta, None)
+      self.journal.record(key, 'compact')
+
+  # --- Secondary indexes --- #
+
+  def _build_indexes(self, table, declared: dict) -> TableIndexes:
+    indexes = TableIndexes(table)
+    for (column, kind) in declared.items():
+      indexes.build(column, kind)
+    return indexes
+
+  def _validate_indexes(self, table, declared) -> None:
+    if not isinstance(declared, dict):
+      raise InvalidDataException('indexes must be a dictionary {column: "hash" | "sorted"}')
+    if declared and not isinstance(table, RowTable):
+      raise InvalidDataException(f'Indexes can only be declared on a RowTable, not a {type(table).__name__}')
+    columns = table.column_names()
+    for (column, kind) in declared.items():
+      if column not in columns:
+        raise InvalidDataException(f'Cannot index {column}, which is not a column of the table')
+      if kind not in INDEX_KINDS:
+        raise InvalidDataException(f'Index kind must be one of {INDEX_KINDS}, not {kind}')
+
+  def _note_scan(self, key, table, filter) -> None:
+    '''
+    Record that filter had to scan table, and index the columns it uses once they are hot:
+    once INDEX_HOT_QUERIES scans of a table of at least INDEX_MIN_ROWS rows have used them.
+    An index is built under the table's write lock, so no update changes the rows while
+    it is read; if an update is in progress the build is left to a later scan.
+    '''
+    if INDEX_HOT_QUERIES <= 0 or len(table.rows) < INDEX_MIN_ROWS:
+      return
+    wanted = indexable_columns(filter)
+    if not wanted:
+      return
+    hot = []
+    with self._lock:
+      counts = self._scan_counts.setdefault(key, {})
+      for (column, kind) in wanted.items():
+        counts[(column, kind)] = counts.get((column, kind), 0) + 1
+        if counts[(column, kind)] >= INDEX_HOT_QUERIES:
+          hot.append((column, kind))
+          del counts[(column, kind)]
+      indexes = self._indexes.get(key)
+      if indexes is None or indexes.table is not table:
+        indexes = self._indexes[key] = TableIndexes(table)
+    if not hot:
+      return
+    write_lock = self._write_lock(key)
+    if not write_lock.acquire(blocking=False):
+      with self._lock:
+        for (column, kind) in hot:
+          counts[(column, kind)] = INDEX_HOT_QUERIES - 1
+      return
+    try:
+      for (column, kind) in hot:
+        with METRICS.stage('index'):
+          indexes.build(column, kind)
+    finally:
+      write_lock.release()
+
+  def _matching_rows(self, key: str, table, filter_spec) -> list:
+    '''
+    The rows of table (all columns, in table order) which match filter_spec, using the
+    table's secondary indexes where they apply
+    '''
+    if not isinstance(table, RowTable):
+      return table.get_filtered_rows(filter_spec=filter_spec, columns=[], format='list')
+    if filter_spec is None:
+      return table.rows
+    filter = make_filter(filter_spec)
+    column_names = table.column_names()
+    with self._lock:
+      indexes = self._indexes.get(key)
+    # The lookup holds only the table's own index lock
+    candidates = indexes.candidate_positions(filter) if indexes is not None and indexes.table is table else None
+    rows = table.rows
+    if candidates is None:
+      self._note_scan(key, table, filter)
+      return [row for row in rows if filter.matches(row, column_names)]
+    return [rows[position] for position in sorted(candidates) if filter.matches(rows[position], column_names)]
+
+  def _check_format(self, format):
+    if format is None:
+      return DEFAULT_FILTERED_ROW_RESULT_FORMAT
+    if format not in ALLOWED_FILTERED_ROW_RESULT_FORMATS:
+      raise InvalidDataException(f'format for get_filtered rows must be one of {ALLOWED_FILTERED_ROW_RESULT_FORMATS}, not {format}')
+    return format
+
+  def filter_rows(self, key: str, table, filter_spec=None, columns=None, format=DEFAULT_FILTERED_ROW_RESULT_FORMAT):
+    '''
+    The equivalent of table.get_filtered_rows(filter_spec, columns, format), answered from
+    the table's secondary indexes when it has indexes the filter can use.
+    Arguments:
+      key: the key of the table
+      table: the table, as returned by get_table
+      filter_spec: the SDQL filter spec, or None for all rows
+      columns: the columns to return; all columns if empty or None
+      format: one of 'list', 'dict', 'sdml'
+    Returns:
+      The matching rows, in table order, in the requested format
+    Raises:
+      InvalidDataException if the filter or the format is invalid
+    '''
+    if filter_spec is None or not isinstance(table, RowTable):
+      return table.get_filtered_rows(filter_spec=filter_spec, columns=columns, format=format)
+    format = self._check_format(format)
+    matches = self._matching_rows(key, table, filter_spec)
+    return _convert_filter_result_to_format(matches, columns if columns else table.column_names(), table.schema, format)
+
+  def aggregate(self, key: str, table, filter_spec=None, group_by=None, aggregates=None, format=DEFAULT_FILTERED_ROW_RESULT_FORMAT):
+    '''
+    Filter the rows of table by filter_spec, group them by the group_by columns and
+    compute aggregates over each group (see aggregate.py).
+    Arguments:
+      key: the key of the table
+      table: the table, as returned by get_table
+      filter_spec: the SDQL filter spec, or None for all rows
+      group_by: list of columns to group by; None or empty for a single group
+      aggregates: list of {"function": ..., "column": ..., "name": ...} specifications
+      format: one of 'list', 'dict', 'sdml'
+    Returns:
+      One row per group (the group-by values followed by the aggregates) in the requested format
+    Raises:
+      InvalidDataException if any of the arguments is invalid
+    '''
+    format = self._check_format(format)
+    if isinstance(table, RowTable):
+      (schema, rows) = (table.schema, self._matching_rows(key, table, filter_spec))
+    else:
+      # Read only the columns the aggregation uses
+      used = set(group_by or []) | {aggregate.get('column') for aggregate in aggregates or [] if isinstance(aggregate, dict)}
+      schema = [entry for entry in table.schema if entry['name'] in used] or table.schema[:1]
+      rows = table.get_filtered_rows(filter_spec=filter_spec, columns=[entry['name'] for entry in schema], format='list')
+    (result_schema, result_rows) = aggregate_rows(rows, schema, group_by, aggregates)
+    return _convert_filter_result_to_format(result_rows, [entry['name'] for entry in result_schema], result_schema, format)
 
   def table_exists(self, key: str) -> bool:
     '''
     Return true iff the table exists
     '''
-    return self.storage_manager.key_exists(key)
+    (missing, _) = self._missing.lookup(key)
+    if missing:
+      return False
+    exists = self.storage_manager.key_exists(key)
+    if not exists:
+      self._missing.put(key, True)
+    return exists
     
   def list_tables(self, user: Optional[str] = None) -> List[str]:
     '''
@@ -116,7 +929,8 @@ class GDPTableManager:
     Return the PermissionsRecord for the table at key.  The table is at <foo>.sdml,
     and the permission record is at <foo>.perm.  Returns the stored PermissionRecord if
     there is one and it's valid.  If not, it returns the default PermissionRecord for
-    a table, which has the table key and the owner, and a blank user and role list
+    a table, which has the table key and the owner, and a blank user and role list.
+    A missing permission record is remembered, so it isn't fetched again for a while.
     Arguments:
       key: key for the table
     Returns:
@@ -128,9 +942,13 @@ class GDPTableManager:
       permissions_key = perm_key(key)
     except ValueError:
       raise GDPNotFoundException(key)
-    stored_permissions = self.storage_manager.get_object(permissions_key)
+    (missing, _) = self._missing.lookup(permissions_key)
+    METRICS.count_cache('permission', missing)
+    stored_permissions = None if missing else self.storage_manager.get_object(permissions_key)
     new_permissions_record =  PermissionRecord(key=key, owner=owner(key), users=[], roles=[])
     if stored_permissions is None:
+      if not missing:
+        self._missing.put(permissions_key, True)
       return new_permissions_record
     try:
       if isinstance(stored_permissions, str):
@@ -152,7 +970,8 @@ class GDPTableManager:
     Returns: 
       True if permitted, False otherwise
     '''
-    permissions_record = self.get_permissions_record(gdp_table_key)
+    with METRICS.stage('permission'):
+      permissions_record = self.get_permissions_record(gdp_table_key)
     return user == permissions_record.owner or user in permissions_record.users or 'PUBLIC' in permissions_record.users or user_is_hub_user and 'HUB' in permissions_record.users
     
   def all_user_tables(self, user, is_hub_user):
@@ -204,6 +1023,8 @@ class GDPTableManager:
     permissions_key = perm_key(key)
     # Save updated permission record
     self.storage_manager.put_object(permissions_key, dump_permission(perm_record))
+    self._missing.invalidate(permissions_key)
+    self.journal.record(key, 'access')
 
   def get_user_access(self, key: str, user: str):
     perm_record =  self.get_permissions_record(key)
@@ -226,30 +1047,55 @@ class GDPTableManager:
     Store a table in the repository and update permissions.
     Parameters:
       key: the table  to store (owner/name.sdml)
-      table_data: a JSON string or dict (table data)
-     
+      table_data: a JSON string or dict (table data).  An optional "indexes" entry,
+        {"<column>": "hash" | "sorted"}, declares secondary indexes for the table
+    Raises:
+      InvalidDataException if the declared indexes are invalid
+      GDPTableBusyException if the table is kept busy by other writers
     '''
     table_to_write = table_data if type(table_data) == str else dumps(table_data, indent=2)
     table_to_load = loads(table_to_write)
     self._validate_table(table_to_load)
-    self.table_server.add_sdtp_table_from_dictionary(key, table_to_load)
-    self.storage_manager.put_object(key, table_to_write)
-    self._cache_meta[key] = self.storage_manager.get_meta(key)
+    table = TableBuilder.build_table(table_to_load)
+    declared = table_to_load.get('indexes') or {}
+    self._validate_indexes(table, declared)
+    indexes = self._build_indexes(table, declared) if declared else None
+    serialized = dumps(table.to_dictionary(), default=json_serialize)
+    if isinstance(table, RowTable) and not declared:
+      # Stored in its serialized form, so downloads can send it as it is
+      table_to_write = serialized
+    with self._write_lock(key), self._lease(key):
+      (segments_meta, manifest) = read_manifest(self.storage_manager, key)
+      self.storage_manager.put_object(key, table_to_write)
+      self._missing.invalidate(key)
+      self._evict(key)
+      delete_segments(self.storage_manager, key, manifest)
+      base_meta = self._write_columns(key, table_to_load, declared, table_to_write == serialized)
+      with self._lock:
+        self._declared_indexes[key] = declared
+        if indexes is not None:
+          self._indexes[key] = indexes
+      self._cache_table(key, table, base_meta)
+      self.journal.record(key, 'publish')
 
   def delete_table(self, key):
     '''
     Delete a table from storage, permissions, and in-memory server.
-    Raises GDPNotFoundException if it doesn't exist.
+    Raises GDPNotFoundException if it doesn't exist, GDPTableBusyException if it is
+    kept busy by other writers.
     '''
     if not self.table_exists(key):
       raise GDPNotFoundException(f'table {key} does not exist')
-    self.storage_manager.delete_object(key)
-    permissions_key = perm_key(key)
-    self.storage_manager.delete_object(permissions_key)
-    if key in self.table_server.servers:
-      del self.table_server.servers[key]
-    if key in self._cache_meta:
-      del self._cache_meta[key]
+    with self._write_lock(key), self._lease(key):
+      (segments_meta, manifest) = read_manifest(self.storage_manager, key)
+      self.storage_manager.delete_object(key)
+      permissions_key = perm_key(key)
+      self.storage_manager.delete_object(permissions_key)
+      delete_segments(self.storage_manager, key, manifest)
+      delete_columns(self.storage_manager, key)
+      self.catalogue.update({key: None})
+      self._evict(key)
+      self.journal.record(key, 'delete')
 
 
   def clean_tables(self, user = None):
@@ -265,11 +1111,22 @@ class GDPTableManager:
     '''
     Get URLs/schemas for all tables accessible to this user.
     Returns a dict mapping table name to schema.
+    The schemas come from the catalogue; tables missing from it are described from
+    storage and added to it.
     '''
     table_names = self.list_tables()
     accessible_tables = [name for name in table_names if self.table_access_permitted(name, user, user_is_hub_user)]
+    catalogue = self.read_catalogue()
     result = {}
+    missing = {}
     for name in accessible_tables:
-      table = self.get_table(name)
-      result[name] = table.schema
+      entry = catalogue.get(name)
+      if entry is None:
+        try:
+          entry = missing[name] = self._describe_table(name)
+        except GDPNotFoundException:
+          continue
+      result[name] = entry['schema']
+    if missing:
+      self.catalogue.update(missing)
     return result
@@ -0,0 +1,60 @@
+'''
+gunicorn_conf.py -- Production server configuration for the GDP table repo.
+
+Run with:
+  gunicorn -c python:src.gunicorn_conf 'src.app:create_app()'
+
+Every setting is tunable from the environment (see the GDP_* variables in src/config.py).
+The defaults use a small number of processes with several threads each: every worker
+process holds its own in-memory table cache, so threads (which share the cache) are much
+cheaper than extra processes.
+'''
+import os
+import tempfile
+from src.config import (
+  GDP_BIND, GDP_WORKERS, GDP_THREADS, GDP_WORKER_TIMEOUT, GDP_GRACEFUL_TIMEOUT,
+  GDP_KEEPALIVE, GDP_MAX_REQUESTS, GDP_MAX_REQUESTS_JITTER, GDP_PRELOAD_APP, METRICS_DIR
+)
+from src.metrics import METRICS
+
+bind = GDP_BIND
+worker_class = 'gthread'
+workers = GDP_WORKERS
+threads = GDP_THREADS
+
+# Import the app, and build the storage clients, once in the master before forking
+preload_app = GDP_PRELOAD_APP
+
+# Recycle workers periodically to bound memory growth; the jitter keeps the
+# workers from all restarting at the same moment
+max_requests = GDP_MAX_REQUESTS
+max_requests_jitter = GDP_MAX_REQUESTS_JITTER
+
+# On SIGTERM a worker stops accepting connections and gets graceful_timeout seconds
+# to finish the requests (including streamed downloads) it is already serving
+timeout = GDP_WORKER_TIMEOUT
+graceful_timeout = GDP_GRACEFUL_TIMEOUT
+keepalive = GDP_KEEPALIVE
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+  # The workers share their metrics through one directory, so that /metrics reports the
+  # whole server whichever worker serves it.  The environment variable reaches workers
+  # which import the app themselves (preload_app off).
+  directory = METRICS_DIR or tempfile.mkdtemp(prefix='gdp-metrics-')
+  os.environ['GDP_METRICS_DIR'] = directory
+  METRICS.share(directory)
+
+
+def worker_exit(server, worker):
+  # Runs in the worker: leave its final snapshot for the master to fold in
+  METRICS.write_snapshot()
+  server.log.info(f'worker {worker.pid} exited')
+
+
+def child_exit(server, worker):
+  # Runs in the master
+  METRICS.retire_worker(worker.pid)
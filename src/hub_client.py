@@ -0,0 +1,92 @@
+'''
+hub_client.py -- The shared HTTP connection pool for JupyterHub API traffic.
+
+All calls to HUB_API_URL go through one HubClient, which keeps connections alive
+between requests, applies connect/read timeouts, retries idempotent requests on
+connection errors and gateway failures with exponential backoff, and keeps simple
+counters of what it has done.
+'''
+import threading
+import time
+from typing import Dict, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HubClient:
+  '''
+  A pooled, keep-alive HTTP client for the JupyterHub REST API.
+  Arguments:
+    api_url: the hub API root, e.g. https://hub.example.org/hub/api
+    pool_size: maximum number of connections kept open to the hub
+    connect_timeout: seconds to wait for a connection
+    read_timeout: seconds to wait for a response
+    retries: number of retries for failed idempotent requests
+    backoff: backoff factor; retry n waits backoff * 2**(n-1) seconds
+  '''
+  def __init__(
+      self,
+      api_url: str,
+      pool_size: int = 20,
+      connect_timeout: float = 3.05,
+      read_timeout: float = 10.0,
+      retries: int = 2,
+      backoff: float = 0.1
+  ):
+    self.api_url = api_url.rstrip('/')
+    self.timeout = (connect_timeout, read_timeout)
+    retry = Retry(
+      total=retries,
+      connect=retries,
+      read=retries,
+      status=retries,
+      backoff_factor=backoff,
+      status_forcelist=(502, 503, 504),
+      allowed_methods=frozenset(['GET', 'HEAD']),
+      raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry, pool_block=False)
+    self.session = requests.Session()
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self._stats_lock = threading.Lock()
+    self._stats = {'requests': 0, 'errors': 0, 'seconds': 0.0}
+    self._status_counts: Dict[int, int] = {}
+
+  def get(self, path: str, token: str, timeout: Optional[tuple] = None) -> requests.Response:
+    '''
+    GET path (relative to the api url) using token for authorization.
+    Raises requests.RequestException if the hub can't be reached after retries.
+    '''
+    headers = {'Authorization': f'token {token}'}
+    start = time.perf_counter()
+    try:
+      response = self.session.get(f'{self.api_url}/{path.lstrip("/")}', headers=headers, timeout=timeout or self.timeout)
+    except requests.RequestException:
+      self._record(time.perf_counter() - start, None)
+      raise
+    self._record(time.perf_counter() - start, response.status_code)
+    return response
+
+  def _record(self, elapsed: float, status: Optional[int]) -> None:
+    with self._stats_lock:
+      self._stats['requests'] += 1
+      self._stats['seconds'] += elapsed
+      if status is None or status >= 500:
+        self._stats['errors'] += 1
+      if status is not None:
+        self._status_counts[status] = self._status_counts.get(status, 0) + 1
+
+  def stats(self) -> Dict:
+    '''
+    Return a snapshot of the request counters: total requests, errors (connection
+    failures and 5xx responses), total seconds spent, and counts by status code.
+    '''
+    with self._stats_lock:
+      result = dict(self._stats)
+      result['status_counts'] = dict(self._status_counts)
+      return result
+
+  def close(self) -> None:
+    self.session.close()
@@ -0,0 +1,154 @@
+'''
+log_config.py -- Non-blocking logging for the GDP.
+
+configure_logging() routes every record through a QueueHandler on the root logger into an
+in-memory queue; a QueueListener thread formats the records and writes them to stdout.
+A request thread never waits on the stream.  Records are written either as text or, with
+LOG_FORMAT=json, as one JSON object per line, carrying any extra= fields.
+
+Levels are set per logger: LOG_LEVEL for the root, and LOG_LEVELS for individual modules,
+e.g. "src.routes.repo=DEBUG,werkzeug=WARNING".  Modules log through
+logging.getLogger(__name__) with %-style arguments, so a debug call below the level
+costs one isEnabledFor check and formats nothing.
+
+The listener thread doesn't survive a fork, so it is restarted in each forked worker
+(gunicorn preloads the app in the master).
+'''
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Dict, Optional
+from src.config import LOG_LEVEL, LOG_LEVELS, LOG_FORMAT
+
+# The attributes every LogRecord has; any others came from extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', logging.INFO, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_queue: queue.SimpleQueue = queue.SimpleQueue()
+_queue_handler: Optional[logging.Handler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_configured_levels: Dict[str, int] = {}
+
+
+class JsonFormatter(logging.Formatter):
+  '''
+  Formats a record as one line of JSON: time, level, logger, message, any extra fields,
+  and the traceback if there is one
+  '''
+  def format(self, record: logging.LogRecord) -> str:
+    entry = {
+      'time': self.formatTime(record),
+      'level': record.levelname,
+      'logger': record.name,
+      'message': record.getMessage()
+    }
+    for (name, value) in vars(record).items():
+      if name not in _RECORD_ATTRIBUTES and not name.startswith('_'):
+        entry[name] = value
+    if record.exc_info:
+      entry['exception'] = self.formatException(record.exc_info)
+    elif record.exc_text:
+      entry['exception'] = record.exc_text
+    return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+  '''
+  Enqueues records without formatting them on the caller's thread.  Only the arguments
+  are merged into the message (they may change once the caller moves on) and tracebacks
+  rendered; the time, the layout and the write are left to the listener.
+  '''
+  def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+    record.msg = record.getMessage()
+    record.args = None
+    if record.exc_info and not record.exc_text:
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+    record.exc_info = None
+    record.stack_info = None
+    return record
+
+
+def parse_levels(spec: str) -> Dict[str, int]:
+  '''
+  Parse "logger=LEVEL,logger=LEVEL" into {logger: level}.
+  Raises:
+    ValueError if an entry is malformed or names an unknown level
+  '''
+  levels = {}
+  for entry in spec.split(','):
+    entry = entry.strip()
+    if not entry:
+      continue
+    (name, equals, level) = entry.partition('=')
+    if not equals or not name.strip():
+      raise ValueError(f'Bad log level setting {entry}: expected logger=LEVEL')
+    levels[name.strip()] = _level(level)
+  return levels
+
+
+def _level(name: str) -> int:
+  level = logging.getLevelName(name.strip().upper())
+  if not isinstance(level, int):
+    raise ValueError(f'Unknown log level {name}')
+  return level
+
+
+def _make_formatter() -> logging.Formatter:
+  if LOG_FORMAT == 'json':
+    return JsonFormatter()
+  return logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def _start_listener() -> None:
+  global _listener
+  handler = logging.StreamHandler(sys.stdout)
+  handler.setFormatter(_make_formatter())
+  _listener = logging.handlers.QueueListener(_queue, handler, respect_handler_level=False)
+  _listener.start()
+
+
+def _restart_listener_in_child() -> None:
+  if _listener is not None:
+    _start_listener()
+
+
+def flush() -> None:
+  '''
+  Stop the listener once it has written every queued record, then start it again
+  '''
+  if _listener is not None:
+    _listener.stop()
+    _start_listener()
+
+
+def _stop_listener() -> None:
+  if _listener is not None:
+    _listener.stop()
+
+
+def configure_logging(level: str = LOG_LEVEL, levels: str = LOG_LEVELS) -> None:
+  '''
+  Install the queue handler on the root logger and set the logger levels.  Safe to call
+  more than once: the handler and the listener are installed once per process.
+  Arguments:
+    level: the level of the root logger
+    levels: per-logger levels, "logger=LEVEL,..."
+  '''
+  global _queue_handler
+  root = logging.getLogger()
+  if _queue_handler is None:
+    _queue_handler = _QueueHandler(_queue)
+    root.addHandler(_queue_handler)
+    _start_listener()
+    atexit.register(_stop_listener)
+    os.register_at_fork(after_in_child=_restart_listener_in_child)
+  root.setLevel(_level(level))
+  for name in _configured_levels:
+    logging.getLogger(name).setLevel(logging.NOTSET)
+  _configured_levels.clear()
+  _configured_levels.update(parse_levels(levels))
+  for (name, logger_level) in _configured_levels.items():
+    logging.getLogger(name).setLevel(logger_level)
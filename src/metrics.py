@@ -0,0 +1,377 @@
+'''
+metrics.py -- Lightweight in-process request instrumentation, exposed in the
+Prometheus text format by the /metrics route.
+
+Three families of metrics are kept:
+  gdp_request_seconds{endpoint}         latency histogram for every Flask endpoint
+  gdp_stage_seconds{endpoint, stage}    latency histogram for the stages of a request
+                                        (auth, permission, storage_meta, storage_fetch,
+                                        parse, filter, serialize).  Stages may nest: the
+                                        permission stage includes its storage reads.
+  gdp_cache_requests_total{cache, result}  hits and misses of the server caches
+
+Other modules add counters with add_counter, and keep them up to date with a collector.
+
+Each worker process records into its own registry.  Under gunicorn the workers share
+their metrics through a directory (GDP_METRICS_DIR, set up by gunicorn_conf.py): each
+worker writes a snapshot of its series to worker-<pid>.json every METRICS_SHARE_INTERVAL
+seconds and on exit, and /metrics, whichever worker serves it, renders the sum over
+every snapshot.  When a worker exits, the master folds its snapshot into retired.json,
+so the totals never go backwards as workers are recycled.  Without a directory (the
+development server, tests) the metrics are the process's own, labelled with its pid.
+
+Recording costs two perf_counter calls, one lock and a bisect.  When metrics are
+disabled (GDP_METRICS=false) stage() returns a shared no-op context manager.
+'''
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+from src.config import METRICS_ENABLED, METRICS_DIR, METRICS_SHARE_INTERVAL
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current_endpoint: ContextVar[str] = ContextVar('gdp_endpoint', default='none')
+_NO_OP = nullcontext()
+
+
+def _escape(value) -> str:
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels: Dict) -> str:
+  if not labels:
+    return ''
+  return '{' + ','.join(f'{name}="{_escape(value)}"' for (name, value) in labels.items()) + '}'
+
+
+class Histogram:
+  '''
+  A histogram with fixed upper bounds, one series per label tuple.
+  '''
+  def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.help_text = help_text
+    self.label_names = label_names
+    self.buckets = buckets
+    self._series: Dict[Tuple, List] = {}
+    self._lock = threading.Lock()
+
+  def observe(self, label_values: Tuple, value: float) -> None:
+    index = bisect_left(self.buckets, value)
+    with self._lock:
+      series = self._series.get(label_values)
+      if series is None:
+        # bucket counts (plus +Inf), sum, count
+        series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        self._series[label_values] = series
+      series[0][index] += 1
+      series[1] += value
+      series[2] += 1
+
+  def snapshot(self) -> List:
+    '''
+    The series as [[label values, [bucket counts, sum, count]], ...]
+    '''
+    with self._lock:
+      return [[list(labels), [list(series[0]), series[1], series[2]]] for (labels, series) in self._series.items()]
+
+  @staticmethod
+  def merge(total: Dict, snapshot: List) -> None:
+    for (labels, (counts, value_sum, count)) in snapshot:
+      series = total.setdefault(tuple(labels), [[0] * len(counts), 0.0, 0])
+      series[0] = [a + b for (a, b) in zip(series[0], counts)]
+      series[1] += value_sum
+      series[2] += count
+
+  def render(self, extra_labels: Dict, series: Optional[Dict] = None) -> List[str]:
+    '''
+    The exposition lines of this histogram, or of series (merged snapshots) if given
+    '''
+    lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+    if series is None:
+      with self._lock:
+        snapshot = [(labels, list(data[0]), data[1], data[2]) for (labels, data) in self._series.items()]
+    else:
+      snapshot = [(labels, data[0], data[1], data[2]) for (labels, data) in series.items()]
+    for (label_values, counts, total, count) in snapshot:
+      labels = dict(zip(self.label_names, label_values))
+      labels.update(extra_labels)
+      cumulative = 0
+      for (bound, bucket_count) in zip(list(self.buckets) + ['+Inf'], counts):
+        cumulative += bucket_count
+        lines.append(f'{self.name}_bucket{_format_labels({**labels, "le": bound})} {cumulative}')
+      lines.append(f'{self.name}_sum{_format_labels(labels)} {total}')
+      lines.append(f'{self.name}_count{_format_labels(labels)} {count}')
+    return lines
+
+
+class Counter:
+  '''
+  A monotonically increasing counter, one series per label tuple.
+  '''
+  def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...]):
+    self.name = name
+    self.help_text = help_text
+    self.label_names = label_names
+    self._series: Dict[Tuple, float] = {}
+    self._lock = threading.Lock()
+
+  def inc(self, label_values: Tuple, amount: float = 1) -> None:
+    with self._lock:
+      self._series[label_values] = self._series.get(label_values, 0) + amount
+
+  def set(self, label_values: Tuple, value: float) -> None:
+    '''
+    Set the series to value, for a counter mirroring one kept elsewhere
+    '''
+    with self._lock:
+      self._series[label_values] = value
+
+  def value(self, label_values: Tuple) -> float:
+    with self._lock:
+      return self._series.get(label_values, 0)
+
+  def snapshot(self) -> List:
+    '''
+    The series as [[label values, value], ...]
+    '''
+    with self._lock:
+      return [[list(labels), value] for (labels, value) in self._series.items()]
+
+  @staticmethod
+  def merge(total: Dict, snapshot: List) -> None:
+    for (labels, value) in snapshot:
+      total[tuple(labels)] = total.get(tuple(labels), 0) + value
+
+  def render(self, extra_labels: Dict, series: Optional[Dict] = None) -> List[str]:
+    '''
+    The exposition lines of this counter, or of series (merged snapshots) if given
+    '''
+    lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+    if series is None:
+      with self._lock:
+        snapshot = list(self._series.items())
+    else:
+      snapshot = list(series.items())
+    for (label_values, value) in snapshot:
+      labels = dict(zip(self.label_names, label_values))
+      labels.update(extra_labels)
+      lines.append(f'{self.name}{_format_labels(labels)} {value}')
+    return lines
+
+
+class _StageTimer:
+  def __init__(self, metrics, stage):
+    self.metrics = metrics
+    self.stage = stage
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.metrics.stage_seconds.observe((_current_endpoint.get(), self.stage), time.perf_counter() - self.start)
+    return False
+
+
+class Metrics:
+  '''
+  The registry of all the server's metrics.  There is one per process, METRICS.
+  Arguments:
+    enabled: False to record nothing
+    directory: the directory the workers of a server share their metrics through, or
+      None for this process's metrics only (see share)
+  '''
+  RETIRED = 'retired.json'
+
+  def __init__(self, enabled: bool = True, directory: Optional[str] = None):
+    self.enabled = enabled
+    self.directory = directory or None
+    self.request_seconds = Histogram('gdp_request_seconds', 'Request latency by endpoint', ('endpoint',))
+    self.requests = Counter('gdp_requests_total', 'Requests by endpoint and status', ('endpoint', 'status'))
+    self.stage_seconds = Histogram('gdp_stage_seconds', 'Latency of request stages', ('endpoint', 'stage'))
+    self.cache_requests = Counter('gdp_cache_requests_total', 'Cache lookups by cache and result', ('cache', 'result'))
+    self._families: List = [self.request_seconds, self.requests, self.stage_seconds, self.cache_requests]
+    self._collectors: List[Callable[[], None]] = []
+    self._writer_pid: Optional[int] = None
+    self._writer_lock = threading.Lock()
+
+  def stage(self, name: str):
+    '''
+    Context manager which times the enclosed block as stage name of the current endpoint
+    '''
+    return _StageTimer(self, name) if self.enabled else _NO_OP
+
+  def count_cache(self, cache: str, hit: bool) -> None:
+    if self.enabled:
+      self.cache_requests.inc((cache, 'hit' if hit else 'miss'))
+
+  def observe_request(self, endpoint: str, status: int, seconds: float) -> None:
+    if self.enabled:
+      self.request_seconds.observe((endpoint,), seconds)
+      self.requests.inc((endpoint, str(status)))
+      if self.directory is not None and self._writer_pid != os.getpid():
+        self._start_writer()
+
+  def add_counter(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Counter:
+    '''
+    Add a counter family to the registry, and return it
+    '''
+    counter = Counter(name, help_text, label_names)
+    self._families.append(counter)
+    return counter
+
+  def register_collector(self, collector: Callable[[], None]) -> None:
+    '''
+    Add a function called before the metrics are rendered or written, to bring the
+    families it keeps (see add_counter) up to date
+    '''
+    self._collectors.append(collector)
+
+  def _collect(self) -> Dict[str, List]:
+    for collector in self._collectors:
+      collector()
+    return {family.name: family.snapshot() for family in self._families}
+
+  # --- Sharing between worker processes --- #
+
+  def share(self, directory: str) -> None:
+    '''
+    Share metrics through directory from now on, dropping what an earlier server left
+    there.  Called in the gunicorn master before the workers are forked.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+      if name == self.RETIRED or (name.startswith('worker-') and name.endswith('.json')):
+        os.remove(os.path.join(directory, name))
+    self.directory = directory
+
+  def _write_json(self, directory: str, name: str, data) -> None:
+    (fd, temp_path) = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(data, f)
+    os.replace(temp_path, os.path.join(directory, name))
+
+  def _read_json(self, directory: str, name: str):
+    try:
+      with open(os.path.join(directory, name)) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def write_snapshot(self) -> None:
+    '''
+    Write this worker's series to the shared directory
+    '''
+    if self.enabled and self.directory is not None:
+      self._write_json(self.directory, f'worker-{os.getpid()}.json', self._collect())
+
+  def _start_writer(self) -> None:
+    pid = os.getpid()
+    with self._writer_lock:
+      if self._writer_pid == pid:
+        return
+      self._writer_pid = pid
+    threading.Thread(target=self._write_periodically, args=(pid,), daemon=True).start()
+
+  def _write_periodically(self, pid: int) -> None:
+    while self._writer_pid == pid:
+      time.sleep(METRICS_SHARE_INTERVAL)
+      try:
+        self.write_snapshot()
+      except OSError:
+        pass
+
+  def retire_worker(self, pid: int) -> None:
+    '''
+    Fold the last snapshot of the exited worker pid into the retired totals.  Called by
+    the gunicorn master, the only process which writes them.
+    '''
+    if self.directory is None:
+      return
+    snapshot = self._read_json(self.directory, f'worker-{pid}.json')
+    retired = self._read_json(self.directory, self.RETIRED) or {'workers': [], 'families': {}}
+    if snapshot is not None and pid not in retired['workers']:
+      totals = self._merge([retired['families'], snapshot])
+      retired = {
+        'workers': retired['workers'] + [pid],
+        'families': {name: [[list(labels), data] for (labels, data) in series.items()] for (name, series) in totals.items()}
+      }
+      self._write_json(self.directory, self.RETIRED, retired)
+    try:
+      os.remove(os.path.join(self.directory, f'worker-{pid}.json'))
+    except FileNotFoundError:
+      pass
+
+  def _merge(self, snapshots: List[Dict]) -> Dict[str, Dict]:
+    totals = {family.name: {} for family in self._families}
+    merges = {family.name: family.merge for family in self._families}
+    for snapshot in snapshots:
+      for (name, series) in snapshot.items():
+        if name in merges:
+          merges[name](totals[name], series)
+    return totals
+
+  def _shared_snapshots(self, directory: str) -> List[Dict]:
+    # The retired totals and the snapshot of every worker not yet folded into them
+    retired = self._read_json(directory, self.RETIRED) or {'workers': [], 'families': {}}
+    snapshots = [retired['families']]
+    for name in os.listdir(directory):
+      if name.startswith('worker-') and name.endswith('.json') and int(name[len('worker-'):-len('.json')]) not in retired['workers']:
+        snapshot = self._read_json(directory, name)
+        if snapshot is not None:
+          snapshots.append(snapshot)
+    return snapshots
+
+  def render(self) -> str:
+    lines = []
+    if self.directory is None:
+      self._collect()
+      worker = {'worker': os.getpid()}
+      for family in self._families:
+        lines.extend(family.render(worker))
+    else:
+      self.write_snapshot()
+      totals = self._merge(self._shared_snapshots(self.directory))
+      for family in self._families:
+        lines.extend(family.render({}, totals[family.name]))
+    return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics(enabled=METRICS_ENABLED, directory=METRICS_DIR)
+
+
+def init_request_metrics(app, metrics: Metrics = METRICS) -> None:
+  '''
+  Install the Flask hooks which time every request and label stages with its endpoint
+  '''
+  if not metrics.enabled:
+    return
+  from flask import g, request
+
+  @app.before_request
+  def _start_request_timer():
+    g.gdp_request_start = time.perf_counter()
+    g.gdp_endpoint_token = _current_endpoint.set(request.endpoint or 'unknown')
+
+  @app.after_request
+  def _record_request(response):
+    start = g.pop('gdp_request_start', None)
+    if start is not None:
+      metrics.observe_request(request.endpoint or 'unknown', response.status_code, time.perf_counter() - start)
+    return response
+
+  @app.teardown_request
+  def _reset_endpoint(exc):
+    start = g.pop('gdp_request_start', None)
+    if start is not None:
+      # after_request didn't run, so the request failed with an unhandled exception
+      metrics.observe_request(request.endpoint or 'unknown', 500, time.perf_counter() - start)
+    token = g.pop('gdp_endpoint_token', None)
+    if token is not None:
+      _current_endpoint.reset(token)
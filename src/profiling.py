@@ -0,0 +1,191 @@
+'''
+profiling.py -- On-demand profiling of individual requests.
+
+A request carrying the header X-GDP-Profile (or the query parameter gdp_profile) set to
+one of PROFILE_MODES is profiled:
+  sample    the request's thread is sampled every PROFILE_SAMPLE_INTERVAL seconds, and
+            the stacks are written in the folded format ("frame;frame;frame count" per
+            line) read by flamegraph.pl, speedscope and inferno
+  cprofile  the request runs under cProfile, and the stats are written in the pstats
+            format (snakeviz, flameprof, gprof2dot)
+Only admins (hub admins, or users named in PROFILE_ADMINS), or anyone when the server
+runs with DEBUG_GDP, may profile.  The profiler is started by the authenticated
+decorator once it knows the user (start_request_profile), so it covers the view, and a
+request from anyone else never starts one.  The profile is written to PROFILE_DIR, and
+its name is returned in the X-GDP-Profile response header.  Admins fetch it from
+/services/gdp/profiles/<name>.
+
+One request per process is profiled at a time.  A request which doesn't ask to be
+profiled costs one header and one query-string lookup.
+'''
+import cProfile
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Optional
+from src.config import PROFILING_ENABLED, PROFILE_ADMINS, PROFILE_DIR, PROFILE_SAMPLE_INTERVAL, DEBUG_GDP
+
+PROFILE_HEADER = 'X-GDP-Profile'
+PROFILE_PARAMETER = 'gdp_profile'
+PROFILE_MODES = ('sample', 'cprofile')
+
+_profiling = threading.Lock()
+
+
+def profile_permitted(user) -> bool:
+  '''
+  True iff user may take and read profiles
+  '''
+  if DEBUG_GDP:
+    return True
+  if not isinstance(user, dict):
+    return False
+  from src.auth_helpers import _get_email
+  return user.get('admin') is True or _get_email(user) in PROFILE_ADMINS
+
+
+def _frame_name(frame) -> str:
+  code = frame.f_code
+  return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def _folded_stack(frame) -> str:
+  names = []
+  while frame is not None:
+    names.append(_frame_name(frame))
+    frame = frame.f_back
+  return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+  '''
+  Samples the stack of one thread from a background thread.
+  Arguments:
+    thread_id: the ident of the thread to sample
+    interval: seconds between samples
+  '''
+  extension = 'folded'
+
+  def __init__(self, thread_id: int, interval: float = PROFILE_SAMPLE_INTERVAL):
+    self.thread_id = thread_id
+    self.interval = interval
+    self.counts: Counter = Counter()
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+
+  def start(self) -> None:
+    self._thread.start()
+
+  def _run(self) -> None:
+    while not self._stopped.wait(self.interval):
+      frame = sys._current_frames().get(self.thread_id)
+      if frame is not None:
+        self.counts[_folded_stack(frame)] += 1
+
+  def stop(self) -> None:
+    self._stopped.set()
+    self._thread.join()
+
+  def write(self, path: str) -> None:
+    with open(path, 'w') as f:
+      for (stack, count) in self.counts.most_common():
+        f.write(f'{stack} {count}\n')
+
+
+class DeterministicProfiler:
+  '''
+  Runs cProfile over the current thread
+  '''
+  extension = 'prof'
+
+  def __init__(self):
+    self._profile = cProfile.Profile()
+
+  def start(self) -> None:
+    self._profile.enable()
+
+  def stop(self) -> None:
+    self._profile.disable()
+
+  def write(self, path: str) -> None:
+    self._profile.dump_stats(path)
+
+
+def start_profiler(mode: str):
+  '''
+  Start a profiler of the current thread in mode (one of PROFILE_MODES).  Returns None if
+  another request is being profiled.  The caller must call finish_profiler.
+  '''
+  if not _profiling.acquire(blocking=False):
+    return None
+  try:
+    profiler = SamplingProfiler(threading.get_ident()) if mode == 'sample' else DeterministicProfiler()
+    profiler.start()
+  except BaseException:
+    _profiling.release()
+    raise
+  return profiler
+
+
+def finish_profiler(profiler, keep: bool, label: str = 'request') -> Optional[str]:
+  '''
+  Stop profiler, and write its profile to PROFILE_DIR if keep is True.
+  Returns:
+    The name of the profile file, or None if it wasn't kept
+  '''
+  try:
+    profiler.stop()
+    if not keep:
+      return None
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe_label = ''.join(c if c.isalnum() or c in '-_' else '_' for c in label)
+    name = f'{time.strftime("%Y%m%d-%H%M%S")}-{safe_label}-{uuid.uuid4().hex[:8]}.{profiler.extension}'
+    profiler.write(os.path.join(PROFILE_DIR, name))
+    return name
+  finally:
+    _profiling.release()
+
+
+def start_request_profile(user) -> None:
+  '''
+  Start profiling the current request if it asks to be profiled and user may profile.
+  Called by the authenticated decorator once it knows the user; the hooks installed by
+  init_request_profiling finish the profile.
+  '''
+  if not PROFILING_ENABLED:
+    return
+  from flask import g, request
+  mode = request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_PARAMETER)
+  if mode not in PROFILE_MODES or 'gdp_profiler' in g or not profile_permitted(user):
+    return
+  g.gdp_profiler = start_profiler(mode)
+  if g.gdp_profiler is None:
+    g.gdp_profile_busy = True
+
+
+def init_request_profiling(app) -> None:
+  '''
+  Install the Flask hooks which finish the profiles started by start_request_profile
+  '''
+  if not PROFILING_ENABLED:
+    return
+  from flask import g, request
+
+  @app.after_request
+  def _finish_profile(response):
+    profiler = g.pop('gdp_profiler', None)
+    if profiler is not None:
+      response.headers[PROFILE_HEADER] = finish_profiler(profiler, True, request.endpoint or 'unknown')
+    elif g.pop('gdp_profile_busy', False):
+      response.headers[PROFILE_HEADER] = 'busy'
+    return response
+
+  @app.teardown_request
+  def _drop_profile(exc):
+    profiler = g.pop('gdp_profiler', None)
+    if profiler is not None:
+      # after_request didn't run
+      finish_profiler(profiler, False)
@@ -0,0 +1,13 @@
+from flask import Blueprint, Response, abort
+from src.metrics import METRICS
+
+metrics_bp = Blueprint('metrics', __name__, url_prefix='/services/gdp')
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def metrics():
+  """
+  Prometheus scrape endpoint: the metrics of every worker of the server (see metrics.py).
+  """
+  if not METRICS.enabled:
+    abort(404)
+  return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
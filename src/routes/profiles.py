@@ -0,0 +1,16 @@
+from flask import Blueprint, abort, send_from_directory
+from src.auth_helpers import authenticated
+from src.config import PROFILE_DIR
+from src.profiling import profile_permitted
+
+profiles_bp = Blueprint('profiles', __name__, url_prefix='/services/gdp')
+
+@profiles_bp.route('/profiles/<name>', methods=['GET'])
+@authenticated
+def get_profile(user, name):
+  """
+  Download a request profile (see src/profiling.py).  Admins only.
+  """
+  if not profile_permitted(user):
+    abort(403, 'Only admins may read profiles')
+  return send_from_directory(PROFILE_DIR, name, as_attachment=True)
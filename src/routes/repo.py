@@ -1,12 +1,16 @@
-from flask import Blueprint, request, jsonify, abort, Response
+import logging
+from flask import Blueprint, request, jsonify, abort
 from src.auth_helpers import authenticated, _get_email
 from flask import current_app
 from src.gdp_table_manager import GDPNotFoundException, GDPNotPermittedException, GDPNotOwnerException
+from src.table_lease import GDPTableBusyException
 from src.config import HUB_URL
-from sdtp import json_serialize
-from json import dumps
+from sdtp import InvalidDataException
+from src.downloads import stored_object_response, table_stream_response
 
 
+logger = logging.getLogger(__name__)
+
 repo_bp = Blueprint('repo', __name__, url_prefix='/services/gdp')
 
 def _get_email_and_abort_if_unauthenticated(user, route):
@@ -18,15 +22,44 @@ def _get_email_and_abort_if_unauthenticated(user, route):
 def _make_url(key):
   return f'{HUB_URL}/table/{key}'
 
+PAGE_PARAMETERS = ('prefix', 'search', 'sort', 'order', 'start', 'limit')
+DEFAULT_PAGE_SIZE = 50
+
+def _busy_response(e):
+  # Another worker or replica is updating the table
+  return jsonify({"error": str(e)}), 503, {'Retry-After': '1'}
+
+def _page_arguments(args):
+  '''
+  The arguments to GDPTableManager.list_tables_page from request parameters.
+  Raises ValueError if start or limit isn't an integer.
+  '''
+  return {
+    'prefix': args.get('prefix'),
+    'search': args.get('search'),
+    'sort': args.get('sort', 'key'),
+    'descending': args.get('order', 'asc') == 'desc',
+    'start': int(args.get('start', 0)),
+    'limit': int(args.get('limit', DEFAULT_PAGE_SIZE))
+  }
+
 
 @repo_bp.route('/tables', methods=['GET'])
 @authenticated
 def list_tables(user):
   """
   List all table names the user can access. keys are returned.
+  With any of the parameters prefix, search, sort, order (asc/desc), start or limit,
+  returns one page: {"tables": [{"key", "owner", "name", "row_count", "size"}], "next": start of the next page}.
   """
   manager = current_app.table_manager  # type: ignore[attr-defined]
   email = _get_email(user)
+  if any(parm in request.args for parm in PAGE_PARAMETERS):
+    try:
+      page = manager.list_tables_page(email, email is not None, **_page_arguments(request.args))
+    except (ValueError, InvalidDataException) as e:
+      return jsonify({"error": str(e)}), 400
+    return jsonify(page)
   all_tables = manager.list_tables()
   result = [key for key in all_tables if manager.table_access_permitted(key, email, email is not None)]
   return jsonify(result)
@@ -62,7 +95,12 @@ def upload_table(user, name):
    
   manager = current_app.table_manager  # type: ignore[attr-defined]
   key = f'{owner}/{valid_name}'
-  manager.publish_table(key, sdml)
+  try:
+    manager.publish_table(key, sdml)
+  except InvalidDataException as e:
+    return jsonify({"error": str(e)}), 400
+  except GDPTableBusyException as e:
+    return _busy_response(e)
   return jsonify(key)
 
 @repo_bp.route('/table', methods=['GET'])
@@ -75,23 +113,22 @@ def get_table(user):
   
   manager = current_app.table_manager  # type: ignore[attr-defined]
   key = request.args['table'] if 'table' in request.args else None
-  current_app.logger.debug(f'in /table, email is {email}, key is {key}')
+  logger.debug('/table: email is %s, key is %s', email, key)
   if key is None:
-    current_app.logger.debug(f'Aborting due to missing table parameter')
+    logger.debug('/table: missing table parameter')
     return 'parameter table is missing in /table', 400
   try:
-    table = manager.get_table_if_permitted(key, email, email is not None)
-    current_app.logger.debug(f'/tables fetched table at {key}: {table}')
-    result = table.to_dictionary()
-    response = dumps(result, default=json_serialize)
-    return Response(response, mimetype = "application/json")
+    (meta, table) = manager.download_source(key, email, email is not None)
+    if table is None:
+      return stored_object_response(manager.storage_manager, key, meta)
+    return table_stream_response(table)
   except GDPNotPermittedException:
     message = f"user {email} is not permitted to access {key}"
-    current_app.logger.debug(f'/tables: GDPNotPermittedException: {message}')
+    logger.debug('/table: GDPNotPermittedException: %s', message)
     return message, 403
   except GDPNotFoundException:
     message = f"Table  {key} is not found"
-    current_app.logger.debug(f'/tables: GDPNotFoundException: {message}')
+    logger.debug('/table: GDPNotFoundException: %s', message)
     return jsonify(message), 404
 
 @repo_bp.route('/delete/<name>', methods=['DELETE'])
@@ -100,19 +137,21 @@ def delete_table(user, name):
   """
   Owner deletes a table by name.
   """
-  current_app.logger.debug(f'/delete, user is {user}, name is {name}')
+  logger.debug('/delete: user is %s, name is %s', user, name)
   email = _get_email_and_abort_if_unauthenticated(user, '/delete')
   key = f'{email}/{name}'
-  current_app.logger.debug(f'/delete, key is {key}')
+  logger.debug('/delete: key is %s', key)
 
   manager = current_app.table_manager  # type: ignore[attr-defined]
   try:
     manager.delete_table(key)
-    current_app.logger.debug(f'/delete, {key} successfully deleted')
+    logger.debug('/delete: %s deleted', key)
     return jsonify({'deleted': key})
   except  GDPNotFoundException as e:
-    current_app.logger.debug(f'/delete, {key} not found')
+    logger.debug('/delete: %s not found', key)
     return repr(e), 404
+  except GDPTableBusyException as e:
+    return _busy_response(e)
   
 
 @repo_bp.route('/share/<name>', methods=['POST'])
@@ -145,3 +184,53 @@ def share_table(user, name):
     return jsonify({'update': _make_url(key)})
   except GDPNotFoundException as e:
     return repr(e), 404
+
+
+def _update_rows(user, name, route, update):
+  email = _get_email_and_abort_if_unauthenticated(user, route)
+  valid_name = name if name.endswith('sdml') else name + '.sdml'
+  key = f'{email}/{valid_name}'
+  content_type = request.content_type or ""
+  if not content_type.startswith('application/json'):
+    return jsonify({"error": "Unsupported Content-Type"}), 400
+  data = request.get_json()
+  rows = data.get('rows')
+  if not isinstance(rows, list):
+    return jsonify({"error": "Missing rows in JSON"}), 400
+  manager = current_app.table_manager  # type: ignore[attr-defined]
+  try:
+    row_count = update(manager, key, email, rows, data)
+    return jsonify({'table': key, 'rows': row_count})
+  except GDPNotFoundException as e:
+    return repr(e), 404
+  except GDPNotOwnerException as e:
+    return repr(e), 403
+  except InvalidDataException as e:
+    return jsonify({"error": str(e)}), 400
+  except GDPTableBusyException as e:
+    return _busy_response(e)
+
+
+@repo_bp.route('/append/<name>', methods=['POST'])
+@authenticated
+def append_rows(user, name):
+  """
+  Owner appends rows to a table without re-uploading it.
+  Expects JSON: {"rows": [[...], ...]}
+  """
+  return _update_rows(user, name, '/append', lambda manager, key, email, rows, data: manager.append_rows(key, email, rows))
+
+
+@repo_bp.route('/patch/<name>', methods=['POST'])
+@authenticated
+def patch_rows(user, name):
+  """
+  Owner upserts rows into a table: each row replaces the row with the same key_column value.
+  Expects JSON: {"key_column": "<column>", "rows": [[...], ...]}
+  """
+  def patch(manager, key, email, rows, data):
+    key_column = data.get('key_column')
+    if not key_column:
+      raise InvalidDataException('Missing key_column in JSON')
+    return manager.patch_rows(key, email, rows, key_column)
+  return _update_rows(user, name, '/patch', patch)
@@ -4,10 +4,16 @@ from src.auth_helpers import authenticated, _get_email
 from flask import current_app
 from src.gdp_table_manager import GDPNotFoundException, GDPNotPermittedException
 from sdtp import InvalidDataException, json_serialize, RowTable
+from src.metrics import METRICS
+from src.config import BATCH_MAX_QUERIES, COALESCE_QUERIES
+from src.single_flight import SingleFlight
 from json import dumps
 
 sdtp_bp = Blueprint('sdtp', __name__, url_prefix='/services/gdp')
 
+# Identical queries in flight at the same time share one computation (see _query_response)
+_query_flights = SingleFlight()
+
 @sdtp_bp.route('/echo')
 @authenticated
 def echo(user):
@@ -16,7 +22,6 @@ def echo(user):
 @sdtp_bp.route('/get_table_names', methods=['GET'])
 @authenticated
 def get_table_names(user):
-  print(user)
   # Return list of table names user can see
   manager = current_app.table_manager  # type: ignore[attr-defined]
   email = _get_email(user)
@@ -31,15 +36,7 @@ def get_tables(user):
   manager = current_app.table_manager  # type: ignore[attr-defined]
   email = _get_email(user)
   is_hub_user = email is not None
-  all_tables = manager.all_user_tables(email, is_hub_user)
-  result = {}
-  for key in all_tables:
-    try:
-      table = manager.get_table_if_permitted(key, email, is_hub_user)
-      result[key] = table.schema
-    except Exception: # can't happen
-      pass
-  return jsonify(result)
+  return jsonify(manager.get_table_info(email, is_hub_user))
 
 def _check_and_return_parameters(parameters, route):
   result = request.args.to_dict()
@@ -66,16 +63,44 @@ def _get_table_for_query(parameters, user, route):
 @authenticated
 def get_table_schema(user):
 # Query: ?table=... or body JSON {"table": ...}
+  parms = _check_and_return_parameters({'table'}, '/get_table_schema')
+  manager = current_app.table_manager  # type: ignore[attr-defined]
+  email = _get_email(user)
   try:
-    (parms, table) = _get_table_for_query({'table'}, user, '/get_table_schema')
-    return jsonify(table.schema)
+    return jsonify(manager.get_table_schema_if_permitted(parms['table'], email, email is not None))
+  except GDPNotPermittedException as e:
+    abort(401, e)
   except GDPNotFoundException as e:
     abort(404, e)
 
 
-def _column_query_result(result):
+def _query_response(parms, table, compute):
+  '''
+  Respond to a query on table with the serialized result of compute().  Requests for the
+  same endpoint with the same parameters against the same version of the table, made
+  while one of them is being computed, wait for it and share its serialized body.  Each
+  request has already passed its own permission check (the table was fetched with
+  get_table_if_permitted).
+  Arguments:
+    parms: the parameters of the query, including the table
+    table: the table being queried
+    compute: zero-argument function returning the (JSON-serializable) result
+  '''
+  def serialize():
+    result = compute()
+    with METRICS.stage('serialize'):
+      if isinstance(result, RowTable):
+        result = result.to_dictionary()
+      return dumps(result, default= json_serialize).encode()
+  if COALESCE_QUERIES:
+    manager = current_app.table_manager  # type: ignore[attr-defined]
+    flight = (request.endpoint, manager.table_version(parms['table'], table), dumps(parms, sort_keys=True, default=str))
+    METRICS.count_cache('query_coalesced', _query_flights.in_flight(flight))
+    body = _query_flights.do(flight, serialize)
+  else:
+    body = serialize()
   return Response(
-    dumps(result, default= json_serialize),
+    body,
     mimetype = "application/json"
   )
 
@@ -87,11 +112,13 @@ def get_range_spec(user):
   (parms, table) = _get_table_for_query({'table', 'column'}, user, '/get_range_spec')
   try:
     column = parms['column']
-    result = (table.range_spec(column))
-    return _column_query_result(result)
+    return _query_response(parms, table, lambda: table.range_spec(column))
   except InvalidDataException as e:
     
     abort(400, f'{column} is not a valid column of table {parms["table"]}') #type: ignore
+  except GDPNotFoundException as e:
+    # The table was replaced, and the version being read is gone
+    abort(404, e)
 
 
 
@@ -102,9 +129,12 @@ def get_all_values(user):
   (parms, table) = _get_table_for_query({'table', 'column'}, user, '/get_all_values')
   try:
     column = parms['column']
-    return _column_query_result(table.all_values(column))
+    return _query_response(parms, table, lambda: table.all_values(column))
   except InvalidDataException as e:
     abort(400, f'{column} is not a valid column of table {parms["table"]}') #type: ignore
+  except GDPNotFoundException as e:
+    # The table was replaced, and the version being read is gone
+    abort(404, e)
 
 @sdtp_bp.route('/get_column', methods=['GET'])
 @authenticated
@@ -113,9 +143,12 @@ def get_column(user):
   (parms, table) = _get_table_for_query({'table', 'column'}, user, '/get_all_values')
   try:
     column = parms['column']
-    return _column_query_result(table.get_column(column))
+    return _query_response(parms, table, lambda: table.get_column(column))
   except InvalidDataException as e:
      abort(400, f'{column} is not a valid column of table {parms["table"]}') #type: ignore
+  except GDPNotFoundException as e:
+    # The table was replaced, and the version being read is gone
+    abort(404, e)
 
 def _check_and_return_json_parameters(parameters, route):
     result = request.get_json(silent=True) or {}
@@ -149,16 +182,91 @@ def get_filtered_rows(user):
   filter_spec = parms.get('filter_spec')
   columns = parms.get('columns', [])
   fmt = parms.get('format', 'list')
+  manager = current_app.table_manager  # type: ignore[attr-defined]
+  def compute():
+    with METRICS.stage('filter'):
+      return manager.filter_rows(parms['table'], table, filter_spec = filter_spec, columns = columns, format=fmt)
   try:
-    result = table.get_filtered_rows(filter_spec = filter_spec, columns = columns, format=fmt)
-    if isinstance(result, RowTable):
-      result = result.to_dictionary()
-    return Response(
-       dumps(result, default= json_serialize),
-        mimetype = "application/json"
-    )
-
+    return _query_response(parms, table, compute)
   except Exception as e:
      abort(400, e)
   # Then do whatever: rows = table.filtered_rows(filter_spec, columns, fmt)
   # return jsonify(rows)
+
+
+@sdtp_bp.route('/get_aggregate', methods=['POST'])
+@authenticated
+def get_aggregate(user):
+  # Body: {"table": ..., "aggregates": [...], "group_by": [...], "filter_spec": ..., "format": ...}
+  (parms, table) = _get_table_for_json_query({'table', 'aggregates'}, user, '/get_aggregate')
+  manager = current_app.table_manager  # type: ignore[attr-defined]
+  def compute():
+    with METRICS.stage('aggregate'):
+      return manager.aggregate(parms['table'], table, filter_spec = parms.get('filter_spec'), group_by = parms.get('group_by'), aggregates = parms['aggregates'], format = parms.get('format', 'list'))
+  try:
+    return _query_response(parms, table, compute)
+  except Exception as e:
+     abort(400, e)
+
+
+def _sdml_result(result):
+  return result.to_dictionary() if isinstance(result, RowTable) else result
+
+# The queries a /batch request may contain: op -> (required parameters, function(manager, key, table, query))
+BATCH_OPERATIONS = {
+  'get_table_schema': (set(), lambda manager, key, table, query: table.schema),
+  'get_range_spec': ({'column'}, lambda manager, key, table, query: table.range_spec(query['column'])),
+  'get_all_values': ({'column'}, lambda manager, key, table, query: table.all_values(query['column'])),
+  'get_column': ({'column'}, lambda manager, key, table, query: table.get_column(query['column'])),
+  'get_filtered_rows': (set(), lambda manager, key, table, query: _sdml_result(manager.filter_rows(key, table, filter_spec = query.get('filter_spec'), columns = query.get('columns', []), format = query.get('format', 'list')))),
+  'get_aggregate': ({'aggregates'}, lambda manager, key, table, query: _sdml_result(manager.aggregate(key, table, filter_spec = query.get('filter_spec'), group_by = query.get('group_by'), aggregates = query['aggregates'], format = query.get('format', 'list')))),
+}
+
+def _resolve_batch_table(manager, key, email, tables):
+  # Fetch each table (and check the user's access to it) once per batch
+  if key not in tables:
+    try:
+      tables[key] = (200, manager.get_table_if_permitted(key, email, email is not None))
+    except GDPNotPermittedException as e:
+      tables[key] = (401, str(e))
+    except GDPNotFoundException as e:
+      tables[key] = (404, str(e))
+  return tables[key]
+
+def _run_batch_query(manager, query, email, tables):
+  if not isinstance(query, dict) or query.get('op') not in BATCH_OPERATIONS:
+    return {'status': 400, 'error': f'Each query must be a dictionary whose op is one of {sorted(BATCH_OPERATIONS.keys())}'}
+  (required, operation) = BATCH_OPERATIONS[query['op']]
+  missing = (required | {'table'}) - set(query.keys())
+  if missing:
+    return {'status': 400, 'error': f'{query["op"]} requires missing parameters: {missing}'}
+  (status, table) = _resolve_batch_table(manager, query['table'], email, tables)
+  if status != 200:
+    return {'status': status, 'error': table}
+  try:
+    return {'status': 200, 'result': operation(manager, query['table'], table, query)}
+  except Exception as e:
+    return {'status': 400, 'error': str(e)}
+
+@sdtp_bp.route('/batch', methods=['POST'])
+@authenticated
+def batch(user):
+  # Body: {"queries": [{"op": "get_range_spec", "table": ..., "column": ...}, ...]}
+  # Returns a list with one {"status": ..., "result" | "error": ...} per query, in order
+  parms = _check_and_return_json_parameters({'queries'}, '/batch')
+  queries = parms['queries']
+  if not isinstance(queries, list):
+    abort(400, '/batch requires a list of queries')
+  if len(queries) > BATCH_MAX_QUERIES:
+    abort(400, f'/batch accepts at most {BATCH_MAX_QUERIES} queries')
+  manager = current_app.table_manager  # type: ignore[attr-defined]
+  email = _get_email(user)
+  tables = {}
+  with METRICS.stage('batch'):
+    results = [_run_batch_query(manager, query, email, tables) for query in queries]
+  with METRICS.stage('serialize'):
+    body = dumps(results, default= json_serialize)
+  return Response(
+    body,
+    mimetype = "application/json"
+  )
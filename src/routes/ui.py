@@ -2,9 +2,17 @@
 import uuid
 import os
 import json
-from flask import Blueprint, render_template, request, redirect, flash, current_app, abort, jsonify, url_for
+import logging
+from urllib.parse import urlencode
+from flask import Blueprint, render_template, request, redirect, flash, current_app, jsonify, url_for
 from src.auth_helpers import _get_email, authenticated
 from src.gdp_table_manager import GDPNotFoundException, GDPNotOwnerException, GDPNotPermittedException, owner
+from src.table_lease import GDPTableBusyException
+from src.routes.repo import _page_arguments, PAGE_PARAMETERS
+from src.downloads import stored_object_response, table_stream_response
+from sdtp import InvalidDataException
+
+logger = logging.getLogger(__name__)
 
 ui_bp = Blueprint('ui', __name__, url_prefix='/services/gdp')
 
@@ -12,8 +20,8 @@ API_ROUTES = [
     {
         "route": "/tables",
         "methods": ["GET"],
-        "parameters": [],
-        "description": "List all table names the user can access. Keys are returned."
+        "parameters": ["prefix (optional)", "search (optional)", "sort (optional)", "order (optional)", "start (optional)", "limit (optional)"],
+        "description": "List all table names the user can access. Keys are returned. With any parameter, returns one page of tables (with their owner, name, row count and size) whose keys start with prefix and contain search, sorted by sort (key, name, owner, row_count or size) in order (asc or desc), and the start of the next page."
     },
     {
         "route": "/upload/<name>",
@@ -33,6 +41,18 @@ API_ROUTES = [
         "parameters": [],
         "description": "Delete the table with name <name>. Only the owner of the table can call this."
     },
+    {
+        "route": "/append/<name>",
+        "methods": ["POST"],
+        "parameters": ["rows"],
+        "description": "Append rows to the table with name <name> without re-uploading it. Only the owner of the table can call this."
+    },
+    {
+        "route": "/patch/<name>",
+        "methods": ["POST"],
+        "parameters": ["rows", "key_column"],
+        "description": "Upsert rows into the table with name <name>: each row replaces the row with the same value in key_column, or is appended. Only the owner of the table can call this."
+    },
     {
         "route": "/share/<name>",
         "methods": ["POST"],
@@ -81,6 +101,18 @@ API_ROUTES = [
         "parameters": ["table", "columns (optional)", "filter_spec (optional)", "format (optional)"],
         "description": "Filter the rows according to the specification given by filter_spec. Returns the rows for which the resulting filter returns True. If columns is specified, return only those columns. Return in the format specified by format. If 'dict', return a list of dictionaries; if 'SDML', return a RowTable; if 'list' or omitted, return a list of lists of values."
     },
+    {
+        "route": "/get_aggregate",
+        "methods": ["POST"],
+        "parameters": ["table", "aggregates", "group_by (optional)", "filter_spec (optional)", "format (optional)"],
+        "description": "Filter the table with filter_spec, group the rows by the group_by columns and return count, sum, mean, min or max of columns for each group."
+    },
+    {
+        "route": "/batch",
+        "methods": ["POST"],
+        "parameters": ["queries"],
+        "description": "Run a list of SDTP queries, each a dictionary with an op (get_table_schema, get_range_spec, get_all_values, get_column, get_filtered_rows or get_aggregate), a table and the op's parameters. Returns a list with a status and a result or error for each query."
+    },
 ]
 
 
@@ -153,23 +185,42 @@ def ui_view_tables(user):
     # TODO: render tables.html, fetch tables for user
     email = _get_email(user)
     manager = current_app.table_manager  # type: ignore[attr-defined]
-    print(f'Showing tables for {email}')
-    tables = manager.all_user_tables(email, email is not None)
+    logger.debug('Showing tables for %s', email)
+    try:
+      page_arguments = _page_arguments(request.args)
+      # The starts of the pages before this one, so Previous goes back to where they began
+      back = [int(earlier) for earlier in request.args.get('back', '').split(',') if earlier]
+      page = manager.list_tables_page(email, email is not None, **page_arguments)
+    except (ValueError, InvalidDataException) as e:
+      flash(str(e))
+      page_arguments = _page_arguments({})
+      back = []
+      page = manager.list_tables_page(email, email is not None, **page_arguments)
+    tables = [entry['key'] for entry in page['tables']]
     def owned(table):
        return email is not None and owner(table) == email
     
     
-    owned_tables = [table for table in tables if owned(table)] 
-    other_tables = list(set(tables) - set(owned_tables))
+    owned_tables = [owner_links(table) for table in tables if owned(table)]
+    other_tables = [other_links(table) for table in tables if not owned(table)]
+
+    def page_link(start, back):
+       parameters = {name: request.args[name] for name in PAGE_PARAMETERS if name in request.args and name != 'start'}
+       parameters['start'] = str(start)
+       if back:
+          parameters['back'] = ','.join(str(earlier) for earlier in back)
+       return url_for('ui.ui_view_tables') + '?' + urlencode(parameters)
 
-    owned_tables = [owner_links(table) for table in owned_tables]
-    other_tables = [other_links(table) for table in other_tables]
+    start = page_arguments['start']
 
     return render_template(
        'view_tables.html',
        navbar_contents = _gen_navbar('view_tables', email),
        owned = owned_tables,
        other = other_tables,
+       search = page_arguments['search'] or '',
+       next_link = page_link(page['next'], back + [start]) if page['next'] is not None else None,
+       previous_link = page_link(back[-1], back[:-1]) if back else None,
        email=email, uuid=str(uuid.uuid4())
     )
 
@@ -183,18 +234,16 @@ def table_detail(user, owner, name):
     table_name = f'{owner}/{name}'
     links = owner_links(table_name) if email == owner else other_links(table_name)
     try:
-      table  = manager.get_table_if_permitted(table_name, email, email is not None)
-      num_columns = len(table.schema)
-      rows = table.get_filtered_rows()
-      if len(rows) > 10:
-        first_rows = rows[:5]
-        last_rows = rows[-5:]
+      preview  = manager.preview_if_permitted(table_name, email, email is not None)
+      num_columns = len(preview['schema'])
+      rows = preview['head']
+      if len(preview['tail']) > 0:
         middle = ['...' for i in range(num_columns)]
-        rows = first_rows + [middle] + last_rows
+        rows = rows + [middle] + preview['tail']
       return render_template(
         'view_table.html', 
         navbar_contents = _gen_navbar('view_table', email),
-        schema = table.schema,
+        schema = preview['schema'],
         table_name = table_name,
         rows = rows,
         uuid=str(uuid.uuid4()),
@@ -328,17 +377,10 @@ def download_table(user, owner, name):
     email = _get_email(user)
     table_name = f"{owner}/{name}"
     try:
-        table = manager.get_table_if_permitted(table_name, email, email is not None)
-        
-        data = table.to_json()  # Or whatever serialization you use
-        return (
-            data,
-            200,
-            {
-                "Content-Type": "application/json",
-                "Content-Disposition": f"attachment; filename={name}"
-            }
-        )
+        (meta, table) = manager.download_source(table_name, email, email is not None)
+        if table is None:
+            return stored_object_response(manager.storage_manager, table_name, meta, filename=name)
+        return table_stream_response(table, filename=name)
     except GDPNotFoundException:
         flash(f'table {table_name} does not exist')
     except GDPNotPermittedException:
@@ -402,7 +444,11 @@ def upload_table(user):
         key = f'{email}/{table_name}'
         # You might want to validate table_name, check for collisions, etc.
         # Save the file (parse as SDML if needed), set permissions, etc.
-        manager.publish_table(key, sdml_str)
+        try:
+            manager.publish_table(key, sdml_str)
+        except GDPTableBusyException:
+            flash(f'{key} is being updated; please try again')
+            return redirect(url_for('ui.upload_table'))
         flash('Table uploaded successfully!')
         return redirect(url_for('ui.ui_view_tables'))
     return render_template(
@@ -0,0 +1,71 @@
+'''
+single_flight.py -- Per-key deduplication of concurrent work.
+
+When several threads ask for the same key at the same time, only the first one
+(the leader) runs the loader.  The others wait for the leader and share its result,
+or its exception.  Once the leader finishes the key is forgotten, so the next call
+runs the loader again.
+'''
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class _Call:
+  '''
+  A single in-flight call: the event waiters block on, and the outcome of the call.
+  '''
+  def __init__(self):
+    self.done = threading.Event()
+    # The loader's return value, or the exception it raised
+    self.result: Any = None
+    self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+  '''
+  Runs at most one loader per key at a time.  Thread-safe.
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls: Dict[Hashable, _Call] = {}
+
+  def do(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+    '''
+    Run loader() for key, unless a call for key is already in flight, in which case
+    wait for that call and return its result.
+    Arguments:
+      key: the key identifying the work
+      loader: a zero-argument function that does the work
+    Returns:
+      The result of the loader
+    Raises:
+      Whatever the loader raised
+    '''
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = _Call()
+        self._calls[key] = call
+    if not leader:
+      call.done.wait()
+      if call.error is not None:
+        raise call.error
+      return call.result
+    try:
+      call.result = loader()
+      return call.result
+    except BaseException as e:
+      call.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
+  def in_flight(self, key: Hashable) -> bool:
+    '''
+    Returns true iff a call for key is running
+    '''
+    with self._lock:
+      return key in self._calls
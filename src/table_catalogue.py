@@ -0,0 +1,143 @@
+'''
+table_catalogue.py -- One object describing every table, so listings take one read.
+
+The catalogue (CATALOGUE_KEY) maps each table key to {schema, row_count, size, etag,
+columnar}.  It is kept up to date by publish, compaction and delete (so appended rows
+are counted once they are compacted), and cached in memory until its etag changes.  It
+is only replaced by conditional writes, retried with backoff if another writer got in
+first, and is built from storage when it is missing.  An update which keeps losing the
+race is held back and written with the next one, rather than dropping the catalogue
+(and with it every reader's listings) into a rebuild.  It is an accelerator, not the source of truth:
+the column sidecars are, and readers describe tables the catalogue lacks from them.
+'''
+import random
+import threading
+import time
+from json import dumps, loads
+from typing import Callable, Dict, Optional
+from src.table_lease import UPDATE_ATTEMPTS
+
+# Its key doesn't end in .sdml, so it is never listed as a table
+CATALOGUE_KEY = '.gdp/catalogue.json'
+
+
+def catalogue_entry(sidecar: dict, base_meta) -> dict:
+  '''
+  The catalogue entry of the table whose column sidecar is sidecar and whose meta is base_meta
+  '''
+  return {
+    'schema': sidecar['schema'],
+    'row_count': sidecar.get('row_count'),
+    'size': base_meta.size if base_meta else None,
+    'etag': base_meta.etag if base_meta else None,
+    'columnar': bool(sidecar.get('columns'))
+  }
+
+
+class TableCatalogue:
+  '''
+  The catalogue, as read and written by one process.
+  Arguments:
+    storage_manager: the GDPStorageManager holding the tables
+    describe_tables: function() returning catalogue entries for every table in storage
+  '''
+  # Seconds to back off (at most, doubling) between conditional writes which lost
+  BACKOFF = 0.02
+
+  def __init__(self, storage_manager, describe_tables: Callable[[], Dict[str, dict]]):
+    self.storage_manager = storage_manager
+    self.describe_tables = describe_tables
+    self._lock = threading.Lock()
+    # (etag, tables) of the copy last read or written; tables is None until then
+    self._cached = (None, None)
+    # Updates not yet written, because every attempt lost the race
+    self._unwritten: Dict[str, Optional[dict]] = {}
+
+  def cached(self) -> Optional[Dict[str, dict]]:
+    '''
+    The copy of the catalogue last read or written, without checking storage, or None
+    if it hasn't been read yet
+    '''
+    with self._lock:
+      return self._cached[1]
+
+  def read(self) -> Dict[str, dict]:
+    '''
+    Return the catalogue.  Costs one get_meta if the cached copy is current.
+    '''
+    return self.read_with_meta()[1]
+
+  def read_with_meta(self) -> tuple:
+    '''
+    (meta, tables) of the stored catalogue, or (None, {}) if there is none
+    '''
+    meta = self.storage_manager.get_meta(CATALOGUE_KEY)
+    if meta is None:
+      with self._lock:
+        self._cached = (None, {})
+      return (None, {})
+    with self._lock:
+      (etag, tables) = self._cached
+    if etag == meta.etag:
+      return (meta, tables)
+    stored = self.storage_manager.get_object(CATALOGUE_KEY)
+    if isinstance(stored, str):
+      stored = loads(stored)
+    tables = stored.get('tables', {}) if stored is not None else {}
+    with self._lock:
+      self._cached = (meta.etag, tables)
+    return (meta, tables)
+
+  def _write(self, tables: Dict[str, dict], expected):
+    # Store tables if the stored catalogue is still expected's version (None: if there is
+    # none).  Returns the new meta, or None if it wasn't
+    meta = self.storage_manager.put_object_if_match(CATALOGUE_KEY, dumps({'tables': tables}), expected)
+    if meta is not None:
+      with self._lock:
+        self._cached = (meta.etag, tables)
+    return meta
+
+  def update(self, updates: Dict[str, Optional[dict]]) -> None:
+    '''
+    Apply updates to the catalogue: None removes a table, a dictionary is merged into
+    the table's entry.  If there is no catalogue, it is built from storage.  If other
+    writers keep getting in first, the stored catalogue is left as it is and updates
+    are written with the next update.
+    '''
+    with self._lock:
+      updates = {**self._unwritten, **updates}
+      self._unwritten = {}
+    for attempt in range(UPDATE_ATTEMPTS):
+      if attempt > 0:
+        time.sleep(random.uniform(0, self.BACKOFF * 2 ** attempt))
+      (meta, tables) = self.read_with_meta()
+      if meta is None:
+        # Storage already holds the change being recorded
+        if self._write(self.describe_tables(), None) is not None:
+          return
+        continue
+      tables = dict(tables)
+      for (key, update) in updates.items():
+        if update is None:
+          tables.pop(key, None)
+        else:
+          tables[key] = {**tables.get(key, {}), **update}
+      if self._write(tables, meta) is not None:
+        return
+    # Kept losing the race: the catalogue is stale for these tables until the next update
+    with self._lock:
+      self._unwritten = {**updates, **self._unwritten}
+
+  def rebuild(self) -> Dict[str, dict]:
+    '''
+    Rewrite the catalogue from the tables in storage, and return it
+    '''
+    tables: Dict[str, dict] = {}
+    for attempt in range(UPDATE_ATTEMPTS):
+      meta = self.storage_manager.get_meta(CATALOGUE_KEY)
+      tables = self.describe_tables()
+      if self._write(tables, meta) is not None:
+        with self._lock:
+          self._unwritten = {}
+        break
+    return tables
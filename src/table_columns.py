@@ -0,0 +1,131 @@
+'''
+table_columns.py -- Column sidecars, and tables stored one object per column.
+
+Every published table has a column sidecar (<table>.cols) holding its schema, row count
+and first and last PREVIEW_ROWS rows, so schema requests and previews never read the
+rows.  RowTables with at least COLUMNAR_MIN_COLUMNS columns are also written one object
+per column (<table>.col.<generation>.<index>), and loaded as a ColumnarTable, which
+reads only the columns a query touches.  The sidecar records the etag of the base it
+describes, and is ignored once the base has changed.  It also records whether the base
+is exactly the table's serialized form (no internal keys such as "indexes", and no
+formatting of the uploader's), so that downloads may send it as it is stored.
+
+The column objects of a replaced version are listed under "retired" in the new sidecar,
+and deleted by the first write after JOURNAL_RETENTION seconds, so replicas still
+serving the old version can finish reading it.
+'''
+import time
+import uuid
+from json import dumps, loads
+from typing import Optional, Tuple
+from sdtp import json_serialize, convert_list_to_type
+from src.metrics import METRICS
+from src.table_segments import table_stem
+from src.config import COLUMNAR_MIN_COLUMNS, PREVIEW_ROWS, JOURNAL_RETENTION
+
+
+def columns_key(table_key: str) -> str:
+  '''
+  Key of the sidecar holding the schema and row count of the table at table_key, and
+  the keys of its per-column objects if it is stored by column
+  '''
+  return table_stem(table_key) + '.cols'
+
+
+def column_key(table_key: str, generation: str, index: int) -> str:
+  return f'{table_stem(table_key)}.col.{generation}.{index:05d}'
+
+
+def _parse(obj):
+  return loads(obj) if isinstance(obj, str) else obj
+
+
+def head_and_tail(rows, head: int, tail: int):
+  '''
+  The first head and last tail rows, without overlap: short tables are all head
+  '''
+  if len(rows) <= head + tail:
+    return (list(rows), [])
+  return (list(rows[:head]), list(rows[len(rows) - tail:]) if tail > 0 else [])
+
+
+def read_sidecar(storage_manager, key: str, blob_meta) -> Optional[dict]:
+  '''
+  The column sidecar of the table at key, if there is one and it describes the base
+  whose meta is blob_meta
+  '''
+  with METRICS.stage('storage_fetch'):
+    sidecar = storage_manager.get_object(columns_key(key))
+  if sidecar is None:
+    return None
+  sidecar = _parse(sidecar)
+  return sidecar if sidecar.get('base_etag') == blob_meta.etag else None
+
+
+def load_column(storage_manager, sidecar: dict, index: int) -> Optional[list]:
+  '''
+  The values of column index of the table sidecar describes, converted to the column's
+  type, or None if its object is gone (the table has been replaced)
+  '''
+  with METRICS.stage('storage_fetch'):
+    values = storage_manager.get_object(sidecar['columns'][index])
+  if values is None:
+    return None
+  with METRICS.stage('parse'):
+    return convert_list_to_type(sidecar['schema'][index]['type'], _parse(values))
+
+
+def write_columns(storage_manager, key: str, table_data: dict, declared_indexes: dict, serialized: bool = False) -> Tuple[dict, object]:
+  '''
+  Write the column sidecar for the base table just stored at key (and, for a wide
+  RowTable, its per-column objects), retiring the column objects it replaces.
+  serialized is True iff the base is exactly the table's serialized form.
+  Returns (sidecar, the base's meta).
+  '''
+  old_sidecar = storage_manager.get_object(columns_key(key))
+  now = time.time()
+  retired = []
+  if old_sidecar is not None:
+    old_sidecar = _parse(old_sidecar)
+    retired = old_sidecar.get('retired') or []
+    if old_sidecar.get('columns'):
+      retired.append({'columns': old_sidecar['columns'], 'at': now})
+  expired = [entry for entry in retired if now - entry['at'] >= JOURNAL_RETENTION]
+  base_meta = storage_manager.get_meta(key)
+  schema = table_data.get('schema', [])
+  rows = table_data.get('rows') if table_data.get('type') == 'RowTable' else None
+  sidecar = {
+    'base_etag': base_meta.etag if base_meta else None,
+    'schema': schema,
+    'row_count': len(rows) if rows is not None else None,
+    'indexes': declared_indexes,
+    'serialized': serialized,
+    'columns': None,
+    'retired': [entry for entry in retired if entry not in expired]
+  }
+  if rows is not None:
+    (sidecar['head'], sidecar['tail']) = head_and_tail(rows, PREVIEW_ROWS, PREVIEW_ROWS)
+  if rows is not None and len(schema) >= COLUMNAR_MIN_COLUMNS:
+    generation = uuid.uuid4().hex[:12]
+    sidecar['columns'] = [column_key(key, generation, index) for index in range(len(schema))]
+    for (index, column) in enumerate(sidecar['columns']):
+      storage_manager.put_object(column, dumps([row[index] for row in rows], default=json_serialize))
+  storage_manager.put_object(columns_key(key), dumps(sidecar))
+  for entry in expired:
+    for column in entry['columns']:
+      storage_manager.delete_object(column)
+  return (sidecar, base_meta)
+
+
+def delete_columns(storage_manager, key: str) -> None:
+  '''
+  Delete the sidecar of the table at key and all its column objects, retired or not
+  '''
+  sidecar = storage_manager.get_object(columns_key(key))
+  if sidecar is None:
+    return
+  storage_manager.delete_object(columns_key(key))
+  sidecar = _parse(sidecar)
+  for columns in [sidecar.get('columns') or []] + [entry['columns'] for entry in sidecar.get('retired') or []]:
+    for column in columns:
+      storage_manager.delete_object(column)
@@ -0,0 +1,119 @@
+'''
+table_freshness.py -- Whether each cached table is still current.
+
+While the change journal (change_journal.py) is being polled, a cached table is current
+unless a change to it has been journalled since its load began: each journalled change
+(and each restart of the journal, after which changes may have been missed) takes a
+new sequence number, and each cached table records the number current when its load
+began.  Without the journal, a cached table is revalidated on each request, or once
+every TABLE_CACHE_TTL seconds.  A table found to have changed may be served stale for
+up to TABLE_CACHE_STALE seconds while it is reloaded in the background, and hot tables
+(REFRESH_AHEAD_HITS requests since they were last checked) are rechecked before their
+TTL runs out.  The TTL and staleness policy is applied by GDPTableManager.get_table;
+this module keeps the state it needs.
+'''
+import time
+from typing import Optional
+from src.config import REFRESH_AHEAD_HITS
+
+
+class TableFreshness:
+  '''
+  The freshness of the tables one process has cached.  Not thread-safe: the caller
+  holds the lock guarding its cache around every call.
+  '''
+  def __init__(self):
+    # The journal sequence number, when each cached table's load began, and when each
+    # table (or, after a reset, every table) was last changed elsewhere
+    self.seq = 0
+    self._cache_seq = {}
+    self._changed_seq = {}
+    self._reset_seq = 0
+    # When each cached table was last known current, the requests served since then,
+    # when it was first seen to have changed, and the refreshes in flight
+    self._validated_at = {}
+    self._hits = {}
+    self._stale_since = {}
+    self._refreshing = set()
+
+  def cached(self, key, seq: Optional[int] = None) -> None:
+    '''
+    The table at key has just been cached, from a load which began at seq (default now)
+    '''
+    self._cache_seq[key] = self.seq if seq is None else seq
+    self._validated(key)
+    self._stale_since.pop(key, None)
+
+  def revalidated(self, key, seq: int) -> None:
+    '''
+    The cached table at key was found current by a check which began at seq
+    '''
+    self._cache_seq[key] = max(self._cache_seq.get(key, -1), seq)
+    self._validated(key)
+    self._stale_since.pop(key, None)
+
+  def _validated(self, key) -> None:
+    self._validated_at[key] = time.monotonic()
+    self._hits[key] = 0
+
+  def forget(self, key) -> None:
+    self._cache_seq.pop(key, None)
+    self._validated_at.pop(key, None)
+    self._hits.pop(key, None)
+    self._stale_since.pop(key, None)
+
+  def changed(self, key) -> None:
+    '''
+    The journal reports a change to the table at key
+    '''
+    self.seq += 1
+    self._changed_seq[key] = self.seq
+
+  def reset(self) -> None:
+    '''
+    Changes may have been missed: every cached table must be revalidated once
+    '''
+    self.seq += 1
+    self._reset_seq = self.seq
+
+  def is_current(self, key) -> bool:
+    '''
+    True iff the cached table at key was loaded (or revalidated) after the last
+    journalled change to it
+    '''
+    return self._cache_seq.get(key, -1) >= max(self._changed_seq.get(key, 0), self._reset_seq)
+
+  def hit(self, key) -> None:
+    self._hits[key] = self._hits.get(key, 0) + 1
+
+  def hot(self, key) -> bool:
+    return self._hits.get(key, 0) >= REFRESH_AHEAD_HITS
+
+  def age(self, key, now: float) -> float:
+    '''
+    Seconds since the cached table at key was last known current
+    '''
+    return now - self._validated_at.get(key, now)
+
+  def stale_since(self, key) -> Optional[float]:
+    return self._stale_since.get(key)
+
+  def mark_stale(self, key, since: float) -> float:
+    '''
+    Record that the cached table at key was seen to have changed at since, unless that
+    was already recorded.  Returns when it was first seen.
+    '''
+    return self._stale_since.setdefault(key, since)
+
+  def start_refresh(self, key) -> bool:
+    '''
+    True iff no refresh of the table at key is in flight; the caller must then refresh
+    it and call end_refresh
+    '''
+    if key in self._refreshing:
+      return False
+    self._refreshing.add(key)
+    return True
+
+  def end_refresh(self, key) -> None:
+    self._refreshing.discard(key)
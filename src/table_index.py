@@ -0,0 +1,233 @@
+'''
+table_index.py -- Secondary indexes over the rows of an in-memory RowTable.
+
+Two kinds of index are supported:
+  hash    value -> row positions; answers IN_LIST
+  sorted  (value, position) pairs in value order; answers IN_LIST, GE, GT, LE, LT
+          (and so IN_RANGE, which make_filter expands into GE/LE/GT/LT under ALL)
+
+candidate_positions() turns a filter into the positions of the rows which might match,
+or None if the filter can't be answered from the indexes.  Candidates are a superset of
+the matching rows: the caller always re-checks each candidate against the full filter,
+so an index only ever narrows the scan.  A selective query costs O(log n + k) rather
+than O(n).
+
+The indexes of a table are guarded by their own lock, so lookups on one table never
+wait for another table.  build() reads the table's rows without that lock, so its
+caller must keep the rows from changing while it runs.
+'''
+import threading
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Optional, Union
+from sdtp import InvalidDataException
+from sdtp.sdtp_filter import InListFilter, CompareFilter, GEFilter, GTFilter, LEFilter, AllFilter, AnyFilter
+
+INDEX_KINDS = ('hash', 'sorted')
+
+_INFINITY = float('inf')
+
+
+class HashIndex:
+  '''
+  A map from each value of a column to the (ascending) positions of the rows holding it
+  '''
+  kind = 'hash'
+
+  def __init__(self, rows: list, column_index: int):
+    self.column_index = column_index
+    self._positions: Dict = {}
+    for (position, row) in enumerate(rows):
+      self._positions.setdefault(row[column_index], []).append(position)
+
+  def lookup(self, values) -> List[int]:
+    result = []
+    for value in values:
+      result.extend(self._positions.get(value, ()))
+    return result
+
+  def add(self, position: int, value) -> None:
+    self._positions.setdefault(value, []).append(position)
+
+  def remove(self, position: int, value) -> None:
+    positions = self._positions.get(value)
+    if positions is not None and position in positions:
+      positions.remove(position)
+      if not positions:
+        del self._positions[value]
+
+
+class SortedIndex:
+  '''
+  The (value, position) pairs of a column, in value order.  None is not orderable and
+  never satisfies a comparison, so rows whose value is None are left out.
+  '''
+  kind = 'sorted'
+
+  def __init__(self, rows: list, column_index: int):
+    self.column_index = column_index
+    self._entries = sorted((row[column_index], position) for (position, row) in enumerate(rows) if row[column_index] is not None)
+
+  def range(self, low=None, low_inclusive=True, high=None, high_inclusive=True) -> List[int]:
+    '''
+    Positions of the rows whose value lies between low and high (either may be None,
+    meaning unbounded).  Raises TypeError if a bound can't be compared with the values.
+    '''
+    start = 0
+    end = len(self._entries)
+    if low is not None:
+      start = bisect_left(self._entries, (low, -1)) if low_inclusive else bisect_right(self._entries, (low, _INFINITY))
+    if high is not None:
+      end = bisect_right(self._entries, (high, _INFINITY)) if high_inclusive else bisect_left(self._entries, (high, -1))
+    return [position for (value, position) in self._entries[start:end]]
+
+  def lookup(self, values) -> List[int]:
+    result = []
+    for value in values:
+      if value is not None:
+        result.extend(self.range(value, True, value, True))
+    return result
+
+  def add(self, position: int, value) -> None:
+    if value is not None:
+      insort(self._entries, (value, position))
+
+  def remove(self, position: int, value) -> None:
+    if value is None:
+      return
+    index = bisect_left(self._entries, (value, position))
+    if index < len(self._entries) and self._entries[index] == (value, position):
+      del self._entries[index]
+
+
+_INDEX_CLASSES = {'hash': HashIndex, 'sorted': SortedIndex}
+
+
+class TableIndexes:
+  '''
+  The indexes built over one RowTable, keyed by column name.  The indexes hold row
+  positions, so they must be told about every change to the table's rows
+  (row_added, row_replaced).
+  '''
+  def __init__(self, table):
+    self.table = table
+    self.columns = table.column_names()
+    self.indexes: Dict[str, Dict[str, Union[HashIndex, SortedIndex]]] = {}
+    self.lock = threading.Lock()
+
+  def build(self, column: str, kind: str) -> None:
+    '''
+    Index column with an index of kind.  The caller must keep the table's rows from
+    changing until this returns; the index is only published once it is complete.
+    '''
+    if kind not in _INDEX_CLASSES:
+      raise InvalidDataException(f'Index kind must be one of {INDEX_KINDS}, not {kind}')
+    if column not in self.columns:
+      raise InvalidDataException(f'{column} is not a column of the table')
+    if self.has(column, kind):
+      return
+    index = _INDEX_CLASSES[kind](self.table.rows, self.columns.index(column))
+    with self.lock:
+      self.indexes = {**self.indexes, column: {**self.indexes.get(column, {}), kind: index}}
+
+  def has(self, column: str, kind: str) -> bool:
+    return kind in self.indexes.get(column, {})
+
+  def _sorted(self, column: str) -> SortedIndex:
+    index = self.indexes[column]['sorted']
+    assert isinstance(index, SortedIndex)
+    return index
+
+  def row_added(self, position: int, row: list) -> None:
+    with self.lock:
+      for indexes in self.indexes.values():
+        for index in indexes.values():
+          index.add(position, row[index.column_index])
+
+  def row_replaced(self, position: int, old_row: list, new_row: list) -> None:
+    with self.lock:
+      for indexes in self.indexes.values():
+        for index in indexes.values():
+          index.remove(position, old_row[index.column_index])
+          index.add(position, new_row[index.column_index])
+
+  def _bounds(self, compare_filters: list) -> tuple:
+    # Fold a list of comparisons on one column into (low, low_inclusive, high, high_inclusive)
+    low = high = None
+    low_inclusive = high_inclusive = True
+    for f in compare_filters:
+      value = f._compare_value
+      if isinstance(f, (GEFilter, GTFilter)):
+        inclusive = isinstance(f, GEFilter)
+        if low is None or value > low or (value == low and not inclusive):
+          (low, low_inclusive) = (value, inclusive)
+      else:
+        inclusive = isinstance(f, LEFilter)
+        if high is None or value < high or (value == high and not inclusive):
+          (high, high_inclusive) = (value, inclusive)
+    return (low, low_inclusive, high, high_inclusive)
+
+  def candidate_positions(self, filter) -> Optional[set]:
+    '''
+    Return a set of row positions which includes every row matching filter, or None if
+    the filter can't be answered from the indexes (the caller should scan).
+    '''
+    try:
+      with self.lock:
+        return self._candidates(filter)
+    except TypeError:
+      # a filter value which doesn't compare with the column's values
+      return None
+
+  def _candidates(self, filter) -> Optional[set]:
+    if isinstance(filter, InListFilter):
+      indexes = self.indexes.get(filter.column, {})
+      index = indexes.get('hash') or indexes.get('sorted')
+      return None if index is None else set(index.lookup(filter._compare_values))
+    if isinstance(filter, CompareFilter):
+      if not self.has(filter.column, 'sorted'):
+        return None
+      return set(self._sorted(filter.column).range(*self._bounds([filter])))
+    if isinstance(filter, AllFilter):
+      # Comparisons on the same column (e.g. an expanded IN_RANGE) become one range scan
+      comparisons: Dict[str, list] = {}
+      others = []
+      for argument in filter.arguments:
+        if isinstance(argument, CompareFilter) and self.has(argument.column, 'sorted'):
+          comparisons.setdefault(argument.column, []).append(argument)
+        else:
+          others.append(argument)
+      candidate_sets = [set(self._sorted(column).range(*self._bounds(filters))) for (column, filters) in comparisons.items()]
+      for argument in others:
+        candidates = self._candidates(argument)
+        if candidates is not None:
+          candidate_sets.append(candidates)
+      if not candidate_sets:
+        return None
+      candidate_sets.sort(key=len)
+      return candidate_sets[0].intersection(*candidate_sets[1:])
+    if isinstance(filter, AnyFilter):
+      result = set()
+      for argument in filter.arguments:
+        candidates = self._candidates(argument)
+        if candidates is None:
+          return None
+        result |= candidates
+      return result
+    return None
+
+
+def indexable_columns(filter) -> Dict[str, str]:
+  '''
+  The columns of filter which an index could serve, with the kind of index each needs
+  '''
+  if isinstance(filter, InListFilter):
+    return {filter.column: 'hash'}
+  if isinstance(filter, CompareFilter):
+    return {filter.column: 'sorted'}
+  if isinstance(filter, (AllFilter, AnyFilter)):
+    result = {}
+    for argument in filter.arguments:
+      for (column, kind) in indexable_columns(argument).items():
+        result[column] = 'sorted' if 'sorted' in (kind, result.get(column)) else kind
+    return result
+  return {}
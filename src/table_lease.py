@@ -0,0 +1,85 @@
+'''
+table_lease.py -- Leases which let one process at a time update a table.
+
+A lease is a small object in storage, created with a conditional write
+(put_object_if_match), so of the workers and replicas racing for it exactly one gets
+it.  It holds an expiry time: a lease left behind by a holder which died is taken over
+once it has expired, again by a conditional write against the expired lease.  The
+holder deletes the lease when it is done.  A holder which overruns its lease can be
+overtaken, so the writes made under a lease, and its release, are conditional as well.
+'''
+import time
+import uuid
+from json import dumps, loads
+from src.config import TABLE_LEASE_TTL, TABLE_LEASE_WAIT
+
+# Conditional writes tried before an update gives up
+UPDATE_ATTEMPTS = 5
+
+
+class GDPTableBusyException(Exception):
+  '''
+  Raised when a table is being updated by another process for longer than a writer waits
+  '''
+  def __init__(self, key):
+    self.message = f'Table {key} is being updated by another process; try again'
+    self.key = key
+    super().__init__(self.message)
+
+
+def _expires(lease) -> float:
+  try:
+    return float((loads(lease) if isinstance(lease, str) else lease)['expires'])
+  except (ValueError, TypeError, KeyError):
+    return 0.0
+
+
+class TableLease:
+  '''
+  Context manager which holds the lease on a table while it is updated.
+  Arguments:
+    storage_manager: the GDPStorageManager shared by the writers
+    key: the key of the table
+    lease_key: the key of its lease object
+    ttl: seconds after which a lease which hasn't been released may be taken over
+    wait: seconds to wait for the lease before raising GDPTableBusyException
+  '''
+  POLL_INTERVAL = 0.05
+
+  def __init__(self, storage_manager, key: str, lease_key: str, ttl: float = TABLE_LEASE_TTL, wait: float = TABLE_LEASE_WAIT):
+    self.storage_manager = storage_manager
+    self.key = key
+    self.lease_key = lease_key
+    self.ttl = ttl
+    self.wait = wait
+    self._meta = None
+
+  def _try_acquire(self) -> bool:
+    lease = dumps({'holder': uuid.uuid4().hex, 'expires': time.time() + self.ttl})
+    self._meta = self.storage_manager.put_object_if_match(self.lease_key, lease, None)
+    if self._meta is not None:
+      return True
+    # Read the meta before the lease, so a lease renewed in between fails the takeover
+    current_meta = self.storage_manager.get_meta(self.lease_key)
+    if current_meta is None:
+      return False
+    current = self.storage_manager.get_object(self.lease_key)
+    if current is None or _expires(current) >= time.time():
+      return False
+    self._meta = self.storage_manager.put_object_if_match(self.lease_key, lease, current_meta)
+    return self._meta is not None
+
+  def __enter__(self):
+    deadline = time.monotonic() + self.wait
+    while not self._try_acquire():
+      if time.monotonic() >= deadline:
+        raise GDPTableBusyException(self.key)
+      time.sleep(self.POLL_INTERVAL)
+    return self
+
+  def __exit__(self, *exc):
+    # Only delete the lease if it is still this one: a holder which overran it may have
+    # been overtaken
+    if self._meta is not None:
+      self.storage_manager.delete_object_if_match(self.lease_key, self._meta)
+    return False
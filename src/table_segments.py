@@ -0,0 +1,105 @@
+'''
+table_segments.py -- Rows added to a table without rewriting it.
+
+Each update (an append, or a patch keyed on a column) is stored as a segment object of
+its own, and the segments are listed in a manifest, <table>.segs = {"base_etag": etag,
+"segments": [keys]}, which names the base table they apply to.  A table is loaded by
+reading the base and merging its segments in order.  Compaction rewrites the base with
+all the rows, so a reader which sees a new base with an old manifest just ignores the
+old segments.
+'''
+import uuid
+from json import loads
+from typing import Optional
+
+
+def table_stem(table_key: str) -> str:
+  if table_key.endswith('.sdml'):
+    return table_key[:-5]
+  raise ValueError("Table key does not end with '.sdml'")
+
+
+def segments_key(table_key: str) -> str:
+  '''
+  Key of the manifest listing the row segments appended to the table at table_key
+  '''
+  return table_stem(table_key) + '.segs'
+
+
+def segment_key(table_key: str) -> str:
+  '''
+  A new, unique key for a segment of the table at table_key, so that writers racing
+  on the same table can never overwrite each other's segments
+  '''
+  return f'{table_stem(table_key)}.seg.{uuid.uuid4().hex}'
+
+
+def pending_segments(manifest, base_meta) -> bool:
+  '''
+  True iff manifest lists segments not yet merged into the base whose meta is base_meta
+  '''
+  return manifest is not None and manifest.get('base_etag') == base_meta.etag and len(manifest.get('segments', [])) > 0
+
+
+def read_manifest(storage_manager, key: str, meta=None) -> tuple:
+  '''
+  Returns (meta, manifest) for the segment manifest of the table at key, or (None, None)
+  if it has none.  meta, if given, is the manifest's meta, already read.
+  '''
+  manifest_key = segments_key(key)
+  if meta is None:
+    meta = storage_manager.get_meta(manifest_key)
+    if meta is None:
+      return (None, None)
+  manifest = storage_manager.get_object(manifest_key)
+  if manifest is None:
+    return (None, None)
+  return (meta, loads(manifest) if isinstance(manifest, str) else manifest)
+
+
+def delete_segments(storage_manager, key: str, manifest) -> None:
+  '''
+  Delete the manifest of the table at key, and the segments it lists
+  '''
+  if manifest is None:
+    return
+  storage_manager.delete_object(segments_key(key))
+  for seg_key in manifest.get('segments', []):
+    storage_manager.delete_object(seg_key)
+
+
+def merge_segment(table, rows: list, segment: dict, positions: Optional[dict], position_column: Optional[int], indexes) -> None:
+  '''
+  Merge rows, the typed rows of segment, into table.  Costs O(rows in the segment).
+  Arguments:
+    table: the RowTable
+    rows: the segment's rows, converted to the table's column types
+    segment: {"op": "append" | "patch", "key_column": column (patches only), "rows": rows}
+    positions: None, or a map value -> row index of column position_column, kept up to
+      date here; a patch needs the map of its key column
+    position_column: the index of the column positions maps
+    indexes: None, or the table's TableIndexes, which are told of each row changed
+  '''
+  if segment.get('op') == 'patch':
+    assert positions is not None and position_column is not None, 'a patch needs the positions of its key column'
+    for row in rows:
+      position = positions.get(row[position_column])
+      if position is None:
+        position = positions[row[position_column]] = len(table.rows)
+        table.rows.append(row)
+        if indexes is not None:
+          indexes.row_added(position, row)
+      else:
+        old_row = table.rows[position]
+        table.rows[position] = row
+        if indexes is not None:
+          indexes.row_replaced(position, old_row, row)
+    return
+  start = len(table.rows)
+  if positions is not None:
+    for (i, row) in enumerate(rows):
+      positions.setdefault(row[position_column], start + i)
+  table.rows.extend(rows)
+  if indexes is not None:
+    for (i, row) in enumerate(rows):
+      indexes.row_added(start + i, row)
@@ -0,0 +1,72 @@
+'''
+ttl_cache.py -- A small, thread-safe, size-bounded cache with per-entry expiry.
+
+Entries are evicted least-recently-used first once the cache is full, and are
+dropped on lookup once they have expired.  None is a legitimate cached value, which
+is what lets callers cache negative results ("this token is invalid", "this key
+doesn't exist"); lookup() reports hit/miss separately from the value.
+'''
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class TTLCache:
+  '''
+  A bounded LRU cache whose entries expire ttl seconds after they are stored.
+  Arguments:
+    max_size: maximum number of entries held
+    ttl: default lifetime of an entry, in seconds
+  '''
+  def __init__(self, max_size: int = 1024, ttl: float = 60.0):
+    self.max_size = max_size
+    self.ttl = ttl
+    self._entries: OrderedDict = OrderedDict()
+    self._lock = threading.Lock()
+
+  def lookup(self, key: Hashable) -> Tuple[bool, Any]:
+    '''
+    Look up key.
+    Returns:
+      (True, value) if there is an unexpired entry for key, (False, None) otherwise
+    '''
+    now = time.monotonic()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return (False, None)
+      (expires, value) = entry
+      if expires <= now:
+        del self._entries[key]
+        return (False, None)
+      self._entries.move_to_end(key)
+      return (True, value)
+
+  def put(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+    '''
+    Store value under key for ttl seconds (the cache's default ttl if None)
+    '''
+    lifetime = self.ttl if ttl is None else ttl
+    if lifetime <= 0 or self.max_size <= 0:
+      return
+    with self._lock:
+      self._entries[key] = (time.monotonic() + lifetime, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def invalidate(self, key: Hashable) -> None:
+    '''
+    Drop the entry for key, if any
+    '''
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self):
+    with self._lock:
+      return len(self._entries)
@@ -5,10 +5,11 @@ import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 print(sys.path)
+# The apps the tests create don't poll the change journal: the pollers would outlive them
+os.environ.setdefault('GDP_JOURNAL_POLL_INTERVAL', '0')
 
 import types
 import pytest
-import logging
 
 
 # --- Mock/Fake auth_helpers module ---
@@ -27,6 +28,8 @@ def authenticated(fn):
         }
         user = USERS.get(user_key, None)
         g.current_user = user
+        from src.profiling import start_request_profile
+        start_request_profile(user)
         return fn(user, *args, **kwargs)
     return wrapper
 
@@ -0,0 +1,56 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from src.hub_client import HubClient
+
+
+class FakeHubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    calls = {}
+    def do_GET(self):
+        FakeHubHandler.calls[self.path] = FakeHubHandler.calls.get(self.path, 0) + 1
+        if self.path == '/hub/api/user' and self.headers.get('Authorization') == 'token good':
+            self._reply(200, {'name': 'aiko@ai'})
+        elif self.path == '/hub/api/flaky' and FakeHubHandler.calls[self.path] == 1:
+            self._reply(503, {})
+        elif self.path == '/hub/api/flaky':
+            self._reply(200, {'ok': True})
+        else:
+            self._reply(403, {})
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def hub_url():
+    FakeHubHandler.calls = {}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeHubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/hub/api/'
+    server.shutdown()
+
+
+def test_get_and_stats(hub_url):
+    client = HubClient(hub_url, retries=0)
+    assert client.get('user', 'good').json() == {'name': 'aiko@ai'}
+    assert client.get('/user', 'bad').status_code == 403
+    stats = client.stats()
+    assert stats['requests'] == 2
+    assert stats['errors'] == 0
+    assert stats['status_counts'] == {200: 1, 403: 1}
+
+
+def test_retry_on_gateway_error(hub_url):
+    client = HubClient(hub_url, retries=2, backoff=0)
+    response = client.get('flaky', 'good')
+    assert response.status_code == 200
+    assert FakeHubHandler.calls['/hub/api/flaky'] == 2
@@ -0,0 +1,38 @@
+import json
+import logging
+import pytest
+from src.log_config import JsonFormatter, parse_levels, configure_logging, flush
+
+
+def test_parse_levels():
+    assert parse_levels('src.routes.repo=debug, werkzeug=WARNING,') == {'src.routes.repo': logging.DEBUG, 'werkzeug': logging.WARNING}
+    assert parse_levels('') == {}
+    with pytest.raises(ValueError):
+        parse_levels('werkzeug')
+    with pytest.raises(ValueError):
+        parse_levels('werkzeug=LOUD')
+
+def test_json_formatter():
+    record = logging.LogRecord('src.test', logging.INFO, __file__, 1, 'loaded %s', ('t.sdml',), None)
+    record.table = 't.sdml'
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == 'loaded t.sdml'
+    assert entry['level'] == 'INFO'
+    assert entry['logger'] == 'src.test'
+    assert entry['table'] == 't.sdml'
+
+def test_queued_logging_and_levels(capsys):
+    configure_logging('INFO', 'src.test.noisy=DEBUG')
+    flush()
+    logging.getLogger('src.test.quiet').debug('dropped %s', 1)
+    logging.getLogger('src.test.quiet').info('kept %s', 2)
+    logging.getLogger('src.test.noisy').debug('kept %s', 3)
+    flush()
+    out = capsys.readouterr().out
+    assert 'dropped 1' not in out
+    assert 'kept 2' in out and 'kept 3' in out
+    configure_logging('INFO', '')
+    assert logging.getLogger('src.test.noisy').level == logging.NOTSET
+    with capsys.disabled():
+        # Leave the listener writing to the real stdout
+        flush()
@@ -0,0 +1,85 @@
+from src.metrics import Metrics, METRICS
+
+
+def test_histogram_render():
+    metrics = Metrics(enabled=True)
+    metrics.observe_request('sdtp.get_tables', 200, 0.003)
+    metrics.observe_request('sdtp.get_tables', 200, 20)
+    text = metrics.render()
+    assert 'gdp_request_seconds_bucket{endpoint="sdtp.get_tables",worker=' in text
+    assert 'le="0.005"} 1' in text
+    assert 'le="+Inf"} 2' in text
+    assert 'gdp_requests_total{endpoint="sdtp.get_tables",status="200"' in text
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics(enabled=False)
+    with metrics.stage('parse'):
+        pass
+    metrics.count_cache('table', True)
+    assert 'gdp_stage_seconds_count' not in metrics.render()
+    assert 'gdp_cache_requests_total{' not in metrics.render()
+
+def test_metrics_shared_between_workers(tmp_path):
+    import os
+    metrics = Metrics(enabled=True)
+    metrics.share(str(tmp_path))
+    metrics.observe_request('sdtp.get_tables', 200, 0.003)
+    pid = os.fork()
+    if pid == 0:
+        # a second worker
+        metrics.observe_request('sdtp.get_tables', 200, 0.003)
+        metrics.write_snapshot()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    text = metrics.render()
+    # 1 request here and 2 in the child (which inherited the first)
+    assert 'gdp_requests_total{endpoint="sdtp.get_tables",status="200"} 3' in text
+    assert 'worker=' not in text
+    # A retired worker's counts are kept
+    metrics.retire_worker(pid)
+    assert not (tmp_path / f'worker-{pid}.json').exists()
+    assert 'gdp_requests_total{endpoint="sdtp.get_tables",status="200"} 3' in metrics.render()
+
+def test_metrics_endpoint(client, tables_setup):
+    hits_before = METRICS.cache_requests.value(('table', 'hit'))
+    client.get('/services/gdp/get_table_schema?table=aiko@ai/table_1.sdml')
+    client.post('/services/gdp/get_filtered_rows', json={'table': 'aiko@ai/table_1.sdml'})
+    assert METRICS.cache_requests.value(('table', 'hit')) == hits_before + 2
+    resp = client.get('/services/gdp/metrics')
+    assert resp.status_code == 200
+    text = resp.get_data(as_text=True)
+    assert 'gdp_request_seconds_count{endpoint="sdtp.get_table_schema"' in text
+    assert 'gdp_stage_seconds_count{endpoint="sdtp.get_filtered_rows",stage="filter"' in text
+    assert 'gdp_stage_seconds_count{endpoint="sdtp.get_filtered_rows",stage="permission"' in text
+
+def test_request_profiling(client, tables_setup, tmp_path, monkeypatch):
+    import pstats
+    import src.profiling
+    import src.routes.profiles
+    monkeypatch.setattr(src.profiling, 'PROFILE_ADMINS', ['aiko@ai'])
+    monkeypatch.setattr(src.profiling, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(src.routes.profiles, 'PROFILE_DIR', str(tmp_path))
+    body = {'table': 'aiko@ai/table_1.sdml'}
+    resp = client.post('/services/gdp/get_filtered_rows', headers={'Authorization': 'userA', 'X-GDP-Profile': 'cprofile'}, json=body)
+    assert resp.status_code == 200
+    name = resp.headers['X-GDP-Profile']
+    assert name.endswith('.prof')
+    assert pstats.Stats(str(tmp_path / name)).get_stats_profile().func_profiles
+    resp = client.get('/services/gdp/get_all_values?table=aiko@ai/table_1.sdml&column=name&gdp_profile=sample', headers={'Authorization': 'userA'})
+    assert resp.headers['X-GDP-Profile'].endswith('.folded')
+    # Only admins get (and can read) profiles; nobody else even starts a profiler
+    started = []
+    start_profiler = src.profiling.start_profiler
+    monkeypatch.setattr(src.profiling, 'start_profiler', lambda mode: started.append(mode) or start_profiler(mode))
+    resp = client.post('/services/gdp/get_filtered_rows', headers={'Authorization': 'userB', 'X-GDP-Profile': 'cprofile'}, json=body)
+    assert resp.status_code == 200
+    assert 'X-GDP-Profile' not in resp.headers
+    assert started == []
+    with src.profiling._profiling:
+        resp = client.post('/services/gdp/get_filtered_rows', headers={'Authorization': 'userA', 'X-GDP-Profile': 'cprofile'}, json=body)
+    assert resp.headers['X-GDP-Profile'] == 'busy'
+    assert len(list(tmp_path.iterdir())) == 2
+    assert client.get(f'/services/gdp/profiles/{name}', headers={'Authorization': 'userB'}).status_code == 403
+    assert client.get(f'/services/gdp/profiles/{name}', headers={'Authorization': 'userA'}).status_code == 200
+    # No header, no profile
+    assert 'X-GDP-Profile' not in client.post('/services/gdp/get_filtered_rows', headers={'Authorization': 'userA'}, json=body).headers
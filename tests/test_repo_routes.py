@@ -1,6 +1,6 @@
 # tests/test_repo_routes.py
 
-from helpers import run_and_check_result, run_and_check_post_result
+from helpers import run_and_check_result
 from flask import current_app
 
 
@@ -144,3 +144,101 @@ def test_share_bad_list(client, tables_setup):
   
 
 # ...and any other core endpoints (update, unshare, etc.)
+
+def test_append_and_patch(client, tables_setup):
+  route = "/services/gdp/table?table=aiko@ai/table_1.sdml"
+  response = client.post('/services/gdp/append/table_1.sdml', headers={'Authorization': 'userA'}, json={'rows': [[3, "Carol"]]})
+  assert response.status_code == 200
+  assert response.get_json() == {'table': 'aiko@ai/table_1.sdml', 'rows': 3}
+  response = client.post('/services/gdp/patch/table_1', headers={'Authorization': 'userA'}, json={'key_column': 'id', 'rows': [[1, "Alicia"]]})
+  assert response.status_code == 200
+  assert client.get(route).get_json()['rows'] == [[1, "Alicia"], [2, "Bob"], [3, "Carol"]]
+  response = client.post('/services/gdp/patch/table_1', headers={'Authorization': 'userA'}, json={'rows': [[1, "Alicia"]]})
+  assert response.status_code == 400
+  response = client.post('/services/gdp/append/table_1.sdml', headers={'Authorization': 'userA'}, json={'rows': [[3]]})
+  assert response.status_code == 400
+  response = client.post('/services/gdp/append/nope.sdml', headers={'Authorization': 'userA'}, json={'rows': [[3, "Carol"]]})
+  assert response.status_code == 404
+  response = client.post('/services/gdp/append/table_1.sdml', json={'rows': [[3, "Carol"]]})
+  assert response.status_code == 400
+
+def test_list_tables_page(client, tables_setup):
+  resp = client.get('/services/gdp/tables?limit=2', headers={"Authorization": "userB"})
+  assert resp.status_code == 200
+  page = resp.get_json()
+  assert [table['key'] for table in page['tables']] == ['aiko@ai/table_1.sdml', 'aiko@ai/table_2.sdml']
+  assert page['tables'][0] == {'key': 'aiko@ai/table_1.sdml', 'owner': 'aiko@ai', 'name': 'table_1.sdml', 'row_count': 2, 'size': page['tables'][0]['size']}
+  resp = client.get(f'/services/gdp/tables?limit=2&start={page["next"]}', headers={"Authorization": "userB"})
+  page = resp.get_json()
+  assert [table['key'] for table in page['tables']] == ['rick@ai/table_3.sdml', 'rick@ai/table_4.sdml']
+  assert page['next'] is None
+  resp = client.get('/services/gdp/tables?search=TABLE_3', headers={"Authorization": "userC"})
+  assert [table['key'] for table in resp.get_json()['tables']] == ['rick@ai/table_3.sdml']
+  resp = client.get('/services/gdp/tables?prefix=rick@ai/&sort=name&order=desc', headers={"Authorization": "userC"})
+  assert [table['key'] for table in resp.get_json()['tables']] == ['rick@ai/table_4.sdml', 'rick@ai/table_3.sdml']
+  resp = client.get('/services/gdp/tables?start=0')
+  assert [table['key'] for table in resp.get_json()['tables']] == ['aiko@ai/table_1.sdml']
+  assert client.get('/services/gdp/tables?sort=color').status_code == 400
+  assert client.get('/services/gdp/tables?limit=many').status_code == 400
+
+def test_ui_table_pages(client, tables_setup):
+  import re
+  from html import unescape
+  headers = {"Authorization": "userC"}
+  def links(path):
+    resp = client.get(path, headers=headers)
+    assert resp.status_code == 200
+    return {name: unescape(href) for (href, name) in re.findall(r'<a href="([^"]*)">(Previous|Next)</a>', resp.get_data(as_text=True))}
+  first = links('/services/gdp/ui/view_tables/?limit=1&_anchor=x')
+  assert 'Previous' not in first and '_anchor' not in first['Next']
+  second = links(first['Next'])
+  assert 'back=0' in second['Next']
+  third = links(second['Next'])
+  # Previous goes back to where the second page began, whatever tables were skipped
+  assert links(third['Previous']) == second
+  assert 'Previous' not in links(second['Previous'])
+
+def test_download_ranges(client, tables_setup):
+  import json
+  route = "/services/gdp/table?table=aiko@ai/table_2.sdml"
+  headers = {"Authorization": "userA"}
+  full = client.get(route, headers=headers)
+  assert full.status_code == 200
+  assert full.headers['Accept-Ranges'] == 'bytes'
+  body = full.get_data()
+  etag = full.headers['ETag']
+  part = client.get(route, headers={**headers, "Range": "bytes=0-9"})
+  assert part.status_code == 206
+  assert part.headers['Content-Range'] == f'bytes 0-9/{len(body)}'
+  rest = client.get(route, headers={**headers, "Range": "bytes=10-", "If-Range": etag})
+  assert rest.status_code == 206
+  assert part.get_data() + rest.get_data() == body
+  assert client.get(route, headers={**headers, "Range": "bytes=-5"}).get_data() == body[-5:]
+  assert client.get(route, headers={**headers, "Range": f"bytes={len(body)}-"}).status_code == 416
+  assert client.get(route, headers={**headers, "Range": "bytes=10-", "If-Range": '"stale"'}).status_code == 200
+  # Appended rows not yet compacted are serialized, as a stream
+  client.post('/services/gdp/append/table_2.sdml', headers=headers, json={'rows': [[50, False]]})
+  appended = client.get(route, headers={**headers, "Range": "bytes=0-9"})
+  assert appended.status_code == 200
+  assert json.loads(appended.get_data())['rows'] == [[95, True], [70, False], [50, False]]
+
+def test_download_sends_the_serialized_table(app, client, tables_setup):
+  import json
+  from sdtp import json_serialize
+  headers = {"Authorization": "userA"}
+  table = {"type": "RowTable", "schema": [{"name": "id", "type": "number"}], "rows": [[1], [2]], "indexes": {"id": "hash"}}
+  with app.app_context():
+    manager = current_app.table_manager  # type: ignore[attr-defined]
+    manager.publish_table("aiko@ai/indexed.sdml", json.dumps(table, indent=4))
+    manager.update_access("aiko@ai/indexed.sdml", "aiko@ai", [])
+    expected = json.dumps(manager.get_table("aiko@ai/indexed.sdml").to_dictionary(), default=json_serialize)
+  response = client.get("/services/gdp/table?table=aiko@ai/indexed.sdml", headers=headers)
+  assert response.status_code == 200
+  assert response.get_data(as_text=True) == expected
+  assert 'indexes' not in response.get_json()
+
+def test_ui_download(client, tables_setup):
+  resp = client.get('/services/gdp/ui/download/aiko@ai/table_1.sdml', headers={"Authorization": "userA"})
+  assert resp.status_code == 200
+  assert resp.headers['Content-Disposition'] == 'attachment; filename=table_1.sdml'
+  assert resp.get_json()['rows'] == [[1, "Alice"], [2, "Bob"]]
@@ -102,3 +102,84 @@ def test_get_filtered_rows(client, tables_setup):
   run_and_check_post_result(client, route, {"Authorization": "userA"}, body, 200, [[95, True]], 9 )
   body = {"table": "aiko@ai/table_2.sdml", "columns": ["score"],"filter_spec": {"operator": "IN_LIST", "column": "passed", "values": [True]}}
   run_and_check_post_result(client, route, {"Authorization": "userA"}, body, 200, [[95]], 10 )
+
+def test_get_aggregate(client, tables_setup):
+  route = "/services/gdp/get_aggregate"
+  count = [{"function": "count"}]
+  run_and_check_post_result(client, route, {"Authorization": "userA"}, {"table": "aiko@ai/table_2.sdml"}, 400, '', 0)
+  run_and_check_post_result(client, route, {"Authorization": "userC"}, {"table": "aiko@ai/table_2.sdml", "aggregates": count}, 401, '', 1)
+  body = {"table": "aiko@ai/table_2.sdml", "aggregates": [{"function": "sum", "column": "passed"}]}
+  run_and_check_post_result(client, route, {"Authorization": "userA"}, body, 400, '', 2)
+  body = {"table": "aiko@ai/table_2.sdml", "aggregates": [{"function": "median", "column": "score"}]}
+  run_and_check_post_result(client, route, {"Authorization": "userA"}, body, 400, '', 3)
+  body = {"table": "aiko@ai/table_2.sdml", "aggregates": count + [{"function": "sum", "column": "score"}, {"function": "mean", "column": "score"}, {"function": "min", "column": "score"}, {"function": "max", "column": "score"}]}
+  run_and_check_post_result(client, route, {"Authorization": "userA"}, body, 200, [[2, 165, 82.5, 70, 95]], 4)
+  body = {"table": "aiko@ai/table_2.sdml", "group_by": ["passed"], "aggregates": [{"function": "max", "column": "score", "name": "best"}], "format": "dict"}
+  run_and_check_post_result(client, route, {"Authorization": "userA"}, body, 200, [{"passed": True, "best": 95}, {"passed": False, "best": 70}], 5)
+  body = {"table": "aiko@ai/table_2.sdml", "aggregates": count, "filter_spec": {"operator": "IN_RANGE", "column": "score", "min_val": 80, "max_val": 100}, "format": "sdml"}
+  run_and_check_post_result(client, route, {"Authorization": "userA"}, body, 200, {"type": "RowTable", "schema": [{"name": "count", "type": "number"}], "rows": [[1]]}, 6)
+  body = {"table": "aiko@ai/table_2.sdml", "aggregates": count, "filter_spec": {"operator": "IN_LIST", "column": "score", "values": [1]}}
+  run_and_check_post_result(client, route, {"Authorization": "userA"}, body, 200, [[0]], 7)
+
+def test_batch(client, tables_setup):
+  route = "/services/gdp/batch"
+  run_and_check_post_result(client, route, {"Authorization": "userA"}, {"queries": "nope"}, 400, '', 0)
+  queries = [
+    {"op": "get_table_schema", "table": "aiko@ai/table_2.sdml"},
+    {"op": "get_range_spec", "table": "aiko@ai/table_2.sdml", "column": "score"},
+    {"op": "get_all_values", "table": "aiko@ai/table_1.sdml", "column": "name"},
+    {"op": "get_filtered_rows", "table": "aiko@ai/table_2.sdml", "columns": ["score"], "filter_spec": {"operator": "IN_LIST", "column": "passed", "values": [True]}},
+    {"op": "get_aggregate", "table": "aiko@ai/table_2.sdml", "aggregates": [{"function": "count"}]},
+    {"op": "get_range_spec", "table": "aiko@ai/table_2.sdml", "column": "nope"},
+    {"op": "get_column", "table": "aiko@ai/table_2.sdml"},
+    {"op": "get_table_schema", "table": "rick@ai/table_4.sdml"},
+    {"op": "get_table_schema", "table": "nope.sdml"},
+    {"op": "drop_table", "table": "aiko@ai/table_2.sdml"}
+  ]
+  expected = [
+    {"status": 200, "result": [{"name": "score", "type": "number"}, {"name": "passed", "type": "boolean"}]},
+    {"status": 200, "result": [70, 95]},
+    {"status": 200, "result": ["Alice", "Bob"]},
+    {"status": 200, "result": [[95]]},
+    {"status": 200, "result": [[2]]},
+  ]
+  resp = client.post(route, headers={"Authorization": "userA"}, json={"queries": queries})
+  assert resp.status_code == 200
+  results = resp.get_json()
+  assert results[:5] == expected
+  assert [result["status"] for result in results[5:]] == [400, 400, 401, 404, 400]
+
+def test_batch_checks_each_table_once(app, client, tables_setup):
+  manager = app.table_manager
+  calls = []
+  original = manager.get_table_if_permitted
+  manager.get_table_if_permitted = lambda key, user, is_hub_user: calls.append(key) or original(key, user, is_hub_user)
+  queries = [{"op": "get_range_spec", "table": "aiko@ai/table_2.sdml", "column": "score"} for i in range(5)]
+  resp = client.post("/services/gdp/batch", headers={"Authorization": "userA"}, json={"queries": queries})
+  assert resp.status_code == 200
+  assert calls == ["aiko@ai/table_2.sdml"]
+
+def test_identical_queries_are_coalesced(app, tables_setup):
+  import threading, time
+  manager = app.table_manager
+  calls = []
+  original = manager.filter_rows
+  def slow_filter_rows(*args, **kwargs):
+    calls.append(args[0])
+    time.sleep(0.2)
+    return original(*args, **kwargs)
+  manager.filter_rows = slow_filter_rows
+  body = {"table": "aiko@ai/table_2.sdml", "filter_spec": {"operator": "IN_RANGE", "column": "score", "min_val": 0, "max_val": 100}}
+  responses = {}
+  def query(name, user):
+    responses[name] = app.test_client().post("/services/gdp/get_filtered_rows", headers={"Authorization": user}, json=body)
+  threads = [threading.Thread(target=query, args=(i, "userA" if i % 2 else "userB")) for i in range(6)]
+  threads.append(threading.Thread(target=query, args=("denied", "userC")))
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert calls == ["aiko@ai/table_2.sdml"]
+  assert responses["denied"].status_code == 401
+  assert len({responses[i].get_data() for i in range(6)}) == 1
+  assert all(responses[i].status_code == 200 for i in range(6))
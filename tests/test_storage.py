@@ -0,0 +1,194 @@
+import time
+import pytest
+from src.gdp_storage import InMemoryStorageManager, SimulatedLatencyStorageManager, GDPStorageThrottledException, parse_latency_spec
+
+
+def test_simulated_latency_counts_and_delays():
+    storage = SimulatedLatencyStorageManager(InMemoryStorageManager(), latency={'get_object': 0.02})
+    storage.put_object('alice/t.sdml', '{"a": 1}')
+    start = time.perf_counter()
+    assert storage.get_object('alice/t.sdml') == '{"a": 1}'
+    assert time.perf_counter() - start >= 0.02
+    assert storage.key_exists('alice/t.sdml')
+    assert storage.get_meta('alice/t.sdml') is not None
+    assert storage.all_keys_matching(suffix='.sdml') == ['alice/t.sdml']
+    assert storage.call_counts == {'key_exists': 1, 'get_meta': 1, 'get_object': 1, 'get_range': 0, 'put_object': 1, 'delete_object': 0, 'list': 1}
+    storage.reset_counts()
+    assert sum(storage.call_counts.values()) == 0
+
+def test_simulated_throttling():
+    storage = SimulatedLatencyStorageManager(InMemoryStorageManager(), throttle_rate=1.0, seed=1)
+    with pytest.raises(GDPStorageThrottledException):
+        storage.key_exists('alice/t.sdml')
+    assert storage.throttled_counts['key_exists'] == 1
+
+def test_simulated_bandwidth():
+    storage = SimulatedLatencyStorageManager(InMemoryStorageManager(), bandwidth=10000)
+    start = time.perf_counter()
+    storage.put_object('alice/t.sdml', 'x' * 500)
+    assert time.perf_counter() - start >= 0.05
+
+def test_parse_latency_spec():
+    assert parse_latency_spec('get_object=20, get_meta=5') == {'get_object': 0.02, 'get_meta': 0.005}
+    assert parse_latency_spec('10')['list'] == 0.01
+    assert parse_latency_spec('') == {}
+
+
+def test_filesystem_round_trip(tmp_path):
+    from src.gdp_storage import GDPFileSystemStorageManager
+    storage = GDPFileSystemStorageManager(str(tmp_path))
+    assert storage.get_object('alice/t.sdml') is None
+    assert storage.get_meta('alice/t.sdml') is None
+    storage.put_object('alice/t.sdml', {'a': 1})
+    storage.put_object('alice/t.perm', 'not json')
+    storage.put_object('bob/u.sdml', '{"b": 2}')
+    assert storage.key_exists('alice/t.sdml')
+    assert storage.get_object('alice/t.sdml') == {'a': 1}
+    assert storage.get_object('alice/t.perm') == 'not json'
+    assert storage.get_object('bob/u.sdml') == {'b': 2}
+    assert sorted(storage.all_keys_matching(suffix='.sdml')) == ['alice/t.sdml', 'bob/u.sdml']
+    assert storage.all_keys_matching(prefix='alice/', suffix='.sdml') == ['alice/t.sdml']
+    assert storage.all_keys_matching(prefix='carol/') == []
+    storage.delete_object('alice/t.sdml')
+    storage.delete_object('alice/t.sdml')
+    assert not storage.key_exists('alice/t.sdml')
+
+def test_filesystem_get_range(tmp_path):
+    from src.gdp_storage import GDPFileSystemStorageManager
+    storage = GDPFileSystemStorageManager(str(tmp_path))
+    storage.put_object('alice/t.sdml', '0123456789')
+    storage.put_object('alice/empty.sdml', '')
+    assert storage.get_object('alice/empty.sdml') == ''
+    assert storage.get_range('alice/empty.sdml', 0, 1) == b''
+    assert storage.get_range('alice/t.sdml', 2, 5) == b'234'
+    assert storage.get_range('alice/t.sdml', 7) == b'789'
+    assert b''.join(storage.iter_range('alice/t.sdml', 1, 9, chunk_size=3)) == b'12345678'
+    assert storage.get_range('alice/missing.sdml', 0, 1) is None
+
+@pytest.mark.parametrize("backend", ["memory", "filesystem"])
+def test_ranges_pinned_to_a_version(backend, tmp_path):
+    from src.gdp_storage import GDPFileSystemStorageManager
+    storage = InMemoryStorageManager() if backend == "memory" else GDPFileSystemStorageManager(str(tmp_path), durable=False)
+    storage.put_object('alice/t.sdml', '0123456789')
+    meta = storage.get_meta('alice/t.sdml')
+    chunks = storage.iter_range('alice/t.sdml', 0, 10, chunk_size=4, expected=meta)
+    assert next(chunks) == b'0123'
+    storage.put_object('alice/t.sdml', 'abcdefghij')
+    assert list(chunks) in ([], [b'4567', b'89'])
+    assert storage.get_range('alice/t.sdml', 0, 4, expected=meta) is None
+    assert list(storage.iter_range('alice/t.sdml', 0, 10, expected=meta)) == []
+    assert storage.get_range('alice/t.sdml', 0, 4, expected=storage.get_meta('alice/t.sdml')) == b'abcd'
+
+def test_filesystem_etag_changes_on_write(tmp_path):
+    from src.gdp_storage import GDPFileSystemStorageManager
+    storage = GDPFileSystemStorageManager(str(tmp_path), durable=False)
+    storage.put_object('alice/t.sdml', {'a': 1})
+    first = storage.get_meta('alice/t.sdml')
+    storage.put_object('alice/t.sdml', {'a': 1})
+    second = storage.get_meta('alice/t.sdml')
+    assert first is not None and second is not None
+    assert first.etag != second.etag
+    assert second.size == len('{"a": 1}')
+    assert not [name for name in (tmp_path / 'alice').iterdir() if name.name.startswith('.gdp-tmp-')]
+
+@pytest.mark.parametrize("backend", ["memory", "filesystem"])
+def test_conditional_writes(backend, tmp_path):
+    from src.gdp_storage import GDPFileSystemStorageManager
+    storage = InMemoryStorageManager() if backend == "memory" else GDPFileSystemStorageManager(str(tmp_path))
+    first = storage.put_object_if_match('alice/t.segs', '{"n": 1}', None)
+    meta = storage.get_meta('alice/t.segs')
+    assert first is not None and meta is not None and first.etag == meta.etag
+    # It exists now, and a write against a stale version fails
+    assert storage.put_object_if_match('alice/t.segs', '{"n": 2}', None) is None
+    second = storage.put_object_if_match('alice/t.segs', '{"n": 2}', first)
+    assert second is not None
+    assert storage.put_object_if_match('alice/t.segs', '{"n": 3}', first) is None
+    assert storage.get_object('alice/t.segs') in ('{"n": 2}', {"n": 2})
+    assert not storage.delete_object_if_match('alice/t.segs', first)
+    assert storage.delete_object_if_match('alice/t.segs', second)
+    assert not storage.delete_object_if_match('alice/t.segs', second)
+    storage.put_object_if_match('alice/t.segs', '{"n": 3}', None)
+    assert storage.all_keys_matching() == ['alice/t.segs']
+
+def test_filesystem_rejects_bad_keys(tmp_path):
+    from src.gdp_storage import GDPFileSystemStorageManager
+    storage = GDPFileSystemStorageManager(str(tmp_path))
+    with pytest.raises(ValueError):
+        storage.put_object('../escape.sdml', {})
+    with pytest.raises(ValueError):
+        storage.get_object('/etc/passwd')
+
+def test_filesystem_with_table_manager(tmp_path):
+    from src.gdp_storage import GDPFileSystemStorageManager
+    from src.gdp_table_manager import GDPTableManager
+    table = {"type": "RowTable", "schema": [{"name": "id", "type": "number"}], "rows": [[1], [2]]}
+    GDPTableManager(GDPFileSystemStorageManager(str(tmp_path)), journal_poll_interval=0).publish_table('alice/t.sdml', table)
+    restarted = GDPTableManager(GDPFileSystemStorageManager(str(tmp_path)), journal_poll_interval=0)
+    assert restarted.get_table('alice/t.sdml').get_column('id') == [1, 2]
+    assert restarted.list_tables('alice') == ['alice/t.sdml']
+
+
+def test_local_cache_reads_through_and_validates_etag(tmp_path):
+    from src.gdp_storage import LocalCacheStorageManager
+    remote = SimulatedLatencyStorageManager(InMemoryStorageManager())
+    remote.put_object('alice/t.sdml', '{"v": 1}')
+    cache = LocalCacheStorageManager(remote, str(tmp_path / 'cache'))
+    assert cache.get_object('alice/t.sdml') == {'v': 1}
+    assert cache.get_object('alice/t.sdml') == {'v': 1}
+    assert remote.call_counts['get_range'] == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    # a write by another node changes the etag, so the next read refetches
+    remote.put_object('alice/t.sdml', '{"v": 2}')
+    assert cache.get_object('alice/t.sdml') == {'v': 2}
+    assert remote.call_counts['get_range'] == 2
+    # a hit straight after a get_meta asks for the meta only once
+    remote.reset_counts()
+    cache.get_meta('alice/t.sdml')
+    assert cache.get_object('alice/t.sdml') == {'v': 2}
+    assert remote.call_counts['get_meta'] == 1
+    # a plain write through drops the copy; a conditional one keeps it under the etag it made
+    cache.put_object('alice/t.sdml', '{"v": 3}')
+    assert remote.get_object('alice/t.sdml') == '{"v": 3}'
+    assert cache.get_object('alice/t.sdml') == {'v': 3}
+    assert remote.call_counts['get_range'] == 1
+    meta = cache.put_object_if_match('alice/t.sdml', '{"v": 4}', remote.get_meta('alice/t.sdml'))
+    assert meta is not None and cache._index['alice/t.sdml'][0] == meta.etag
+    assert cache.get_object('alice/t.sdml') == {'v': 4}
+    assert remote.call_counts['get_range'] == 1
+    cache.delete_object('alice/t.sdml')
+    assert cache.get_object('alice/t.sdml') is None
+
+def test_local_cache_survives_restart_and_evicts(tmp_path):
+    from src.gdp_storage import LocalCacheStorageManager
+    remote = SimulatedLatencyStorageManager(InMemoryStorageManager())
+    for name in ['a', 'b', 'c']:
+        remote.put_object(f'alice/{name}.sdml', 'x' * 40)
+    cache = LocalCacheStorageManager(remote, str(tmp_path), max_bytes=100)
+    for name in ['a', 'b', 'c']:
+        cache.get_object(f'alice/{name}.sdml')
+    assert cache._bytes == 80
+    assert 'alice/a.sdml' not in cache._index
+    remote.reset_counts()
+    restarted = LocalCacheStorageManager(remote, str(tmp_path), max_bytes=100)
+    assert restarted.get_object('alice/c.sdml') == 'x' * 40
+    assert remote.call_counts['get_object'] == 0
+
+def test_storage_backend_registry(tmp_path, monkeypatch):
+    import src.config
+    from src.gdp_storage import create_backend_storage_manager, register_storage_backend, STORAGE_BACKENDS, GDPFileSystemStorageManager
+    monkeypatch.setattr(src.config, 'LOCAL_STORAGE_DIR', str(tmp_path))
+    assert isinstance(create_backend_storage_manager('Local'), GDPFileSystemStorageManager)
+    assert isinstance(create_backend_storage_manager('MEMORY'), InMemoryStorageManager)
+    assert isinstance(create_backend_storage_manager('unknown'), InMemoryStorageManager)
+    assert isinstance(create_backend_storage_manager('src.gdp_storage:InMemoryStorageManager'), InMemoryStorageManager)
+    monkeypatch.setitem(STORAGE_BACKENDS, 'Test', lambda: SimulatedLatencyStorageManager(InMemoryStorageManager()))
+    assert isinstance(create_backend_storage_manager('Test'), SimulatedLatencyStorageManager)
+    register_storage_backend('Test', InMemoryStorageManager)
+    assert isinstance(create_backend_storage_manager('Test'), InMemoryStorageManager)
+
+def test_cloud_sdks_are_imported_lazily():
+    import subprocess, sys, os
+    script = "import sys, src.gdp_storage; print([m for m in ('google.cloud.storage', 'azure.storage.blob') if m in sys.modules])"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True, cwd=root).stdout
+    assert output.strip() == '[]'
@@ -0,0 +1,125 @@
+import random
+import pytest
+from sdtp import RowTable, InvalidDataException
+from sdtp.sdtp_filter import make_filter
+from src.table_index import TableIndexes
+from src.gdp_storage import InMemoryStorageManager
+import src.gdp_table_manager as table_manager
+from src.gdp_table_manager import GDPTableManager
+
+SCHEMA = [{"name": "id", "type": "number"}, {"name": "category", "type": "string"}, {"name": "score", "type": "number"}]
+
+FILTERS = [
+    {"operator": "IN_LIST", "column": "id", "values": [3, 17, 17, 400, 1000]},
+    {"operator": "IN_LIST", "column": "category", "values": ["cat_1", "missing"]},
+    {"operator": "IN_RANGE", "column": "score", "min_val": 10, "max_val": 20},
+    {"operator": "GT", "column": "score", "value": 90},
+    {"operator": "LT", "column": "score", "value": 5},
+    {"operator": "ALL", "arguments": [
+        {"operator": "IN_RANGE", "column": "score", "min_val": 0, "max_val": 50},
+        {"operator": "IN_LIST", "column": "category", "values": ["cat_2"]}
+    ]},
+    {"operator": "ANY", "arguments": [
+        {"operator": "GE", "column": "score", "value": 99},
+        {"operator": "IN_LIST", "column": "id", "values": [1, 2]}
+    ]},
+    {"operator": "GE", "column": "score", "value": "not a number"},
+]
+
+def _rows(count, seed=0):
+    rng = random.Random(seed)
+    return [[i, f'cat_{rng.randrange(4)}', rng.randrange(100)] for i in range(count)]
+
+def _scan(table, filter):
+    columns = table.column_names()
+    return [row for row in table.rows if filter.matches(row, columns)]
+
+def _indexed(table, indexes, filter):
+    candidates = indexes.candidate_positions(filter)
+    assert candidates is not None
+    columns = table.column_names()
+    return [table.rows[p] for p in sorted(candidates) if filter.matches(table.rows[p], columns)]
+
+
+def test_indexes_agree_with_scan():
+    table = RowTable(SCHEMA, _rows(500))
+    indexes = TableIndexes(table)
+    indexes.build("id", "hash")
+    indexes.build("category", "hash")
+    indexes.build("score", "sorted")
+    for spec in FILTERS[:-1]:
+        filter = make_filter(spec)
+        assert _indexed(table, indexes, filter) == _scan(table, filter)
+    # A value which doesn't compare with the column falls back to a scan
+    assert indexes.candidate_positions(make_filter(FILTERS[-1])) is None
+    # Only hash indexes on id: a range on score can't be answered
+    assert TableIndexes(table).candidate_positions(make_filter(FILTERS[2])) is None
+
+def test_indexes_follow_row_changes():
+    table = RowTable(SCHEMA, _rows(100))
+    indexes = TableIndexes(table)
+    indexes.build("id", "sorted")
+    indexes.build("score", "sorted")
+    indexes.build("category", "hash")
+    for row in _rows(20, seed=1):
+        row[0] += 100
+        table.rows.append(row)
+        indexes.row_added(len(table.rows) - 1, row)
+    for position in (0, 50, 110):
+        old_row = table.rows[position]
+        new_row = [old_row[0], 'cat_9', 1000]
+        table.rows[position] = new_row
+        indexes.row_replaced(position, old_row, new_row)
+    for spec in FILTERS[:-1] + [{"operator": "IN_LIST", "column": "category", "values": ["cat_9"]}]:
+        filter = make_filter(spec)
+        assert _indexed(table, indexes, filter) == _scan(table, filter)
+
+def test_manager_uses_declared_and_hot_indexes(monkeypatch):
+    monkeypatch.setattr(table_manager, 'INDEX_MIN_ROWS', 10)
+    monkeypatch.setattr(table_manager, 'INDEX_HOT_QUERIES', 2)
+    storage = InMemoryStorageManager()
+    tm = GDPTableManager(storage, journal_poll_interval=0)
+    rows = _rows(200)
+    tm.publish_table("alice/t.sdml", {"type": "RowTable", "schema": SCHEMA, "rows": rows, "indexes": {"id": "hash"}})
+    tm.update_access("alice/t.sdml", "alice", [])
+    table = tm.get_table("alice/t.sdml")
+    assert table is not None
+    assert tm._indexes["alice/t.sdml"].has("id", "hash")
+    # A fresh manager builds the declared index when it loads the table
+    other = GDPTableManager(storage, journal_poll_interval=0)
+    assert other._indexes.get("alice/t.sdml") is None
+    other.get_table("alice/t.sdml")
+    assert other._indexes["alice/t.sdml"].has("id", "hash")
+    score_range = FILTERS[2]
+    expected = table.get_filtered_rows(filter_spec=score_range, columns=["id"], format="dict")
+    for i in range(3):
+        assert tm.filter_rows("alice/t.sdml", table, score_range, ["id"], "dict") == expected
+    assert tm._indexes["alice/t.sdml"].has("score", "sorted")
+    tm.append_rows("alice/t.sdml", "alice", [[1000, "cat_1", 15]])
+    assert tm.filter_rows("alice/t.sdml", table, FILTERS[0], [], "list") == [[3, rows[3][1], rows[3][2]], [17, rows[17][1], rows[17][2]], [1000, "cat_1", 15]]
+    with pytest.raises(InvalidDataException):
+        tm.publish_table("alice/bad.sdml", {"type": "RowTable", "schema": SCHEMA, "rows": rows, "indexes": {"nope": "hash"}})
+
+def test_hot_indexes_built_during_appends_are_complete(monkeypatch):
+    import threading
+    monkeypatch.setattr(table_manager, 'INDEX_MIN_ROWS', 10)
+    monkeypatch.setattr(table_manager, 'INDEX_HOT_QUERIES', 1)
+    monkeypatch.setattr(table_manager, 'COMPACT_SEGMENTS', 1000)
+    tm = GDPTableManager(InMemoryStorageManager(), journal_poll_interval=0)
+    tm.publish_table("alice/t.sdml", {"type": "RowTable", "schema": SCHEMA, "rows": _rows(5000)})
+    tm.update_access("alice/t.sdml", "alice", [])
+    def append():
+        for i in range(40):
+            tm.append_rows("alice/t.sdml", "alice", [[5000 + i, "cat_new", 50]])
+    def query():
+        for spec in FILTERS[:-1] * 4:
+            table = tm.get_table("alice/t.sdml")
+            tm.filter_rows("alice/t.sdml", table, spec, [], "list")
+    threads = [threading.Thread(target=append), threading.Thread(target=query)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    table = tm.get_table("alice/t.sdml")
+    for spec in FILTERS[:-1] + [{"operator": "IN_LIST", "column": "category", "values": ["cat_new"]}]:
+        assert tm.filter_rows("alice/t.sdml", table, spec, [], "list") == _scan(table, make_filter(spec))
@@ -1,3 +1,4 @@
+import time
 import pytest
 from src.gdp_table_manager import GDPTableManager, GDPNotFoundException
 from src.gdp_storage import InMemoryStorageManager
@@ -6,7 +7,7 @@ from sdtp import RowTable
 @pytest.fixture
 def managers():
     storage_mgr = InMemoryStorageManager()
-    tm = GDPTableManager(storage_mgr)
+    tm = GDPTableManager(storage_mgr, journal_poll_interval=0)
     return tm
 
 @pytest.fixture
@@ -80,3 +81,403 @@ def test_get_table_info(managers, sample_tables):
     info_bob = tm.get_table_info("bob", True)
     assert isinstance(info_bob, dict)
     
+
+def test_concurrent_misses_load_once(sample_tables):
+    import threading
+    import time
+
+    class SlowStorage(InMemoryStorageManager):
+        def __init__(self):
+            super().__init__()
+            self.fetches = 0
+        def get_object(self, key):
+            if key.endswith('.sdml'):
+                self.fetches += 1
+                time.sleep(0.05)
+            return super().get_object(key)
+
+    table_1, table_2 = sample_tables
+    storage = SlowStorage()
+    writer = GDPTableManager(storage, journal_poll_interval=0)
+    writer.publish_table("alice/table1.sdml", table_1)
+    tm = GDPTableManager(storage, journal_poll_interval=0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(tm.get_table("alice/table1.sdml"))) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert storage.fetches == 1
+    assert len(results) == 8
+    assert all(result is results[0] for result in results)
+
+def test_append_and_patch_rows(sample_tables):
+    from src.gdp_table_manager import GDPNotOwnerException
+    from src.table_segments import segments_key
+    from sdtp import InvalidDataException
+    table_1, table_2 = sample_tables
+    storage = InMemoryStorageManager()
+    tm = GDPTableManager(storage, journal_poll_interval=0)
+    tm.publish_table("alice/table1.sdml", table_1)
+    tm.update_access("alice/table1.sdml", "alice", [])
+    assert tm.append_rows("alice/table1.sdml", "alice", [[3, "Carol"]]) == 3
+    assert tm.patch_rows("alice/table1.sdml", "alice", [[2, "Robert"], [4, "Dan"]], "id") == 4
+    expected = [[1, "Alice"], [2, "Robert"], [3, "Carol"], [4, "Dan"]]
+    assert tm.get_table("alice/table1.sdml").rows == expected
+    # A fresh manager rebuilds the same table from the base and its segments
+    assert GDPTableManager(storage, journal_poll_interval=0).get_table("alice/table1.sdml").rows == expected
+    with pytest.raises(GDPNotOwnerException):
+        tm.append_rows("alice/table1.sdml", "bob", [[5, "Eve"]])
+    with pytest.raises(InvalidDataException):
+        tm.append_rows("alice/table1.sdml", "alice", [[5]])
+    with pytest.raises(InvalidDataException):
+        tm.patch_rows("alice/table1.sdml", "alice", [[5, "Eve"]], "nope")
+    tm.compact_table("alice/table1.sdml")
+    assert not storage.key_exists(segments_key("alice/table1.sdml"))
+    assert GDPTableManager(storage, journal_poll_interval=0).get_table("alice/table1.sdml").rows == expected
+    tm.append_rows("alice/table1.sdml", "alice", [[5, "Eve"]])
+    tm.publish_table("alice/table1.sdml", table_1)
+    assert GDPTableManager(storage, journal_poll_interval=0).get_table("alice/table1.sdml").rows == table_1["rows"]
+    tm.delete_table("alice/table1.sdml")
+    assert storage.all_keys_matching(prefix="alice/") == []
+
+@pytest.mark.parametrize("backend", ["memory", "filesystem"])
+def test_concurrent_updates_from_two_workers(backend, tmp_path, monkeypatch):
+    import threading
+    import src.gdp_table_manager as table_manager
+    from src.gdp_storage import GDPFileSystemStorageManager
+    # Compact every few segments, so compactions race with the appends
+    monkeypatch.setattr(table_manager, 'COMPACT_SEGMENTS', 4)
+    def make_storage():
+        return InMemoryStorageManager() if backend == "memory" else GDPFileSystemStorageManager(str(tmp_path), durable=False)
+    shared = make_storage()
+    # Two workers: separate managers (and, on disk, separate storage managers)
+    workers = [GDPTableManager(shared, journal_poll_interval=0), GDPTableManager(shared if backend == "memory" else make_storage(), journal_poll_interval=0)]
+    schema = [{"name": "id", "type": "number"}]
+    workers[0].publish_table("alice/t.sdml", {"type": "RowTable", "schema": schema, "rows": [[0]]})
+    def append(worker, first):
+        for i in range(first, first + 10):
+            worker.append_rows("alice/t.sdml", "alice", [[i]])
+    threads = [threading.Thread(target=append, args=(worker, 1 + 10 * n)) for (n, worker) in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    while any(worker._compacting for worker in workers):
+        time.sleep(0.01)
+    for worker in workers:
+        worker.compact_table("alice/t.sdml")
+    reader_storage = shared if backend == "memory" else make_storage()
+    rows = GDPTableManager(reader_storage, journal_poll_interval=0).get_table("alice/t.sdml").rows
+    assert sorted(row[0] for row in rows) == list(range(21))
+    # No segments or leases are left behind
+    assert shared.all_keys_matching(prefix="alice/t.seg") == []
+    assert shared.all_keys_matching(prefix="alice/t.lease") == []
+
+def test_table_lease():
+    from src.table_lease import TableLease, GDPTableBusyException
+    storage = InMemoryStorageManager()
+    with TableLease(storage, "alice/t.sdml", "alice/t.lease"):
+        with pytest.raises(GDPTableBusyException):
+            with TableLease(storage, "alice/t.sdml", "alice/t.lease", wait=0.1):
+                pass
+    assert not storage.key_exists("alice/t.lease")
+    # A lease left behind by a holder which died is taken over once it expires
+    TableLease(storage, "alice/t.sdml", "alice/t.lease", ttl=0.05).__enter__()
+    with TableLease(storage, "alice/t.sdml", "alice/t.lease", wait=1):
+        assert storage.key_exists("alice/t.lease")
+    assert not storage.key_exists("alice/t.lease")
+    # A holder which overran its lease doesn't release the lease of the writer which took over
+    overrun = TableLease(storage, "alice/t.sdml", "alice/t.lease", ttl=0.05)
+    overrun.__enter__()
+    with TableLease(storage, "alice/t.sdml", "alice/t.lease", wait=1):
+        overrun.__exit__(None, None, None)
+        assert storage.key_exists("alice/t.lease")
+
+def test_wide_tables_load_by_column(monkeypatch):
+    import src.table_columns as table_columns
+    from src.columnar_table import ColumnarTable
+    monkeypatch.setattr(table_columns, 'COLUMNAR_MIN_COLUMNS', 3)
+
+    class RecordingStorage(InMemoryStorageManager):
+        def __init__(self):
+            super().__init__()
+            self.fetched = []
+        def get_object(self, key):
+            self.fetched.append(key)
+            return super().get_object(key)
+
+    storage = RecordingStorage()
+    schema = [{"name": "id", "type": "number"}, {"name": "name", "type": "string"}, {"name": "score", "type": "number"}]
+    rows = [[1, "a", 10], [2, "b", 20], [3, "c", 30]]
+    GDPTableManager(storage, journal_poll_interval=0).publish_table("alice/wide.sdml", {"type": "RowTable", "schema": schema, "rows": rows})
+    tm = GDPTableManager(storage, journal_poll_interval=0)
+    storage.fetched = []
+    assert tm.get_table_schema("alice/wide.sdml") == schema
+    assert "alice/wide.sdml" not in storage.fetched
+    table = tm.get_table("alice/wide.sdml")
+    assert isinstance(table, ColumnarTable)
+    assert table.loaded_columns() == []
+    spec = {"operator": "GE", "column": "score", "value": 20}
+    assert tm.filter_rows("alice/wide.sdml", table, spec, ["id"], "list") == [[2], [3]]
+    assert table.loaded_columns() == ["id", "score"]
+    assert tm.aggregate("alice/wide.sdml", table, None, ["name"], [{"function": "sum", "column": "score"}]) == [["a", 10], ["b", 20], ["c", 30]]
+    assert table.range_spec("score") == [10, 30]
+    assert "alice/wide.sdml" not in storage.fetched
+    assert table.to_dictionary()["rows"] == rows
+    # Updating a table reads it in full
+    tm.update_access("alice/wide.sdml", "alice", [])
+    tm.append_rows("alice/wide.sdml", "alice", [[4, "d", 40]])
+    assert isinstance(tm.get_table("alice/wide.sdml"), RowTable)
+    tm.compact_table("alice/wide.sdml")
+    fresh = GDPTableManager(storage, journal_poll_interval=0).get_table("alice/wide.sdml")
+    assert isinstance(fresh, ColumnarTable)
+    assert fresh.get_column("id") == [1, 2, 3, 4]
+    tm.delete_table("alice/wide.sdml")
+    assert storage.all_keys_matching(prefix="alice/") == []
+
+def test_republished_columns_outlive_readers(monkeypatch):
+    import src.table_columns as table_columns
+    monkeypatch.setattr(table_columns, 'COLUMNAR_MIN_COLUMNS', 3)
+    storage = InMemoryStorageManager()
+    schema = [{"name": "id", "type": "number"}, {"name": "name", "type": "string"}, {"name": "score", "type": "number"}]
+    writer = GDPTableManager(storage, journal_poll_interval=0)
+    writer.publish_table("alice/wide.sdml", {"type": "RowTable", "schema": schema, "rows": [[1, "a", 10]]})
+    # Another worker is still serving the first version when it is replaced
+    old = GDPTableManager(storage, journal_poll_interval=0).get_table("alice/wide.sdml")
+    writer.publish_table("alice/wide.sdml", {"type": "RowTable", "schema": schema, "rows": [[2, "b", 20]]})
+    assert old.get_column("name") == ["a"]
+    # Once the retention has passed, the next write drops the old columns
+    monkeypatch.setattr(table_columns, 'JOURNAL_RETENTION', 0)
+    writer.publish_table("alice/wide.sdml", {"type": "RowTable", "schema": schema, "rows": [[3, "c", 30]]})
+    assert len(storage.all_keys_matching(prefix="alice/wide.col.")) == 3
+    writer.delete_table("alice/wide.sdml")
+    assert storage.all_keys_matching(prefix="alice/") == []
+
+def test_cold_load_reads_three_objects(sample_tables):
+    from src.gdp_storage import SimulatedLatencyStorageManager
+    storage = SimulatedLatencyStorageManager(InMemoryStorageManager())
+    GDPTableManager(storage, journal_poll_interval=0).publish_table("alice/t.sdml", sample_tables[0])
+    GDPTableManager(storage, journal_poll_interval=0).publish_table("alice/u.sdml", sample_tables[1])
+    tm = GDPTableManager(storage, journal_poll_interval=0)
+    tm.get_table("alice/t.sdml")
+    storage.reset_counts()
+    assert tm.get_table("alice/u.sdml").rows == sample_tables[1]["rows"]
+    assert sum(storage.call_counts.values()) == 3
+
+def test_catalogue_serves_schemas(sample_tables):
+    from src.table_catalogue import CATALOGUE_KEY
+    table_1, table_2 = sample_tables
+
+    class RecordingStorage(InMemoryStorageManager):
+        def __init__(self):
+            super().__init__()
+            self.fetched = []
+        def get_object(self, key):
+            self.fetched.append(key)
+            return super().get_object(key)
+
+    storage = RecordingStorage()
+    writer = GDPTableManager(storage, journal_poll_interval=0)
+    writer.publish_table("alice/table1.sdml", table_1)
+    writer.publish_table("bob/table2.sdml", table_2)
+    writer.update_access("bob/table2.sdml", "bob", ["PUBLIC"])
+    catalogue = writer.read_catalogue()
+    assert catalogue["alice/table1.sdml"]["row_count"] == 2
+    assert catalogue["bob/table2.sdml"]["schema"] == table_2["schema"]
+    writer.update_access("alice/table1.sdml", "alice", [])
+    writer.append_rows("alice/table1.sdml", "alice", [[3, "Carol"]])
+    # Appends leave the catalogue alone; compaction brings it up to date
+    assert writer.read_catalogue()["alice/table1.sdml"]["row_count"] == 2
+    writer.compact_table("alice/table1.sdml")
+    assert writer.read_catalogue()["alice/table1.sdml"]["row_count"] == 3
+
+    tm = GDPTableManager(storage, journal_poll_interval=0)
+    storage.fetched = []
+    assert tm.get_table_info("alice", False) == {"alice/table1.sdml": table_1["schema"], "bob/table2.sdml": table_2["schema"]}
+    assert [key for key in storage.fetched if key.endswith('.sdml') or '.col' in key] == []
+    assert storage.fetched.count(CATALOGUE_KEY) == 1
+    # A table missing from the catalogue is described from storage and added back
+    storage.put_object(CATALOGUE_KEY, '{"tables": {}}')
+    assert tm.get_table_info("alice", False)["alice/table1.sdml"] == table_1["schema"]
+    assert "alice/table1.sdml" in tm.read_catalogue()
+    writer.delete_table("bob/table2.sdml")
+    assert "bob/table2.sdml" not in tm.read_catalogue()
+    assert set(tm.rebuild_catalogue().keys()) == {"alice/table1.sdml"}
+
+def test_catalogue_kept_when_updates_lose(sample_tables):
+    from src.table_catalogue import CATALOGUE_KEY, TableCatalogue
+
+    class ContendedStorage(InMemoryStorageManager):
+        contended = False
+        def put_object_if_match(self, key, object_data, expected):
+            if self.contended and key == CATALOGUE_KEY:
+                return None
+            return super().put_object_if_match(key, object_data, expected)
+
+    storage = ContendedStorage()
+    tm = GDPTableManager(storage, journal_poll_interval=0)
+    tm.catalogue.BACKOFF = 0
+    tm.publish_table("alice/old.sdml", sample_tables[0])
+    storage.contended = True
+    tm.publish_table("alice/new.sdml", sample_tables[0])
+    # The stale catalogue stays, and the lost update is written with the next one
+    assert set(TableCatalogue(storage, dict).read().keys()) == {"alice/old.sdml"}
+    storage.contended = False
+    tm.delete_table("alice/old.sdml")
+    assert set(TableCatalogue(storage, dict).read().keys()) == {"alice/new.sdml"}
+
+@pytest.mark.parametrize("backend", ["memory", "filesystem"])
+def test_catalogue_shared_by_workers(backend, tmp_path, sample_tables):
+    import threading
+    from src.gdp_storage import GDPFileSystemStorageManager
+    from src.table_catalogue import CATALOGUE_KEY
+    table_1 = sample_tables[0]
+    def make_storage():
+        return InMemoryStorageManager() if backend == "memory" else GDPFileSystemStorageManager(str(tmp_path), durable=False)
+    storage = make_storage()
+    first = GDPTableManager(storage, journal_poll_interval=0)
+    first.publish_table("alice/old.sdml", table_1)
+    # A catalogue lost (or never written) is rebuilt from storage, not started afresh
+    storage.delete_object(CATALOGUE_KEY)
+    first.publish_table("alice/new.sdml", table_1)
+    assert set(first.read_catalogue().keys()) == {"alice/old.sdml", "alice/new.sdml"}
+    workers = [GDPTableManager(storage, journal_poll_interval=0), GDPTableManager(storage if backend == "memory" else make_storage(), journal_poll_interval=0)]
+    def publish(worker, n):
+        for i in range(6):
+            worker.publish_table(f"alice/w{n}_{i}.sdml", table_1)
+    threads = [threading.Thread(target=publish, args=(worker, n)) for (n, worker) in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    workers[0].delete_table("alice/w1_0.sdml")
+    catalogue = GDPTableManager(storage, journal_poll_interval=0).read_catalogue()
+    assert set(catalogue.keys()) == set(first.list_tables())
+
+def test_table_pages_follow_storage(sample_tables):
+    from src.table_catalogue import CATALOGUE_KEY
+    from json import dumps
+    storage = InMemoryStorageManager()
+    tm = GDPTableManager(storage, journal_poll_interval=0)
+    tm.publish_table("alice/a.sdml", sample_tables[0])
+    tm.publish_table("alice/b.sdml", sample_tables[1])
+    # The catalogue has lost b, and still lists a table which was deleted
+    catalogue = tm.read_catalogue()
+    storage.put_object(CATALOGUE_KEY, dumps({"tables": {"alice/a.sdml": catalogue["alice/a.sdml"], "alice/gone.sdml": catalogue["alice/a.sdml"]}}))
+    page = tm.list_tables_page("alice", False)
+    assert [(entry["key"], entry["row_count"]) for entry in page["tables"]] == [("alice/a.sdml", 2), ("alice/b.sdml", 2)]
+    assert set(tm.read_catalogue().keys()) == {"alice/a.sdml", "alice/b.sdml"}
+
+def test_preview(sample_tables):
+    from src.config import PREVIEW_ROWS
+    rows = [[i, f'name_{i}'] for i in range(2 * PREVIEW_ROWS + 3)]
+    storage = InMemoryStorageManager()
+    writer = GDPTableManager(storage, journal_poll_interval=0)
+    writer.publish_table("alice/long.sdml", {"type": "RowTable", "schema": sample_tables[0]["schema"], "rows": rows})
+    writer.publish_table("alice/short.sdml", sample_tables[0])
+    expected = {"schema": sample_tables[0]["schema"], "row_count": len(rows), "head": rows[:PREVIEW_ROWS], "tail": rows[-PREVIEW_ROWS:]}
+    # From the sidecar, without loading the table, and from the table in memory
+    tm = GDPTableManager(storage, journal_poll_interval=0)
+    assert tm.preview("alice/long.sdml") == expected
+    assert "alice/long.sdml" not in tm.table_server.servers
+    assert writer.preview("alice/long.sdml") == expected
+    assert tm.preview("alice/long.sdml", 2, 0) == {**expected, "head": rows[:2], "tail": []}
+    assert tm.preview("alice/short.sdml") == {"schema": sample_tables[0]["schema"], "row_count": 2, "head": sample_tables[0]["rows"], "tail": []}
+    writer.update_access("alice/long.sdml", "alice", [])
+    writer.append_rows("alice/long.sdml", "alice", [[100, "last"]])
+    assert GDPTableManager(storage, journal_poll_interval=0).preview("alice/long.sdml")["tail"][-1] == [100, "last"]
+
+def test_change_journal_across_replicas(sample_tables):
+    from src.gdp_storage import SimulatedLatencyStorageManager
+    table_1, table_2 = sample_tables
+    shared = InMemoryStorageManager()
+    writer = GDPTableManager(shared, journal_poll_interval=3600)
+    reader_storage = SimulatedLatencyStorageManager(shared)
+    reader = GDPTableManager(reader_storage, journal_poll_interval=3600)
+    writer.journal.poll()
+    writer.publish_table("alice/t.sdml", table_1)
+    assert reader.get_table("alice/t.sdml").rows == table_1["rows"]
+    # get_table starts the poller
+    while not reader.journal.trusted():
+        time.sleep(0.01)
+    # The first poll revalidates what was cached before it, once
+    reader.get_table("alice/t.sdml")
+    reader_storage.reset_counts()
+    assert reader.get_table("alice/t.sdml").rows == table_1["rows"]
+    assert sum(reader_storage.call_counts.values()) == 0
+    # A change elsewhere is seen at the next poll, and evicts only that table
+    writer.publish_table("alice/u.sdml", table_1)
+    reader.journal.poll()
+    reader.get_table("alice/u.sdml")
+    writer.publish_table("alice/t.sdml", table_2)
+    assert reader.get_table("alice/t.sdml").rows == table_1["rows"]
+    assert reader.journal.poll() == 1
+    assert "alice/t.sdml" not in reader.table_server.servers
+    assert "alice/u.sdml" in reader.table_server.servers
+    assert reader.get_table("alice/t.sdml").rows == table_2["rows"]
+    writer.delete_table("alice/t.sdml")
+    reader.journal.poll()
+    with pytest.raises(GDPNotFoundException):
+        reader.get_table("alice/t.sdml")
+    # A process skips its own entries
+    assert writer.journal.poll() == 0
+    assert "alice/u.sdml" in writer.table_server.servers
+    # With the journal off, every request checks storage
+    untrusted = GDPTableManager(reader_storage, journal_poll_interval=0)
+    untrusted.get_table("alice/u.sdml")
+    reader_storage.reset_counts()
+    untrusted.get_table("alice/u.sdml")
+    assert reader_storage.call_counts["get_meta"] > 0
+
+def test_stale_while_revalidate(sample_tables, monkeypatch):
+    import src.gdp_table_manager as gdp_table_manager
+    from src.gdp_storage import SimulatedLatencyStorageManager
+    table_1, table_2 = sample_tables
+    shared = InMemoryStorageManager()
+    writer = GDPTableManager(shared, journal_poll_interval=0)
+    reader_storage = SimulatedLatencyStorageManager(shared)
+    reader = GDPTableManager(reader_storage, journal_poll_interval=0)
+    writer.publish_table("alice/t.sdml", table_1)
+    # Within the TTL the cache isn't checked at all
+    monkeypatch.setattr(gdp_table_manager, "TABLE_CACHE_TTL", 60)
+    reader.get_table("alice/t.sdml")
+    writer.publish_table("alice/t.sdml", table_2)
+    reader_storage.reset_counts()
+    assert reader.get_table("alice/t.sdml").rows == table_1["rows"]
+    assert sum(reader_storage.call_counts.values()) == 0
+    # Once it expires, the change is noticed; the stale table is served while it reloads
+    monkeypatch.setattr(gdp_table_manager, "TABLE_CACHE_TTL", 0)
+    monkeypatch.setattr(gdp_table_manager, "TABLE_CACHE_STALE", 60)
+    assert reader.get_table("alice/t.sdml").rows == table_1["rows"]
+    deadline = time.monotonic() + 5
+    while reader.table_server.servers["alice/t.sdml"].rows != table_2["rows"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert reader.get_table("alice/t.sdml").rows == table_2["rows"]
+    # Without it, the request which notices the change waits for the reload
+    monkeypatch.setattr(gdp_table_manager, "TABLE_CACHE_STALE", 0)
+    writer.publish_table("alice/t.sdml", table_1)
+    assert reader.get_table("alice/t.sdml").rows == table_1["rows"]
+
+def test_missing_keys_are_cached(sample_tables):
+    from src.gdp_storage import SimulatedLatencyStorageManager
+    from src.gdp_table_manager import perm_key
+    storage = SimulatedLatencyStorageManager(InMemoryStorageManager())
+    tm = GDPTableManager(storage, journal_poll_interval=0)
+    for i in range(3):
+        with pytest.raises(GDPNotFoundException):
+            tm.get_table("alice/missing.sdml")
+    assert not tm.table_exists("alice/missing.sdml")
+    assert storage.call_counts["get_meta"] == 1
+    assert storage.call_counts["key_exists"] == 0
+    # A local publish forgets it
+    tm.publish_table("alice/missing.sdml", sample_tables[0])
+    assert tm.get_table("alice/missing.sdml").rows == sample_tables[0]["rows"]
+    # Unshared tables have no permission record; it is only looked for once
+    storage.reset_counts()
+    assert tm.table_access_permitted("alice/missing.sdml", "alice", False)
+    assert not tm.table_access_permitted("alice/missing.sdml", "bob", False)
+    assert storage.call_counts["get_object"] == 1
+    tm.update_access("alice/missing.sdml", "alice", ["bob"])
+    assert tm.table_access_permitted("alice/missing.sdml", "bob", False)
+    assert storage.backend.get_object(perm_key("alice/missing.sdml")) is not None
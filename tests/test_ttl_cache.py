@@ -0,0 +1,37 @@
+import time
+from src.ttl_cache import TTLCache
+
+
+def test_hit_and_miss():
+    cache = TTLCache(max_size=4, ttl=60)
+    assert cache.lookup('a') == (False, None)
+    cache.put('a', 1)
+    assert cache.lookup('a') == (True, 1)
+
+def test_negative_entries():
+    cache = TTLCache(max_size=4, ttl=60)
+    cache.put('bad_token', None, ttl=60)
+    assert cache.lookup('bad_token') == (True, None)
+
+def test_expiry():
+    cache = TTLCache(max_size=4, ttl=60)
+    cache.put('a', 1, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.lookup('a') == (False, None)
+    assert len(cache) == 0
+
+def test_lru_eviction():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.lookup('a')
+    cache.put('c', 3)
+    assert cache.lookup('b') == (False, None)
+    assert cache.lookup('a') == (True, 1)
+    assert cache.lookup('c') == (True, 3)
+
+def test_invalidate():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.put('a', 1)
+    cache.invalidate('a')
+    assert cache.lookup('a') == (False, None)